@@ -0,0 +1,238 @@
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote_to_bytes
+
+from stream import KEEPALIVE_INTERVAL, sse_format
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 16 * 1024 * 1024
+IDLE_TIMEOUT = 60  # seconds a keep-alive connection may sit between requests
+HOP_BY_HOP = {'connection', 'keep-alive', 'transfer-encoding', 'content-length'}
+
+
+class BadRequest(Exception):
+    status = '400 Bad Request'
+
+
+class UnsupportedEncoding(BadRequest):
+    status = '501 Not Implemented'
+
+
+# asyncio HTTP/1.1 front end for the Flask app. The process stream is served straight from the loop,
+# every other route runs through the WSGI app on a small thread pool, so routes and behaviour stay
+# identical to the threaded server. An idle stream costs a socket, a coroutine and its small queue.
+class AsyncServer:
+    def __init__(self, app, broadcaster, host='127.0.0.1', port=5000, workers=16, stream_path='/process_stream'):
+        self.app = app
+        self.broadcaster = broadcaster
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.stream_path = stream_path
+        self.loop = None
+        self.executor = None
+        self.waiters = set()  # asyncio.Event per open stream, set when the sampler publishes
+
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='wsgi')
+        self.broadcaster.add_hook(self._published)
+        server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_HEADER_SIZE)
+        logger.info(f"Serving on http://{self.host}:{self.port} (asyncio)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.broadcaster.remove_hook(self._published)
+            self.executor.shutdown(wait=False)
+
+    # Called on the sampler thread after every publish: one hop into the loop wakes every stream
+    def _published(self):
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        for event in self.waiters:
+            event.set()
+
+    async def _read_request(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise BadRequest("request header too large")
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise BadRequest("malformed request line")
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers.append((name.strip().lower(), value.strip()))
+        fields = dict(headers)
+        encoding = fields.get('transfer-encoding', '').lower()
+        if encoding and encoding != 'chunked':
+            raise UnsupportedEncoding(f"unsupported Transfer-Encoding: {encoding}")
+        try:
+            length = int(fields.get('content-length', 0) or 0)
+        except ValueError:
+            raise BadRequest("invalid Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise BadRequest("request body too large")
+        if (encoding or length) and fields.get('expect', '').lower() == '100-continue' and version == 'HTTP/1.1':
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")  # the client waits for this before sending the body
+            await writer.drain()
+        if encoding:
+            body = await self._read_chunked(reader)
+            # The app sees a plain body with its decoded length
+            headers = [(name, value) for name, value in headers if name not in ('transfer-encoding', 'content-length')]
+            headers.append(('content-length', str(len(body))))
+        else:
+            body = await reader.readexactly(length) if length else b''
+        return method, target, version, headers, body
+
+    async def _read_chunked(self, reader):
+        body = bytearray()
+        try:
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                try:
+                    size = int(line.split(b';')[0].strip(), 16)  # chunk extensions are ignored
+                except ValueError:
+                    raise BadRequest("malformed chunk size")
+                if size == 0:
+                    break
+                if len(body) + size > MAX_BODY_SIZE:
+                    raise BadRequest("request body too large")
+                body += await reader.readexactly(size)
+                if await reader.readexactly(2) != b'\r\n':
+                    raise BadRequest("malformed chunk")
+            while await reader.readuntil(b'\r\n') != b'\r\n':  # trailers are ignored too
+                pass
+        except asyncio.LimitOverrunError:
+            raise BadRequest("chunk header too large")
+        return bytes(body)
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('', 0)
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader, writer)
+                except BadRequest as e:
+                    await self._respond(writer, e.status, [('Content-Type', 'text/plain')],
+                                        str(e).encode(), close=True)
+                    return
+                if request is None:
+                    return
+                method, target, version, headers, body = request
+                path, _, query = target.partition('?')
+                close = version == 'HTTP/1.0' or dict(headers).get('connection', '').lower() == 'close'
+                if path == self.stream_path and method == 'GET':
+                    await self._stream(writer, query, dict(headers), peer)
+                    return
+                environ = self._environ(method, path, query, version, headers, body, peer)
+                status, response_headers, response_body = await self.loop.run_in_executor(
+                    self.executor, self._call_app, environ)
+                if method == 'HEAD' or status.startswith(('204', '304')):
+                    response_body = b''
+                await self._respond(writer, status, response_headers, response_body, close)
+                if close:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _environ(self, method, path, query, version, headers, body, peer):
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str(peer[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers:
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    # Runs on the thread pool
+    def _call_app(self, environ):
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return chunks.append
+
+        result = self.app(environ, start_response)
+        try:
+            for chunk in result:
+                chunks.append(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], b''.join(chunks)
+
+    async def _respond(self, writer, status, headers, body, close=False):
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in headers if name.lower() not in HOP_BY_HOP]
+        lines.append(f"Content-Length: {len(body)}")
+        lines.append("Connection: close" if close else "Connection: keep-alive")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+    async def _stream(self, writer, query, headers, peer):
+        args = parse_qs(query)
+        last_event_id = headers.get('last-event-id') or args.get('last_event_id', [None])[0]
+        try:
+            fmt = sse_format(args.get('format', ['sse'])[0])
+            subscriber = self.broadcaster.subscribe(last_event_id, name=peer[0], fmt=fmt)
+        except ValueError as e:
+            await self._respond(writer, '400 Bad Request', [('Content-Type', 'text/plain')], str(e).encode(), True)
+            return
+        event = asyncio.Event()
+        self.waiters.add(event)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            while True:
+                event.clear()  # before draining, so a publish in between isn't missed
+                frame = subscriber.get(0)  # never blocks, the queue is filled by the sampler thread
+                while frame is not None:
+                    writer.write(frame)
+                    await writer.drain()  # a slow client only holds up its own coroutine; its queue collapses
+                    frame = subscriber.get(0)
+                try:
+                    await asyncio.wait_for(event.wait(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                    await writer.drain()
+        finally:
+            self.waiters.discard(event)
+            self.broadcaster.unsubscribe(subscriber)
@@ -0,0 +1,106 @@
+import ipaddress
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10000  # ipset/nft lines per bulk load call
+
+
+# Binary radix trie over address bits; a terminal node covers everything below it
+class PrefixTrie:
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, False]  # [zero child, one child, terminal]
+
+    def insert(self, value, length):
+        node = self.root
+        shift = self.bits - 1
+        for _ in range(length):
+            if node[2]:
+                return  # already covered by a shorter prefix
+            bit = (value >> shift) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, False]
+            node = child
+            shift -= 1
+        if not node[2]:
+            node[0] = node[1] = None  # everything below is now redundant
+            node[2] = True
+
+    # Collapse siblings that are both terminal into their parent, bottom-up
+    def _merge(self, node):
+        if node[2]:
+            return True
+        left = node[0] is not None and self._merge(node[0])
+        right = node[1] is not None and self._merge(node[1])
+        if left and right:
+            node[0] = node[1] = None
+            node[2] = True
+        return node[2]
+
+    # Yield (value, length) for every aggregated prefix in address order
+    def prefixes(self):
+        self._merge(self.root)
+        stack = [(self.root, 0, 0)]
+        while stack:
+            node, value, length = stack.pop()
+            if node[2]:
+                yield value << (self.bits - length), length
+                continue
+            for bit in (1, 0):
+                if node[bit] is not None:
+                    stack.append((node[bit], (value << 1) | bit, length + 1))
+
+
+# Parse feed lines into networks, skipping comments and junk
+def parse_entries(lines):
+    networks = []
+    invalid = 0
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(line.split()[0], strict=False))
+        except ValueError:
+            invalid += 1
+    if invalid:
+        logger.warning(f"Skipped {invalid} invalid blocklist entries")
+    return networks
+
+
+def load_feed(path):
+    with open(path, 'r') as f:
+        return parse_entries(f)
+
+
+# Collapse overlapping and adjacent networks, returning (ipv4, ipv6) lists of strings
+def aggregate(networks):
+    tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+    for net in networks:
+        tries[net.version].insert(int(net.network_address), net.prefixlen)
+    result = {}
+    for version, trie in tries.items():
+        cls = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+        result[version] = [str(cls((value, length))) for value, length in trie.prefixes()]
+    return result[4], result[6]
+
+
+def chunks(items, size=CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Aggregate a feed and push it into the backend as an incremental diff per address family
+def import_blocklist(backend, name, networks):
+    v4, v6 = aggregate(networks)
+    added4, removed4 = backend.sync_set(name, v4, 4)
+    added6, removed6 = backend.sync_set(name, v6, 6)
+    logger.info(f"Blocklist {name}: {len(networks)} entries aggregated to {len(v4) + len(v6)} prefixes")
+    return {
+        'entries': len(networks),
+        'prefixes': len(v4) + len(v6),
+        'added': added4 + added6,
+        'removed': removed4 + removed6,
+    }
@@ -0,0 +1,108 @@
+import logging
+import os
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 1024 * 1024  # bytes/s assumed until we know better, the historic 100%
+PEAK_WINDOW = 1800  # samples kept for the observed peak, half an hour at one sample per second
+SHIFT_THRESHOLD = 0.1  # relative change that counts as a significant shift
+
+
+# Negotiated link speed in bytes/s, or None for virtual/unknown interfaces
+def link_speed(iface):
+    try:
+        with open(f'/sys/class/net/{iface}/speed', 'r') as f:
+            mbits = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    return mbits * 1000 * 1000 // 8 if mbits > 0 else None
+
+
+# Transmitted (or received) bytes of an interface from /proc/net/dev
+def iface_bytes(iface, direction='tx'):
+    column = 8 if direction == 'tx' else 0
+    with open('/proc/net/dev', 'r') as f:
+        for line in f:
+            name, _, counters = line.partition(':')
+            if name.strip() == iface:
+                return int(counters.split()[column])
+    return None
+
+
+# Link capacity in one direction: the operator override, else the negotiated link speed, else (virtual
+# interfaces, Wi-Fi drivers that don't report a speed) the observed throughput peak
+class CapacityEstimator:
+    def __init__(self, iface, override=None, window=PEAK_WINDOW, floor=DEFAULT_CAPACITY, direction='tx'):
+        self.iface = iface
+        self.direction = direction
+        self.override = override
+        self.floor = floor
+        self.speed = link_speed(iface)
+        self.peaks = deque()  # monotonic (index, rate) queue for the sliding window maximum
+        self.window = window
+        self.samples = 0
+        self.last = None  # (timestamp, tx bytes)
+        self.current = self.compute()
+
+    def observed_peak(self):
+        return self.peaks[0][1] if self.peaks else 0
+
+    def compute(self):
+        if self.override:
+            return self.override
+        if self.speed:
+            return self.speed
+        if not self.samples:
+            return self.floor
+        return max(self.observed_peak(), self.floor)
+
+    # `capped`: we are shaping the whole link ourselves, so what gets through only measures our own cap
+    # and must not pull the estimate down
+    def sample(self, now=None, capped=False):
+        now = time.time() if now is None else now
+        try:
+            sent = iface_bytes(self.iface, self.direction)
+        except OSError:
+            return
+        if sent is None:
+            return
+        if self.last and now > self.last[0] and sent >= self.last[1] and not capped:
+            rate = (sent - self.last[1]) / (now - self.last[0])
+            while self.peaks and self.peaks[-1][1] <= rate:
+                self.peaks.pop()
+            self.peaks.append((self.samples, rate))
+            while self.peaks[0][0] <= self.samples - self.window:
+                self.peaks.popleft()
+            self.samples += 1
+        self.last = (now, sent)
+
+    # Take a sample and report whether the estimate moved enough to re-rate the limits
+    def update(self, now=None, capped=False):
+        self.sample(now, capped)
+        estimate = self.compute()
+        if abs(estimate - self.current) > self.current * SHIFT_THRESHOLD:
+            logger.info(f"Link capacity estimate for {self.iface} {self.direction} moved to {estimate / 1e6:.2f} MB/s")
+            self.current = estimate
+            return True
+        return False
+
+    def set_override(self, override):
+        self.override = override or None
+        self.current = self.compute()
+
+    def stats(self):
+        return {
+            'iface': self.iface,
+            'direction': self.direction,
+            'capacity': self.current,
+            'link_speed': self.speed,
+            'observed_peak': self.observed_peak(),
+            'override': self.override,
+        }
+
+
+def override_from_env(name='WATERWALL_LINK_CAPACITY'):
+    value = os.environ.get(name)
+    return int(value) if value else None
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/run/waterwall.sock'
+MAX_FRAME = 16 * 1024 * 1024
+HEADER = struct.Struct('>I')  # every frame is a 4-byte big-endian length followed by that much UTF-8 JSON
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _read_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ProtocolError("connection closed mid-frame")
+            return None
+        data += chunk
+    return data
+
+
+# Next message from the socket, or None when the peer closed the connection
+def read_frame(sock):
+    header = _read_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ProtocolError(f"frame of {size} bytes is too large")
+    body = _read_exactly(sock, size)
+    if body is None:
+        raise ProtocolError("connection closed mid-frame")
+    return json.loads(body)
+
+
+def encode_frame(message):
+    body = message if isinstance(message, bytes) else json.dumps(message).encode()
+    return HEADER.pack(len(body)) + body
+
+
+def write_frame(sock, message):
+    sock.sendall(encode_frame(message))
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.control
+        while True:
+            try:
+                request = read_frame(self.request)
+            except (ProtocolError, ValueError) as e:
+                write_frame(self.request, {'ok': False, 'error': str(e)})
+                return
+            except OSError:
+                return
+            if request is None:
+                return
+            reply = {'id': request.get('id')} if isinstance(request, dict) else {}
+            op = request.get('op') if isinstance(request, dict) else None
+            if op == 'subscribe' and server.broadcaster is not None:
+                server.stream(self.request, request, reply)
+                return
+            handler = server.handlers.get(op)
+            if handler is None:
+                reply.update(ok=False, error=f"unknown op {op!r}, expected one of {', '.join(server.ops())}")
+            else:
+                try:
+                    reply.update(ok=True, result=handler(request))
+                except ValueError as e:
+                    reply.update(ok=False, error=str(e))
+                except Exception as e:
+                    logger.exception(f"Control op {op} failed")
+                    reply.update(ok=False, error=str(e))
+            try:
+                write_frame(self.request, reply)
+            except OSError:
+                return
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Framed request/response API on a Unix domain socket: {"op": ..., "id": ...} in, {"id", "ok", "result"|"error"}
+# out, any number of requests per connection. `subscribe` turns the connection into a stream of
+# snapshot/delta frames from the broadcaster.
+class ControlServer:
+    def __init__(self, path, handlers, broadcaster=None, mode=0o660):
+        self.path = path
+        self.handlers = handlers  # op -> callable(request dict) returning a JSON-able result
+        self.broadcaster = broadcaster
+        self.mode = mode  # root plus a group you chgrp the socket to
+        self.server = None
+        self.thread = None
+
+    def ops(self):
+        return sorted(self.handlers) + (['subscribe'] if self.broadcaster is not None else [])
+
+    def start(self):
+        if self.server is not None:
+            return
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise OSError(f"{self.path} is in use by another WaterWall")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)  # left over from a previous run
+            finally:
+                probe.close()
+        self.server = _ThreadingUnixServer(self.path, _Handler)
+        self.server.control = self
+        os.chmod(self.path, self.mode)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='control', daemon=True)
+        self.thread.start()
+        logger.info(f"Control socket listening on {self.path}")
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def stream(self, sock, request, reply):
+        try:
+            subscriber = self.broadcaster.subscribe(request.get('last_event_id'), name='unix',
+                                                    fmt=request.get('format', 'json'))
+        except ValueError as e:
+            write_frame(sock, {**reply, 'ok': False, 'error': str(e)})
+            return
+        try:
+            write_frame(sock, {**reply, 'ok': True, 'result': 'subscribed'})
+            while True:
+                frame = subscriber.get()
+                if frame is not None:
+                    sock.sendall(encode_frame(frame))
+        except OSError:
+            pass
+        finally:
+            self.broadcaster.unsubscribe(subscriber)
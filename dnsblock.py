@@ -0,0 +1,266 @@
+import asyncio
+import heapq
+import ipaddress
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from firewall import FirewallError
+
+logger = logging.getLogger(__name__)
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+# getaddrinfo errors that mean the name has no addresses; the rest (EAI_AGAIN, EAI_FAIL...) are outages
+NO_ADDRESS_ERRORS = {getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA') if hasattr(socket, name)}
+
+
+# The server couldn't answer (SERVFAIL, REFUSED...): says nothing about the domain's addresses
+class LookupFailed(Exception):
+    pass
+
+
+# Build a minimal recursive DNS query packet
+def build_query(query_id, domain, qtype):
+    header = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    qname = b''.join(bytes([len(label)]) + label.encode('idna') for label in domain.rstrip('.').split('.'))
+    return header + qname + b'\x00' + struct.pack('>HH', qtype, 1)
+
+
+def _skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:  # compression pointer ends the name
+            return offset + 2
+        offset += length + 1
+
+
+# Parse a DNS response into (query id, rcode, [(address, ttl)])
+def parse_response(data):
+    query_id, flags, qdcount, ancount = struct.unpack('>HHHH', data[:8])
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+    answers = []
+    for _ in range(ancount):
+        offset = _skip_name(data, offset)
+        rtype, _, ttl, rdlength = struct.unpack('>HHIH', data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        offset += rdlength
+        if rtype == QTYPE_A and rdlength == 4:
+            answers.append((str(ipaddress.IPv4Address(rdata)), ttl))
+        elif rtype == QTYPE_AAAA and rdlength == 16:
+            answers.append((str(ipaddress.IPv6Address(rdata)), ttl))
+    return query_id, flags & 0x000F, answers
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query_id, future):
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if self.future.done():
+            return
+        try:
+            result = parse_response(data)
+        except (struct.error, IndexError) as e:
+            self.future.set_exception(e)
+            return
+        if result[0] != self.query_id:
+            return
+        if result[1] not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            self.future.set_exception(LookupFailed(f"rcode {result[1]}"))
+        else:
+            self.future.set_result(result)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+# Resolves domains with bounded concurrency, either via a DNS server (real TTLs) or the system resolver
+class DomainResolver:
+    def __init__(self, nameserver=None, concurrency=100, timeout=2.0, default_ttl=300, min_ttl=30, max_ttl=86400):
+        self.nameserver = nameserver
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.default_ttl = default_ttl  # used when the system resolver gives us no TTL
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.semaphore = None
+
+    async def _query(self, domain, qtype):
+        loop = asyncio.get_running_loop()
+        query_id = random.randint(0, 0xFFFF)
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _QueryProtocol(query_id, future), remote_addr=(self.nameserver, 53))
+        try:
+            transport.sendto(build_query(query_id, domain, qtype))
+            _, _, answers = await asyncio.wait_for(future, self.timeout)
+            return answers
+        finally:
+            transport.close()
+
+    # (addresses, ttl), or (None, ttl) when the lookup failed. Only NXDOMAIN or an empty NOERROR answer
+    # to every query means the domain has no addresses; an outage must not empty the set.
+    async def _resolve_nameserver(self, domain):
+        results = await asyncio.gather(self._query(domain, QTYPE_A), self._query(domain, QTYPE_AAAA),
+                                       return_exceptions=True)
+        failed = any(isinstance(result, BaseException) for result in results)
+        answers = [answer for result in results if not isinstance(result, BaseException) for answer in result]
+        if not answers:
+            return None if failed else set(), self.min_ttl
+        return {address for address, _ in answers}, min(ttl for _, ttl in answers)
+
+    async def _resolve_system(self, domain):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(domain, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            return set() if e.errno in NO_ADDRESS_ERRORS else None, self.min_ttl
+        return {info[4][0] for info in infos}, self.default_ttl
+
+    # Resolve one domain to (addresses, ttl), never raising
+    async def resolve(self, domain):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            try:
+                if self.nameserver:
+                    addresses, ttl = await self._resolve_nameserver(domain)
+                else:
+                    addresses, ttl = await self._resolve_system(domain)
+            except (OSError, asyncio.TimeoutError, LookupFailed) as e:
+                logger.debug(f"Resolving {domain} failed: {e}")
+                addresses, ttl = None, self.min_ttl
+        return addresses, max(self.min_ttl, min(ttl, self.max_ttl))
+
+
+# Keeps a firewall address set in sync with what a list of domains resolves to
+class DomainBlocklist:
+    def __init__(self, backend, name, resolver=None):
+        self.backend = backend
+        self.name = name
+        self.resolver = resolver or DomainResolver()
+        self.cache = {}  # domain -> (addresses, expiry)
+        self.refs = {}  # address -> number of domains resolving to it
+        self.due = []  # heap of (expiry, domain)
+        self.domains = set()
+        self.lookups = 0
+        self.loop = None
+        self.wakeup = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.unsynced = False  # the last set update failed, retry on the next refresh
+
+    def _apply(self, domain, addresses):
+        old = self.cache.get(domain, (set(), 0))[0]
+        for address in old - addresses:
+            self.refs[address] -= 1
+            if not self.refs[address]:
+                del self.refs[address]
+        for address in addresses - old:
+            self.refs[address] = self.refs.get(address, 0) + 1
+        return old != addresses
+
+    def _sync(self):
+        networks = [ipaddress.ip_network(address) for address in self.refs]
+        v4 = sorted(str(net) for net in networks if net.version == 4)
+        v6 = sorted(str(net) for net in networks if net.version == 6)
+        try:
+            self.backend.sync_set(self.name, v4, 4)
+            self.backend.sync_set(self.name, v6, 6)
+            self.unsynced = False
+        except FirewallError as e:
+            logger.error(f"Domain blocklist {self.name}: {e}")
+            self.unsynced = True
+
+    async def _refresh(self, domains):
+        results = await asyncio.gather(*(self.resolver.resolve(domain) for domain in domains))
+        self.lookups += len(domains)
+        now = time.time()
+        changed = False
+        with self.lock:
+            for domain, (addresses, ttl) in zip(domains, results):
+                if domain not in self.domains:
+                    continue
+                if addresses is None:  # lookup failed, keep the last good answer a little longer
+                    addresses = self.cache.get(domain, (set(), 0))[0]
+                changed = self._apply(domain, addresses) or changed
+                expiry = now + ttl
+                self.cache[domain] = (addresses, expiry)
+                heapq.heappush(self.due, (expiry, domain))
+            if changed or self.unsynced:
+                self._sync()
+
+    def _pop_due(self, now):
+        domains = []
+        with self.lock:
+            while self.due and self.due[0][0] <= now:
+                expiry, domain = heapq.heappop(self.due)
+                cached = self.cache.get(domain)
+                if domain in self.domains and (cached is None or cached[1] == expiry):
+                    domains.append(domain)
+            next_due = self.due[0][0] if self.due else None
+        return domains, next_due
+
+    async def _run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            domains, next_due = self._pop_due(time.time())
+            if domains:
+                await self._refresh(domains)
+                continue
+            timeout = None if next_due is None else max(0, next_due - time.time())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self):
+        if self.thread:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._run(),), daemon=True)
+        self.thread.start()
+
+    # Replace the domain list; new domains are resolved right away, dropped ones released
+    def set_domains(self, domains):
+        domains = {d.strip().lower().rstrip('.') for d in domains if d.strip() and not d.startswith('#')}
+        with self.lock:
+            removed = self.domains - domains
+            added = domains - self.domains
+            self.domains = domains
+            for domain in removed:
+                self._apply(domain, set())
+                self.cache.pop(domain, None)
+            for domain in added:
+                heapq.heappush(self.due, (0, domain))
+            if removed:
+                self._sync()
+        self.start()
+        if self.wakeup is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return len(added), len(removed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'domains': len(self.domains),
+                'resolved': sum(1 for addresses, _ in self.cache.values() if addresses),
+                'addresses': len(self.refs),
+                'lookups': self.lookups,
+                'next_refresh': self.due[0][0] if self.due else None,
+            }
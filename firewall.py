@@ -0,0 +1,378 @@
+import os
+import ipaddress
+import subprocess
+import logging
+import shlex
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from blocklist import chunks
+from capacity import DEFAULT_CAPACITY
+
+logger = logging.getLogger(__name__)
+
+# Every rule we install carries this comment prefix so we can find it again
+RULE_TAG = 'waterwall'
+
+Rule = namedtuple('Rule', ['chain', 'kind', 'pid', 'target'])
+
+
+# A transaction's commit was rejected by the kernel; none of its rule changes took effect
+class FirewallError(Exception):
+    pass
+
+
+# Interface shared by the real and simulated firewall backends
+class FirewallBackend:
+    name = 'base'
+
+    def block(self, pid):
+        raise NotImplementedError
+
+    def unblock(self, pid):
+        raise NotImplementedError
+
+    # Packet/byte counters of all our rules in one readout, keyed by rule comment
+    def read_counters(self):
+        return {}
+
+    # Group several rule changes so they reach the kernel as a single commit; raises FirewallError
+    # when the commit fails
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    # Make the named address set contain exactly `networks`, returning (added, removed); raises
+    # FirewallError when the kernel rejects the change
+    def sync_set(self, name, networks, family=4):
+        raise NotImplementedError
+
+    def cleanup(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+# Limits are expressed as a percentage of the link capacity in bytes/s
+def limit_to_bytes(percentage, capacity=DEFAULT_CAPACITY):
+    return int(capacity * float(percentage) / 100)
+
+
+def rule_comment(kind, pid):
+    return f"{RULE_TAG}:{kind}:{pid}"
+
+
+def set_diff(current, networks):
+    wanted = set(networks)
+    return sorted(wanted - current), sorted(current - wanted), wanted
+
+
+# Real backend driving iptables on the OUTPUT chain
+class IptablesBackend(FirewallBackend):
+    name = 'iptables'
+
+    def __init__(self):
+        self.rules = None  # rule comment -> rule args as installed, loaded lazily from the kernel
+        self.pending = None  # rule changes queued by an open transaction
+        self.lock = threading.RLock()  # held for a whole transaction, so other threads can't join or skip it
+        self.sets = {}  # ipset name -> members we last loaded, for incremental diffs
+
+    def _run(self, args, binary="iptables"):
+        return subprocess.run([binary] + args, capture_output=True)
+
+    def _exists(self, rule, binary="iptables"):
+        return self._run(["-C"] + rule, binary).returncode == 0
+
+    # Index our own rules by their comment, using the exact specs iptables reports
+    def _load_rules(self):
+        result = subprocess.run(["iptables", "-S", "OUTPUT"], capture_output=True, text=True)
+        self.rules = {}
+        for line in result.stdout.splitlines():
+            args = shlex.split(line)
+            if "--comment" not in args:
+                continue
+            comment = args[args.index("--comment") + 1]
+            if comment.startswith(RULE_TAG + ":"):
+                self.rules[comment] = args[1:]
+
+    def _installed(self):
+        if self.rules is None:
+            self._load_rules()
+        return self.rules
+
+    def _change(self, op, comment, rule):
+        installed = self._installed()
+        if op == "-A":
+            installed[comment] = rule
+        else:
+            del installed[comment]
+        if self.pending is not None:
+            self.pending.append([op] + rule)
+        else:
+            self._run([op] + rule)
+
+    def _block_rule(self, pid):
+        return ["OUTPUT", "-m", "owner", "--uid-owner", str(pid),
+                "-m", "comment", "--comment", rule_comment('block', pid), "-j", "DROP"]
+
+    def block(self, pid):
+        comment = rule_comment('block', pid)
+        with self.lock:
+            if comment not in self._installed():
+                self._change("-A", comment, self._block_rule(pid))
+
+    def unblock(self, pid):
+        comment = rule_comment('block', pid)
+        with self.lock:
+            if comment in self._installed():
+                self._change("-D", comment, self.rules[comment])
+
+    # One iptables-save call per readout, no matter how many rules we have
+    def read_counters(self):
+        result = subprocess.run(["iptables-save", "-c", "-t", "filter"], capture_output=True, text=True)
+        counters = {}
+        for line in result.stdout.splitlines():
+            if not line.startswith("[") or f"{RULE_TAG}:" not in line:
+                continue
+            packets, _, rest = line[1:].partition(":")
+            byte_count, _, rule = rest.partition("]")
+            args = shlex.split(rule)
+            if "--comment" in args:
+                counters[args[args.index("--comment") + 1]] = (int(packets), int(byte_count))
+        return counters
+
+    # Queue every rule change and hand them to iptables-restore in one atomic commit
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.pending is not None:  # nested in this thread's own transaction
+                yield self
+                return
+            self._load_rules()
+            self.pending = []
+            try:
+                yield self
+            finally:
+                pending, self.pending = self.pending, None
+                if pending:
+                    script = "*filter\n" + "".join(shlex.join(change) + "\n" for change in pending) + "COMMIT\n"
+                    result = subprocess.run(["iptables-restore", "--noflush"], input=script,
+                                            capture_output=True, text=True)
+                    if result.returncode != 0:
+                        logger.error(f"iptables-restore failed: {result.stderr.strip()}")
+                        self._load_rules()
+                        raise FirewallError(f"iptables-restore failed: {result.stderr.strip()}")
+
+    def _ipset_restore(self, lines):
+        for chunk in chunks(lines):
+            result = subprocess.run(["ipset", "restore", "-exist"], input="\n".join(chunk) + "\n",
+                                    capture_output=True, text=True)
+            if result.returncode != 0:
+                logger.error(f"ipset restore failed: {result.stderr.strip()}")
+                raise FirewallError(f"ipset restore failed: {result.stderr.strip()}")
+
+    # Read back the members of an existing set so a restart still loads a diff
+    def _ipset_members(self, set_name):
+        result = subprocess.run(["ipset", "list", set_name], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        members = result.stdout.split("Members:", 1)[-1].split()
+        return {str(ipaddress.ip_network(member, strict=False)) for member in members}
+
+    def _ensure_set(self, set_name, family):
+        if set_name in self.sets:
+            return
+        members = self._ipset_members(set_name)
+        if members is None:
+            self._run(["create", set_name, "hash:net", "family", "inet" if family == 4 else "inet6",
+                       "maxelem", "2097152", "-exist"], "ipset")
+            members = set()
+        binary = "iptables" if family == 4 else "ip6tables"
+        rule = ["OUTPUT", "-m", "set", "--match-set", set_name, "dst",
+                "-m", "comment", "--comment", rule_comment('set', set_name), "-j", "DROP"]
+        if not self._exists(rule, binary):
+            self._run(["-A"] + rule, binary)
+        self.sets[set_name] = members
+
+    def sync_set(self, name, networks, family=4):
+        set_name = f"{RULE_TAG}-{name}"[:27] + f"-v{family}"  # ipset names max out at 31 chars
+        with self.lock:
+            self._ensure_set(set_name, family)
+            added, removed, wanted = set_diff(self.sets[set_name], networks)
+            try:
+                self._ipset_restore([f"del {set_name} {net}" for net in removed] +
+                                    [f"add {set_name} {net}" for net in added])
+            except FirewallError:
+                # Earlier chunks may have gone in: diff against what the kernel really holds next time
+                members = self._ipset_members(set_name)
+                if members is None:
+                    self.sets.pop(set_name, None)
+                else:
+                    self.sets[set_name] = members
+                raise
+            self.sets[set_name] = wanted
+        return len(added), len(removed)
+
+
+# In-memory backend modelling an iptables ruleset, for running without root
+class SimulatedBackend(FirewallBackend):
+    name = 'simulated'
+
+    def __init__(self, rule_cost_ns=50, op_latency=0.0):
+        self.rules = []  # evaluated in order, like a real chain
+        self.rule_cost_ns = rule_cost_ns  # cost of evaluating a single rule against a packet
+        self.op_latency = op_latency  # simulated kernel time per ruleset change, in seconds
+        self.ops = 0
+        self.noops = 0
+        self.kernel_time = 0.0
+        self.packets_evaluated = 0
+        self.rules_evaluated = 0
+        self.sets = {}  # set name -> members, matched in a single hash lookup like ipset
+        self.in_transaction = False
+        self.dirty = False
+        self.lock = threading.RLock()  # same transaction semantics as the iptables backend
+        self.counters = {}  # rule comment -> [packets, bytes] matched by evaluate()
+
+    def _find(self, kind, pid):
+        for i, rule in enumerate(self.rules):
+            if rule.kind == kind and rule.pid == pid:
+                return i
+        return -1
+
+    def _commit(self):
+        if self.in_transaction:
+            self.dirty = True
+            return
+        self.ops += 1
+        if self.op_latency:
+            start = time.perf_counter()
+            time.sleep(self.op_latency)
+            self.kernel_time += time.perf_counter() - start
+
+    def block(self, pid):
+        pid = int(pid)
+        with self.lock:
+            if self._find('block', pid) >= 0:
+                self.noops += 1
+                return
+            self.rules.append(Rule('OUTPUT', 'block', pid, 'DROP'))
+            self._commit()
+
+    def unblock(self, pid):
+        pid = int(pid)
+        with self.lock:
+            i = self._find('block', pid)
+            if i < 0:
+                self.noops += 1
+                return
+            del self.rules[i]
+            self._commit()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.in_transaction:
+                yield self
+                return
+            self.in_transaction = True
+            self.dirty = False
+            try:
+                yield self
+            finally:
+                self.in_transaction = False
+                if self.dirty:
+                    self._commit()
+
+    # Walk the chain for a packet owned by pid, returning (verdict, simulated cost in ns)
+    def evaluate(self, pid, size=1500):
+        pid = int(pid)
+        with self.lock:
+            self.packets_evaluated += 1
+            for n, rule in enumerate(self.rules, 1):
+                if rule.pid == pid:
+                    self.rules_evaluated += n
+                    counter = self.counters.setdefault(rule_comment(rule.kind, pid), [0, 0])
+                    counter[0] += 1
+                    counter[1] += size
+                    return rule.target, n * self.rule_cost_ns
+            self.rules_evaluated += len(self.rules)
+            return 'ACCEPT', len(self.rules) * self.rule_cost_ns
+
+    def sync_set(self, name, networks, family=4):
+        name = f"{name}-v{family}"
+        with self.lock:
+            added, removed, wanted = set_diff(self.sets.get(name, set()), networks)
+            if added or removed:
+                self.sets[name] = wanted
+                self._commit()
+            else:
+                self.noops += 1
+        return len(added), len(removed)
+
+    def read_counters(self):
+        with self.lock:
+            return {comment: tuple(counter) for comment, counter in self.counters.items()}
+
+    def cleanup(self):
+        with self.lock:
+            self.rules = []
+            self.sets = {}
+            self.counters = {}
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'rules': len(self.rules),
+            'set_entries': sum(len(members) for members in self.sets.values()),
+            'ops': self.ops,
+            'noops': self.noops,
+            'kernel_time': self.kernel_time,
+            'packets_evaluated': self.packets_evaluated,
+            'rules_evaluated': self.rules_evaluated,
+            'per_packet_cost_ns': len(self.rules) * self.rule_cost_ns,
+        }
+
+
+BACKENDS = {
+    'iptables': IptablesBackend,
+    'simulated': SimulatedBackend,
+}
+
+
+# Pick the backend from WATERWALL_BACKEND, defaulting to iptables
+def create_backend(name=None):
+    name = name or os.environ.get('WATERWALL_BACKEND', 'iptables')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown firewall backend: {name}")
+    return BACKENDS[name]()
+
+
+# Drive a backend with a block/repeated block/unblock mix and report control plane throughput
+def bench_control_plane(backend, operations=10000, pids=1000):
+    start = time.perf_counter()
+    for i in range(operations):
+        pid = i % pids
+        op = i % 3
+        if op == 0:
+            backend.block(pid)
+        elif op == 1:
+            backend.block(pid)  # already blocked, a no-op the backend must notice cheaply
+        else:
+            backend.unblock(pid)
+    elapsed = time.perf_counter() - start
+    kernel_time = getattr(backend, 'kernel_time', 0.0)
+    return {
+        'operations': operations,
+        'elapsed': elapsed,
+        'ops_per_second': operations / elapsed if elapsed else 0,
+        'api_time': elapsed - kernel_time,
+        'kernel_time': kernel_time,
+    }
+
+
+if __name__ == '__main__':
+    import sys
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print(bench_control_plane(SimulatedBackend(), operations))
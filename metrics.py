@@ -0,0 +1,115 @@
+import heapq
+import math
+import threading
+
+DEFAULT_TOP = 20  # process groups exported by name, the rest are summed into OTHER
+OTHER = 'other'
+MAX_LABELS = 4096  # escaped label strings remembered between generations
+
+# Per process group: (metric, type, help, snapshot column summed over the group's processes). The byte and drop
+# sums fall when a process exits or changes group, so they are gauges rather than counters.
+GROUP_METRICS = (
+    ('waterwall_group_processes', 'gauge', "Running processes in the group", None),
+    ('waterwall_group_read_bytes_per_second', 'gauge', "Disk bytes read per second (I/O counters)", 'rx_rate'),
+    ('waterwall_group_write_bytes_per_second', 'gauge', "Disk bytes written per second (I/O counters)", 'tx_rate'),
+    ('waterwall_group_read_bytes', 'gauge', "Bytes read from storage by the group's running processes", 'rx_bytes'),
+    ('waterwall_group_write_bytes', 'gauge', "Bytes written to storage by the group's running processes", 'tx_bytes'),
+    ('waterwall_group_dropped_packets', 'gauge', "Packets dropped by block rules", 'dropped_packets'),
+    ('waterwall_group_dropped_bytes', 'gauge', "Bytes dropped by block rules", 'dropped_bytes'),
+    ('waterwall_group_limit_dropped_packets', 'gauge', "Packets dropped by bandwidth limits", 'limited_dropped'),
+)
+RANK_COLUMNS = ('rx_rate', 'tx_rate')  # groups are ranked by total I/O rate
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+# One metric family in the text exposition format. `samples` are (label string or '', value).
+def family(name, kind, help_text, samples):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{{{labels}}} {format_value(value)}" if labels else f"{name} {format_value(value)}"
+              for labels, value in samples]
+    return '\n'.join(lines) + '\n'
+
+
+# A summary without quantiles: just the observation count and sum, enough for rate(sum) / rate(count)
+def summary(name, help_text, count, total):
+    return (f"# HELP {name} {help_text}\n# TYPE {name} summary\n"
+            f"{name}_sum {format_value(total)}\n{name}_count {count}\n")
+
+
+# Sum the snapshot columns per executable, or per [name] like ps shows it where the executable isn't
+# readable (kernel threads, other users' processes without root).
+# Returns group -> [process count, one total per GROUP_METRICS column].
+def group_totals(columns):
+    data = [columns[column] for _, _, _, column in GROUP_METRICS if column]
+    names, exes = columns['name'], columns['exe']
+    groups = {}
+    for i in range(len(columns['pid'])):
+        group = exes[i] or f"[{names[i] or 'unknown'}]"
+        totals = groups.get(group)
+        if totals is None:
+            totals = groups[group] = [0] * (len(data) + 1)
+        totals[0] += 1
+        for j, column in enumerate(data, 1):
+            totals[j] += column[i] or 0
+    return groups
+
+
+# Keep the `top` busiest groups and fold the rest into one OTHER group, so a fork-happy host can't
+# blow up the series count. Returns [(group, totals)], busiest first, OTHER last.
+def top_groups(groups, top):
+    rank = [index for index, (_, _, _, column) in enumerate(GROUP_METRICS) if column in RANK_COLUMNS]
+    kept = heapq.nlargest(top, groups.items(), key=lambda item: (sum(item[1][i] for i in rank), item[0]))
+    if len(kept) == len(groups):
+        return kept
+    names = {group for group, _ in kept}
+    other = [0] * len(GROUP_METRICS)
+    for group, totals in groups.items():
+        if group not in names:
+            for i, value in enumerate(totals):
+                other[i] += value
+    return kept + [(OTHER, other)]
+
+
+# Renders the per-group part of /metrics once per snapshot generation; every scrape in between
+# reuses the text, and label strings are escaped once per executable rather than once per scrape.
+class MetricsRenderer:
+    def __init__(self, top=DEFAULT_TOP):
+        self.top = top
+        self.lock = threading.Lock()
+        self.cached = (None, '')  # (generation, text)
+        self.labels = {}  # group -> 'exe="..."'
+        self.renders = 0
+        self.hits = 0
+
+    def label(self, group):
+        label = self.labels.get(group)
+        if label is None:
+            if len(self.labels) >= MAX_LABELS:
+                self.labels.clear()
+            label = self.labels[group] = f'exe="{escape_label(group)}"'
+        return label
+
+    def groups(self, generation, columns):
+        with self.lock:
+            if self.cached[0] == generation:
+                self.hits += 1
+                return self.cached[1]
+            rows = [(self.label(group), totals) for group, totals in top_groups(group_totals(columns), self.top)]
+            text = ''.join(family(name, kind, help_text, [(label, totals[i]) for label, totals in rows])
+                           for i, (name, kind, help_text, _) in enumerate(GROUP_METRICS))
+            self.cached = (generation, text)
+            self.renders += 1
+            return text
@@ -0,0 +1,129 @@
+import base64
+import heapq
+import json
+import re
+
+HISTORY_FIELD = 'historical_data'
+MAX_PAGE = 1000
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        present, value, pid = key
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    return (present, value, pid)
+
+
+# Parse the /processes query string into select_processes() arguments, raising ValueError on bad input
+def parse_query(args):
+    fields = [f.strip() for f in args.get('fields', '').split(',') if f.strip()] or None
+    pattern = args.get('match')
+    if pattern:
+        try:
+            pattern = re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            raise ValueError(f"invalid match pattern: {e}")
+    top = args.get('top')
+    if top is not None:
+        if not top.isdigit() or not 0 < int(top) <= MAX_PAGE:
+            raise ValueError(f"top must be between 1 and {MAX_PAGE}")
+        top = int(top)
+    history = args.get('history')
+    if history in (None, '', '0', 'false', 'no'):
+        history = 0
+    elif history in ('all', 'true', 'yes'):
+        history = None
+    elif history.isdigit():
+        history = int(history)
+    else:
+        raise ValueError("history must be 'all' or a number of points")
+    sort_by = args.get('sort_by', 'traffic_usage')
+    return {
+        'fields': fields,
+        'name': args.get('name', '').lower() or None,
+        'pattern': pattern,
+        'sort_by': 'traffic_usage_mb' if sort_by == 'traffic_usage' else sort_by,
+        'descending': args.get('sort_order', 'desc') == 'desc',
+        'top': top,
+        'cursor': decode_cursor(args['cursor']) if args.get('cursor') else None,
+        'history': history,
+    }
+
+
+# Pick the rows to return, given row count and a value(row, field) accessor.
+# Returns (row indexes, matched, next cursor or None). With `top` only the requested page is
+# selected from the matches with a heap, O(n log top); `cursor` continues after the last row
+# of the previous page.
+def _select_rows(count, value, name=None, pattern=None, sort_by='traffic_usage_mb', descending=True,
+                 top=None, cursor=None):
+    rows = range(count)
+    if name:
+        rows = [i for i in rows if name in (value(i, 'name') or '').lower() or name in (value(i, 'exe') or '').lower()]
+    if pattern:
+        rows = [i for i in rows if pattern.search(value(i, 'name') or '') or pattern.search(value(i, 'exe') or '')]
+    matched = len(rows)
+
+    def sort_key(i):
+        field = value(i, sort_by)
+        return (field is not None, field if field is not None else 0, value(i, 'pid'))
+
+    keyed = ((sort_key(i), i) for i in rows)
+    if cursor is not None:
+        keyed = (item for item in keyed if (item[0] < cursor if descending else item[0] > cursor))
+    try:
+        if top is None:
+            page = sorted(keyed, key=lambda item: item[0], reverse=descending)
+        else:
+            select = heapq.nlargest if descending else heapq.nsmallest
+            page = select(top + 1, keyed, key=lambda item: item[0])  # one extra row tells us there's more
+    except TypeError:
+        raise ValueError(f"cannot sort by {sort_by}")
+    next_cursor = None
+    if top is not None and len(page) > top:
+        page = page[:top]
+        next_cursor = encode_cursor(page[-1][0])
+    return [i for _, i in page], matched, next_cursor
+
+
+# Filter, order and project process records. Returns (rows, matched, next cursor or None).
+def select_processes(records, fields=None, history=None, **selection):
+    indexes, matched, next_cursor = _select_rows(len(records), lambda i, field: records[i].get(field), **selection)
+    rows = []
+    for i in indexes:
+        record = records[i]
+        if fields:
+            record = {field: record[field] for field in fields if field in record}
+        elif history == 0:
+            record = {field: value for field, value in record.items() if field != HISTORY_FIELD}
+        if history and HISTORY_FIELD in record:
+            record = {**record, HISTORY_FIELD: record[HISTORY_FIELD][-history:]}
+        rows.append(record)
+    return rows, matched, next_cursor
+
+
+# Same selection over field -> column storage (all columns the same length, one row per process).
+# Returns ({'index': [pids], 'columns': {field: [values]}}, matched, next cursor or None).
+def select_columns(columns, fields=None, history=None, **selection):
+    count = len(columns['pid'])
+    indexes, matched, next_cursor = _select_rows(
+        count, lambda i, field: columns[field][i] if field in columns else None, **selection)
+    names = fields or [field for field in columns if field != 'pid' and (history != 0 or field != HISTORY_FIELD)]
+    result = {}
+    for field in names:
+        if field not in columns:
+            continue
+        column = columns[field]
+        if field == HISTORY_FIELD and history:
+            result[field] = [list(column[i])[-history:] for i in indexes]
+        elif field == HISTORY_FIELD:
+            result[field] = [list(column[i]) for i in indexes]
+        else:
+            result[field] = [column[i] for i in indexes]
+    pids = columns['pid']
+    return {'index': [pids[i] for i in indexes], 'columns': result}, matched, next_cursor
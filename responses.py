@@ -0,0 +1,63 @@
+import gzip
+import threading
+from collections import OrderedDict
+
+MIN_COMPRESS_SIZE = 512  # bodies smaller than this aren't worth a gzip header
+
+
+# One serialized response: the identity body, its gzip copy (made on first demand) and extra headers
+class CachedBody:
+    def __init__(self, body, headers=None):
+        self.body = body
+        self.headers = headers or {}
+        self.compressed = None
+
+    def encoded(self, accept_gzip):
+        if not accept_gzip or len(self.body) < MIN_COMPRESS_SIZE:
+            return self.body, None
+        if self.compressed is None:
+            self.compressed = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self.compressed, 'gzip'
+
+
+# Small LRU of serialized responses keyed by (snapshot generation, view parameters)
+class ResponseCache:
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, headers=None):
+        entry = CachedBody(body, headers)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self.lock:
+            identity = sum(len(entry.body) for entry in self.entries.values())
+            compressed = [entry for entry in self.entries.values() if entry.compressed is not None]
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes': identity,
+                'compressed_bytes': sum(len(entry.compressed) for entry in compressed),
+                'compression_ratio': (sum(len(entry.body) for entry in compressed) /
+                                      sum(len(entry.compressed) for entry in compressed)) if compressed else None,
+            }
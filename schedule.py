@@ -0,0 +1,205 @@
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+# Hierarchical timer wheel: O(1) insert and O(1) work per tick no matter how many timers are pending
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=(60, 60, 24, 8), now=None):
+        self.tick = tick
+        self.slots = slots
+        self.spans = [1]
+        for n in slots:
+            self.spans.append(self.spans[-1] * n)  # ticks covered by one full turn of each level
+        self.levels = [[[] for _ in range(n)] for n in slots]
+        self.overflow = []  # timers further out than the whole wheel
+        self.current = int((time.time() if now is None else now) / tick)
+        self.size = 0
+
+    def _place(self, expires, item):
+        delta = expires - self.current
+        for level, n in enumerate(self.slots):
+            if delta < self.spans[level + 1]:
+                self.levels[level][(expires // self.spans[level]) % n].append((expires, item))
+                return
+        self.overflow.append((expires, item))
+
+    def add(self, deadline, item):
+        expires = max(int(-(-deadline // self.tick)), self.current + 1)
+        self._place(expires, item)
+        self.size += 1
+
+    def _cascade(self):
+        for level in range(len(self.slots) - 1, 0, -1):
+            if self.current % self.spans[level] == 0:
+                slot = self.levels[level][(self.current // self.spans[level]) % self.slots[level]]
+                self.levels[level][(self.current // self.spans[level]) % self.slots[level]] = []
+                for expires, item in slot:
+                    self._place(expires, item)
+        if self.current % self.spans[-1] == 0 and self.overflow:
+            overflow, self.overflow = self.overflow, []
+            for expires, item in overflow:
+                self._place(expires, item)
+
+    # Move the wheel up to `now`, returning [(deadline, [items])] in firing order
+    def advance(self, now):
+        target = int(now / self.tick)
+        fired = []
+        if not self.size:
+            self.current = max(self.current, target)
+            return fired
+        while self.current < target:
+            self.current += 1
+            self._cascade()
+            level0 = self.levels[0]
+            index = self.current % self.slots[0]
+            if level0[index]:
+                due = [item for expires, item in level0[index] if expires <= self.current]
+                level0[index] = [(e, item) for e, item in level0[index] if e > self.current]
+                if due:
+                    self.size -= len(due)
+                    fired.append((self.current * self.tick, due))
+        return fired
+
+
+def _parse_clock(value):
+    hours, minutes = value.split(':')
+    return datetime.time(int(hours), int(minutes))
+
+
+def _rule_days(rule):
+    days = rule.get('days') or DAY_NAMES
+    return {DAY_NAMES.index(day[:3].lower()) if isinstance(day, str) else int(day) for day in days}
+
+
+# Check a rule definition and fill in defaults, raising ValueError on bad input
+def normalize_rule(rule):
+    if not isinstance(rule, dict):
+        raise ValueError("a scheduled rule must be a JSON object")
+    if rule.get('action') not in ('block', 'limit'):
+        raise ValueError("action must be 'block' or 'limit'")
+    if not rule.get('pid') and not rule.get('name'):
+        raise ValueError("a scheduled rule needs a pid or a process name")
+    if rule.get('pid') and not (isinstance(rule['pid'], int) or str(rule['pid']).isdigit()):
+        raise ValueError("pid must be an integer")
+    if rule.get('name') and not isinstance(rule['name'], str):
+        raise ValueError("name must be a string")
+    if rule['action'] == 'limit' and not (isinstance(rule.get('percentage'), (int, float))
+                                          and 0 < rule['percentage'] <= 100):
+        raise ValueError("limit rules need a percentage between 0 and 100")
+    try:
+        _parse_clock(rule.get('start', '00:00'))
+        _parse_clock(rule.get('end', '00:00'))
+        if not _rule_days(rule) <= set(range(7)):
+            raise ValueError(rule['days'])
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError("start and end must be HH:MM and days a list of day names or numbers 0-6")
+    return {'id': rule.get('id') or uuid.uuid4().hex[:8], 'start': '00:00', 'end': '00:00', **rule}
+
+
+# Yield (start, end) windows of a rule starting from the day before `now`
+def _windows(rule, now):
+    start, end = _parse_clock(rule['start']), _parse_clock(rule['end'])
+    days = _rule_days(rule)
+    today = datetime.datetime.fromtimestamp(now).date()
+    for offset in range(-1, 9):
+        day = today + datetime.timedelta(days=offset)
+        if day.weekday() not in days:
+            continue
+        window_start = datetime.datetime.combine(day, start)
+        window_end = datetime.datetime.combine(day, end)
+        if window_end <= window_start:  # overnight, or 00:00-00:00 for all day
+            window_end += datetime.timedelta(days=1)
+        yield window_start.timestamp(), window_end.timestamp()
+
+
+def is_active(rule, now):
+    return any(start <= now < end for start, end in _windows(rule, now))
+
+
+# Next moment the rule switches on or off after `now`, as (timestamp, active_after)
+def next_transition(rule, now):
+    active = is_active(rule, now)
+    candidates = []
+    for start, end in _windows(rule, now):
+        if active and end > now and not is_active(rule, end):
+            candidates.append(end)
+        elif not active and start > now:
+            candidates.append(start)
+    if not candidates:
+        return None
+    return min(candidates), not active
+
+
+# Fires rule transitions from a timer wheel and hands each instant's changes over as one batch
+class RuleScheduler:
+    def __init__(self, apply_batch, tick=1.0):
+        self.apply_batch = apply_batch  # called with [(rule, active)] for one instant
+        self.wheel = TimerWheel(tick)
+        self.rules = {}
+        self.generation = {}  # rule id -> generation, stale wheel entries are ignored
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def _schedule(self, rule, now):
+        transition = next_transition(rule, now)
+        if transition:
+            self.wheel.add(transition[0], (rule['id'], self.generation[rule['id']], transition[1]))
+
+    # Replace the rule set, applying the current on/off state of every rule straight away
+    def set_rules(self, rules):
+        now = time.time()
+        with self.lock:
+            old = self.rules
+            self.rules = {rule['id']: rule for rule in rules}
+            changes = [(rule, False) for rule_id, rule in old.items() if rule_id not in self.rules]
+            for rule in self.rules.values():
+                self.generation[rule['id']] = self.generation.get(rule['id'], 0) + 1
+                changes.append((rule, is_active(rule, now)))
+                self._schedule(rule, now)
+            for rule_id in old:
+                if rule_id not in self.rules:
+                    self.generation[rule_id] = self.generation.get(rule_id, 0) + 1
+        if changes:
+            self.apply_batch(changes)
+
+    def tick(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            fired = self.wheel.advance(now)
+            batches = []
+            for when, items in fired:
+                changes = []
+                for rule_id, generation, active in items:
+                    rule = self.rules.get(rule_id)
+                    if rule is None or self.generation.get(rule_id) != generation:
+                        continue
+                    changes.append((rule, active))
+                    self._schedule(rule, when)
+                if changes:
+                    batches.append(changes)
+        for changes in batches:
+            logger.info(f"Applying {len(changes)} scheduled rule transitions")
+            self.apply_batch(changes)
+
+    def _run(self):
+        while not self.stop_event.wait(self.wheel.tick):
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("Scheduled rule transition failed")
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,740 @@
+import os
+import logging
+import re
+import shlex
+import subprocess
+import threading
+import time
+from firewall import RULE_TAG
+
+logger = logging.getLogger(__name__)
+
+ROOT_HANDLE = 1
+DEFAULT_MINOR = 0xFFFF  # unclassified traffic
+MARK_BASE = 0x5700  # fwmark = MARK_BASE + class minor
+UNLIMITED_RATE = 10 * 1000 * 1000 * 1000 // 8  # bytes/s used for the root and default classes
+NET_CLS_ROOT = '/sys/fs/cgroup/net_cls'
+CGROUP2_ROOT = '/sys/fs/cgroup'
+IFB_DEVICE = 'ifb-waterwall'  # ingress traffic is redirected here so HTB can shape it
+PRIO_HANDLE = 10  # qdisc under the default class that separates latency-sensitive traffic
+# priority -> (DSCP class steering CAKE's diffserv3 tins, band of the prio+fq_codel fallback)
+PRIORITIES = {
+    'interactive': ('EF', 1),
+    'normal': (None, 2),
+    'bulk': ('CS1', 3),
+}
+
+
+# Interface of the bandwidth shapers; rates are in bytes per second. The sampler and request threads
+# both change classes, so implementations hold `self.lock` (an RLock) in every public method.
+class Shaper:
+    name = 'base'
+
+    # Create or update the class for a process group and make sure its pids are in it;
+    # ceil defaults to rate for a hard limit, a higher ceil lets the class borrow idle capacity
+    def set_limit(self, group, pids, rate, ceil=None, burst=None):
+        raise NotImplementedError
+
+    # Cap the whole tree at `rate` and guarantee unclassified traffic `default_rate`
+    def set_link_rate(self, rate, default_rate):
+        pass
+
+    # Reclassify many groups at once: {group: (pids, priority)}
+    def set_priorities(self, changes):
+        pass
+
+    def remove(self, group):
+        raise NotImplementedError
+
+    # Per-group {'bytes', 'packets', 'dropped'} in one readout
+    def read_counters(self):
+        return {}
+
+    # Per-group bytes/s in this direction over every interface, including ones this shaper doesn't see
+    def read_observed(self, now):
+        return {}
+
+    def cleanup(self):
+        with self.lock:
+            for group in list(self.classes):
+                self.remove(group)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'shaper': self.name,
+                'classes': {group: c['rate'] for group, c in self.classes.items()},
+                'priorities': {group: p if isinstance(p, str) else p[0] for group, p in self.priorities.items()},
+            }
+
+
+# Interface carrying the default route, which is where egress shaping belongs
+def default_interface():
+    try:
+        with open('/proc/net/route', 'r') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[1] == '00000000':
+                    return fields[0]
+    except OSError:
+        pass
+    return 'eth0'
+
+
+def tc_rate(rate):
+    return f"{max(int(rate * 8), 8)}bit"
+
+
+# Puts process groups into cgroups and gives each group a class number and fwmark.
+# Shared by the egress and ingress shapers, since a process can only sit in one cgroup.
+class CgroupClassifier:
+    def __init__(self):
+        self.mode = 'net_cls' if os.path.isdir(NET_CLS_ROOT) else 'mark'
+        self.groups = {}  # group -> {'minor', 'pids', 'users', 'origins'}
+        self.connmark_ready = False
+        self.lock = threading.RLock()  # shared by both shapers, on the sampler and request threads
+
+    def _cgroup_dir(self, group):
+        group = re.sub(r'[^\w.-]', '_', group)  # process names can contain anything
+        if self.mode == 'net_cls':
+            return os.path.join(NET_CLS_ROOT, f"{RULE_TAG}-{group}")
+        return os.path.join(CGROUP2_ROOT, RULE_TAG, group)
+
+    # iptables match for packets sent by processes in the group's cgroup
+    def cgroup_match(self, group, minor):
+        if self.mode == 'net_cls':
+            return ["OUTPUT", "-m", "cgroup", "--cgroup", str((ROOT_HANDLE << 16) | minor)]
+        return ["OUTPUT", "-m", "cgroup", "--path", os.path.relpath(self._cgroup_dir(group), CGROUP2_ROOT)]
+
+    def _mark_rule(self, group, minor):
+        return self.cgroup_match(group, minor) + ["-m", "comment", "--comment", f"{RULE_TAG}:shape:{group}",
+                                                  "-j", "MARK", "--set-mark", str(MARK_BASE + minor)]
+
+    # Counts replies to the group's connections on every interface, shaped or not
+    def _count_rule(self, group, minor):
+        return ["INPUT", "-m", "connmark", "--mark", str(MARK_BASE + minor),
+                "-m", "comment", "--comment", f"{RULE_TAG}:shape-in:{group}"]
+
+    # Bytes each group sent (egress, counted by its mark rule) or received (ingress) on any interface,
+    # from one dump of the mangle table
+    def read_bytes(self, direction):
+        with self.lock:
+            if not self.groups:
+                return {}
+            prefix = f"{RULE_TAG}:shape:" if direction == 'egress' else f"{RULE_TAG}:shape-in:"
+            result = subprocess.run(["iptables-save", "-c", "-t", "mangle"], capture_output=True, text=True)
+            counters = {}
+            for line in result.stdout.splitlines():
+                if not line.startswith("[") or prefix not in line:
+                    continue
+                counts, _, rule = line[1:].partition("]")
+                args = shlex.split(rule)
+                if "--comment" in args:
+                    comment = args[args.index("--comment") + 1]
+                    if comment.startswith(prefix):
+                        counters[comment[len(prefix):]] = int(counts.partition(":")[2])
+            return counters
+
+    # Saving the mark on the connection lets replies be classified on ingress
+    def _ensure_connmark(self):
+        if self.connmark_ready:
+            return
+        rule = ["OUTPUT", "-m", "mark", "!", "--mark", "0", "-m", "comment", "--comment", f"{RULE_TAG}:connmark",
+                "-j", "CONNMARK", "--save-mark"]
+        if subprocess.run(["iptables", "-t", "mangle", "-C"] + rule, capture_output=True).returncode != 0:
+            subprocess.run(["iptables", "-t", "mangle", "-A"] + rule, capture_output=True)
+        self.connmark_ready = True
+
+    def _move(self, path, pids):
+        moved = True
+        for pid in pids:
+            try:
+                with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                    f.write(str(pid))
+            except OSError as e:
+                logger.warning(f"Could not move PID {pid} into {path}: {e}")
+                moved = False
+        return moved
+
+    def _root(self):
+        return NET_CLS_ROOT if self.mode == 'net_cls' else CGROUP2_ROOT
+
+    # The cgroup a process sits in before we take it, so release() can put it back in its systemd slice
+    # or scope; None when it can't be read or is one of ours
+    def _origin(self, pid):
+        try:
+            with open(f'/proc/{pid}/cgroup', 'r') as f:
+                for line in f:
+                    _, controllers, path = line.rstrip('\n').split(':', 2)
+                    if (self.mode == 'net_cls' and 'net_cls' in controllers.split(',')) or \
+                            (self.mode != 'net_cls' and controllers == ''):
+                        if f"/{RULE_TAG}" in path:
+                            return None
+                        return os.path.join(self._root(), path.lstrip('/'))
+        except (OSError, ValueError):
+            pass
+        return None
+
+    # group -> pids, copied so callers can look without holding the lock
+    def members(self):
+        with self.lock:
+            return {group: set(entry['pids']) for group, entry in self.groups.items()}
+
+    # Return the class minor of a group, creating its cgroup and mark on first use
+    def acquire(self, group, pids, user):
+        with self.lock:
+            entry = self.groups.get(group)
+            if entry is None:
+                used = {e['minor'] for e in self.groups.values()}
+                minor = 2
+                while minor in used:
+                    minor += 1
+                path = self._cgroup_dir(group)
+                os.makedirs(path, exist_ok=True)
+                if self.mode == 'net_cls':
+                    with open(os.path.join(path, 'net_cls.classid'), 'w') as f:
+                        f.write(str((ROOT_HANDLE << 16) | minor))
+                self._ensure_connmark()
+                subprocess.run(["iptables", "-t", "mangle", "-I", "OUTPUT", "1"] + self._mark_rule(group, minor)[1:],
+                               capture_output=True)
+                subprocess.run(["iptables", "-t", "mangle", "-A"] + self._count_rule(group, minor), capture_output=True)
+                entry = self.groups[group] = {'minor': minor, 'pids': set(), 'users': set(), 'origins': {}}
+            entry['users'].add(user)
+            new_pids = set(pids) - entry['pids']
+            for pid in new_pids:
+                entry['origins'][int(pid)] = self._origin(pid)
+            self._move(self._cgroup_dir(group), new_pids)
+            entry['pids'] |= new_pids
+            return entry['minor']
+
+    def release(self, group, user):
+        with self.lock:
+            entry = self.groups.get(group)
+            if entry is None:
+                return
+            entry['users'].discard(user)
+            if entry['users']:
+                return
+            del self.groups[group]
+            path = self._cgroup_dir(group)
+            origins = [origin for origin in entry['origins'].values() if origin]
+            try:
+                with open(os.path.join(path, 'cgroup.procs'), 'r') as f:
+                    members = [int(pid) for pid in f.read().split()]
+                for pid in members:
+                    # children forked inside our cgroup go back with the processes we moved in
+                    origin = entry['origins'].get(pid) or (origins[0] if origins else None)
+                    if origin is None or not self._move(origin, [pid]):
+                        self._move(self._root(), [pid])  # the slice or scope is gone
+                os.rmdir(path)
+            except OSError as e:
+                logger.warning(f"Could not remove cgroup {path}: {e}")
+            subprocess.run(["iptables", "-t", "mangle", "-D"] + self._mark_rule(group, entry['minor']),
+                           capture_output=True)
+            subprocess.run(["iptables", "-t", "mangle", "-D"] + self._count_rule(group, entry['minor']),
+                           capture_output=True)
+
+
+classifier = None
+
+
+def shared_classifier():
+    global classifier
+    if classifier is None:
+        classifier = CgroupClassifier()
+    return classifier
+
+
+# HTB with one class per limited process group, classified by cgroup. Egress shapes the
+# uplink interface directly; ingress redirects the interface's incoming traffic to an IFB
+# device, restoring the connmark on the way so replies land in their process's class.
+class TcShaper(Shaper):
+    name = 'tc'
+
+    def __init__(self, iface=None, direction='egress', ifb=IFB_DEVICE):
+        self.uplink = iface or default_interface()
+        self.direction = direction
+        self.iface = ifb if direction == 'ingress' else self.uplink  # where the HTB tree lives
+        self.classifier = shared_classifier()
+        self.classes = {}  # group -> {'minor', 'rate', 'ceil', 'burst'}
+        self.priorities = {}  # group -> (priority, installed mangle rule)
+        self.priority_mode = None  # 'cake' or 'prio', settled when the tree is built
+        self.link_rate = UNLIMITED_RATE
+        self.observed = {}  # group -> (timestamp, bytes on any interface) from the previous readout
+        self.ready = False
+        self.lock = threading.RLock()
+
+    def _tc(self, args):
+        result = subprocess.run(["tc"] + args, capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.error(f"tc {' '.join(args)} failed: {result.stderr.strip()}")
+        return result
+
+    def _setup_ifb(self):
+        subprocess.run(["ip", "link", "add", self.iface, "type", "ifb"], capture_output=True)
+        subprocess.run(["ip", "link", "set", "dev", self.iface, "up"], capture_output=True)
+        self._tc(["qdisc", "replace", "dev", self.uplink, "handle", "ffff:", "ingress"])
+        self._tc(["filter", "replace", "dev", self.uplink, "parent", "ffff:", "protocol", "all", "prio", "10",
+                  "u32", "match", "u32", "0", "0", "action", "connmark",
+                  "action", "mirred", "egress", "redirect", "dev", self.iface])
+
+    def _setup(self):
+        if self.ready:
+            return
+        if self.direction == 'ingress':
+            self._setup_ifb()
+        self._tc(["qdisc", "replace", "dev", self.iface, "root", "handle", f"{ROOT_HANDLE}:",
+                  "htb", "default", f"{DEFAULT_MINOR:x}"])
+        self._tc(["class", "replace", "dev", self.iface, "parent", f"{ROOT_HANDLE}:", "classid",
+                  f"{ROOT_HANDLE}:1", "htb", "rate", tc_rate(UNLIMITED_RATE)])
+        self._tc(["class", "replace", "dev", self.iface, "parent", f"{ROOT_HANDLE}:1", "classid",
+                  f"{ROOT_HANDLE}:{DEFAULT_MINOR:x}", "htb", "rate", tc_rate(UNLIMITED_RATE)])
+        if self.direction == 'egress' and self.classifier.mode == 'net_cls':
+            # A single cgroup filter maps every net_cls.classid straight onto its class
+            self._tc(["filter", "replace", "dev", self.iface, "parent", f"{ROOT_HANDLE}:", "protocol", "all",
+                      "prio", "10", "handle", "1:", "cgroup"])
+        if self.direction == 'egress':
+            self._setup_priority_qdisc()
+        self.ready = True
+
+    # CAKE's diffserv3 tins under the default class, or prio bands with fq_codel where CAKE is missing
+    def _setup_priority_qdisc(self):
+        parent = ["dev", self.iface, "parent", f"{ROOT_HANDLE}:{DEFAULT_MINOR:x}", "handle", f"{PRIO_HANDLE}:"]
+        result = subprocess.run(["tc", "qdisc", "replace"] + parent + ["cake", "unlimited", "diffserv3"],
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            self.priority_mode = 'cake'
+            return
+        self.priority_mode = 'prio'
+        self._tc(["qdisc", "replace"] + parent + ["prio", "bands", "3", "priomap"] + ["1"] * 16)
+        for band in range(1, 4):
+            self._tc(["qdisc", "replace", "dev", self.iface, "parent", f"{PRIO_HANDLE}:{band}",
+                      "handle", f"{PRIO_HANDLE + band}:", "fq_codel"])
+
+    def _priority_rule(self, group, minor, priority):
+        dscp, band = PRIORITIES[priority]
+        if self.priority_mode == 'cake':
+            target = ["-j", "DSCP", "--set-dscp-class", dscp]
+        else:
+            target = ["-j", "CLASSIFY", "--set-class", f"{PRIO_HANDLE}:{band}"]
+        return (self.classifier.cgroup_match(group, minor) +
+                ["-m", "comment", "--comment", f"{RULE_TAG}:prio:{group}"] + target)
+
+    def set_priorities(self, changes):
+        with self.lock:
+            self._setup()
+            lines = []
+            released = []
+            for group, (pids, priority) in changes.items():
+                group = str(group)
+                installed = self.priorities.pop(group, None)
+                if installed:
+                    lines.append(["-D"] + installed[1])
+                if priority == 'normal':
+                    if installed:
+                        released.append(group)
+                    continue
+                minor = self.classifier.acquire(group, pids, 'priority')
+                rule = self._priority_rule(group, minor, priority)
+                lines.append(["-A"] + rule)
+                self.priorities[group] = (priority, rule)
+            if lines:
+                # One iptables-restore for the whole batch instead of a fork per process
+                script = "*mangle\n" + "".join(shlex.join(line) + "\n" for line in lines) + "COMMIT\n"
+                result = subprocess.run(["iptables-restore", "--noflush"], input=script, capture_output=True, text=True)
+                if result.returncode != 0:
+                    logger.error(f"Priority reclassification failed: {result.stderr.strip()}")
+            for group in released:
+                self.classifier.release(group, 'priority')
+
+    def _uses_marks(self):
+        return self.direction == 'ingress' or self.classifier.mode == 'mark'
+
+    def _htb_args(self, rate, ceil, burst):
+        args = ["htb", "rate", tc_rate(rate), "ceil", tc_rate(ceil)]
+        if burst:
+            args += ["burst", f"{int(burst)}b", "cburst", f"{int(burst)}b"]
+        return args
+
+    def set_limit(self, group, pids, rate, ceil=None, burst=None):
+        with self.lock:
+            self._setup()
+            group = str(group)
+            ceil = ceil or rate
+            minor = self.classifier.acquire(group, pids, self.direction)
+            shaped = self.classes.get(group)
+            if shaped is None:
+                self._tc(["class", "add", "dev", self.iface, "parent", f"{ROOT_HANDLE}:1", "classid",
+                          f"{ROOT_HANDLE}:{minor:x}"] + self._htb_args(rate, ceil, burst))
+                self._tc(["qdisc", "replace", "dev", self.iface, "parent", f"{ROOT_HANDLE}:{minor:x}", "fq_codel"])
+                if self._uses_marks():
+                    self._tc(["filter", "add", "dev", self.iface, "parent", f"{ROOT_HANDLE}:", "protocol", "all",
+                              "prio", "1", "handle", str(MARK_BASE + minor), "fw",
+                              "classid", f"{ROOT_HANDLE}:{minor:x}"])
+                self.classes[group] = {'minor': minor, 'rate': rate, 'ceil': ceil, 'burst': burst}
+            elif (shaped['rate'], shaped['ceil'], shaped['burst']) != (rate, ceil, burst):
+                self._tc(["class", "change", "dev", self.iface, "parent", f"{ROOT_HANDLE}:1", "classid",
+                          f"{ROOT_HANDLE}:{minor:x}"] + self._htb_args(rate, ceil, burst))
+                shaped['rate'], shaped['ceil'], shaped['burst'] = rate, ceil, burst
+
+    def set_link_rate(self, rate, default_rate):
+        with self.lock:
+            self._setup()
+            self._tc(["class", "change", "dev", self.iface, "parent", f"{ROOT_HANDLE}:", "classid",
+                      f"{ROOT_HANDLE}:1", "htb", "rate", tc_rate(rate)])
+            self._tc(["class", "change", "dev", self.iface, "parent", f"{ROOT_HANDLE}:1", "classid",
+                      f"{ROOT_HANDLE}:{DEFAULT_MINOR:x}", "htb", "rate", tc_rate(default_rate), "ceil", tc_rate(rate)])
+            self.link_rate = rate
+
+    def remove(self, group):
+        with self.lock:
+            group = str(group)
+            shaped = self.classes.pop(group, None)
+            if shaped is None:
+                return
+            if self._uses_marks():
+                self._tc(["filter", "del", "dev", self.iface, "parent", f"{ROOT_HANDLE}:", "protocol", "all",
+                          "prio", "1", "handle", str(MARK_BASE + shaped['minor']), "fw"])
+            self._tc(["class", "del", "dev", self.iface, "classid", f"{ROOT_HANDLE}:{shaped['minor']:x}"])
+            self.classifier.release(group, self.direction)
+
+    def read_counters(self):
+        with self.lock:
+            if not self.classes:
+                return {}
+            result = subprocess.run(["tc", "-s", "class", "show", "dev", self.iface], capture_output=True, text=True)
+            by_minor = {}
+            for block in result.stdout.split("class htb ")[1:]:
+                classid = block.split()[0]
+                sent = re.search(r"Sent (\d+) bytes (\d+) pkt \(dropped (\d+)", block)
+                if sent and ':' in classid:
+                    by_minor[int(classid.split(':')[1], 16)] = {
+                        'bytes': int(sent.group(1)), 'packets': int(sent.group(2)), 'dropped': int(sent.group(3))}
+            return {group: by_minor[c['minor']] for group, c in self.classes.items() if c['minor'] in by_minor}
+
+    def read_observed(self, now):
+        with self.lock:
+            rates, observed = {}, {}
+            if not self.classes:
+                self.observed = observed
+                return rates
+            for group, count in self.classifier.read_bytes(self.direction).items():
+                if group not in self.classes:
+                    continue
+                last = self.observed.get(group)
+                if last and now > last[0] and count >= last[1]:
+                    rates[group] = (count - last[1]) / (now - last[0])
+                observed[group] = (now, count)
+            self.observed = observed
+            return rates
+
+    def cleanup(self):
+        with self.lock:
+            super().cleanup()
+            if self.priorities:
+                self.set_priorities({group: ([], 'normal') for group in self.priorities})
+            if self.ready:
+                self._tc(["qdisc", "del", "dev", self.iface, "root"])
+                if self.direction == 'ingress':
+                    self._tc(["qdisc", "del", "dev", self.uplink, "ingress"])
+                    subprocess.run(["ip", "link", "del", self.iface], capture_output=True)
+                self.ready = False
+
+
+# In-memory shaper for running without root; counts class operations instead of running tc
+class SimulatedShaper(Shaper):
+    name = 'simulated'
+
+    def __init__(self):
+        self.classes = {}
+        self.priorities = {}
+        self.link_rate = UNLIMITED_RATE
+        self.default_rate = UNLIMITED_RATE
+        self.ops = 0
+        self.lock = threading.RLock()
+
+    def set_limit(self, group, pids, rate, ceil=None, burst=None):
+        with self.lock:
+            group = str(group)
+            ceil = ceil or rate
+            shaped = self.classes.setdefault(group, {'rate': None, 'ceil': None, 'burst': None, 'pids': set()})
+            if (shaped['rate'], shaped['ceil'], shaped['burst']) != (rate, ceil, burst):
+                shaped['rate'], shaped['ceil'], shaped['burst'] = rate, ceil, burst
+                self.ops += 1
+            shaped['pids'] |= set(pids)
+
+    def set_link_rate(self, rate, default_rate):
+        with self.lock:
+            if (self.link_rate, self.default_rate) != (rate, default_rate):
+                self.link_rate, self.default_rate = rate, default_rate
+                self.ops += 1
+
+    def set_priorities(self, changes):
+        with self.lock:
+            for group, (pids, priority) in changes.items():
+                if priority == 'normal':
+                    self.priorities.pop(str(group), None)
+                else:
+                    self.priorities[str(group)] = priority
+            self.ops += 1
+
+    def remove(self, group):
+        with self.lock:
+            if self.classes.pop(str(group), None) is not None:
+                self.ops += 1
+
+    def stats(self):
+        return {**super().stats(), 'ops': self.ops}
+
+
+# Weighted max-min fair allocation of capacity across demands (progressive filling)
+def max_min_shares(demands, weights, capacity):
+    shares = {}
+    active = set(demands)
+    remaining = capacity
+    while active:
+        per_weight = remaining / sum(weights[group] for group in active)
+        satisfied = {group for group in active if demands[group] <= per_weight * weights[group]}
+        if not satisfied:
+            for group in active:
+                shares[group] = per_weight * weights[group]
+            break
+        for group in satisfied:
+            shares[group] = demands[group]
+            remaining -= demands[group]
+        active -= satisfied
+    return shares
+
+
+# Periodically re-divides the uplink between the busiest process groups by weighted max-min fairness.
+# Shares become HTB guarantees with ceil at the link rate, so idle capacity is still borrowed. Demand is
+# what each group's own class passed since the last run (its tc byte counter): a group starts with a
+# min_rate guarantee and is re-rated once its class has measured it.
+class FairShareController:
+    def __init__(self, shaper, interval=3, headroom=0.95, hysteresis=0.2, max_groups=32,
+                 min_rate=10 * 1024, idle_runs=5):
+        self.shaper = shaper
+        self.interval = interval  # sampler ticks between runs
+        self.headroom = headroom  # fraction of capacity we let through, so the queue stays with us
+        self.hysteresis = hysteresis  # relative change needed before a class is re-rated
+        self.max_groups = max_groups
+        self.min_rate = min_rate  # bytes/s below which a group isn't worth a class
+        self.idle_runs = idle_runs
+        self.enabled = False
+        self.weights = {}  # group -> priority weight, default 1
+        self.groups = {}  # group -> {'share', 'idle', 'rate', 'last'}
+        self.dormant = {}  # group -> run after which an idle group may get a class again
+        self.ticks = 0
+        self.runs = 0
+        self.last_shares = {}
+        self.lock = threading.RLock()  # configure() comes from request threads, tick() from the sampler
+
+    def configure(self, enabled=None, weights=None):
+        with self.lock:
+            if weights is not None:
+                self.weights = {group: max(float(w), 0.01) for group, w in weights.items()}
+            if enabled is not None:
+                self.enabled = enabled
+                if not enabled:
+                    self.reset()
+
+    def reset(self):
+        with self.lock:
+            for group in self.groups:
+                self.shaper.remove(f"fair-{group}")
+            self.groups = {}
+            self.dormant = {}
+            self.last_shares = {}
+            if self.shaper.link_rate != UNLIMITED_RATE:  # hand the whole link back
+                self.shaper.set_link_rate(UNLIMITED_RATE, UNLIMITED_RATE)
+
+    def _changed(self, old, new):
+        return old is None or abs(new - old) > old * self.hysteresis
+
+    # Count a sampler tick; True when this one re-divides the link, so callers only gather input then
+    def due(self):
+        with self.lock:
+            if not self.enabled:
+                return False
+            self.ticks += 1
+            return self.ticks % self.interval == 0
+
+    # Network rate of every managed group since the last run, from its class's byte counter
+    def _measure(self, counters, now):
+        for group, state in self.groups.items():
+            count = counters.get(f"fair-{group}", {}).get('bytes')
+            last, state['last'] = state['last'], (now, count) if count is not None else None
+            if count is not None and last and now > last[0] and count >= last[1]:
+                state['rate'] = (count - last[1]) / (now - last[0])
+
+    # processes: iterable of (pid, group) for the candidates, i.e. processes with network sockets;
+    # counters: shaper.read_counters(); reserved: bytes/s already promised to hard limits
+    def tick(self, processes, counters, capacity, reserved=0, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if not self.enabled:
+                return
+            self.runs += 1
+            members = {}
+            for pid, group in processes:
+                members.setdefault(group, []).append(pid)
+            self._measure(counters, now)
+            for group in list(self.groups):
+                if group not in members:  # exited or closed its sockets
+                    self.shaper.remove(f"fair-{group}")
+                    del self.groups[group]
+            self.dormant = {group: until for group, until in self.dormant.items() if until > self.runs}
+            candidates = sorted((g for g in members if g not in self.groups and g not in self.dormant),
+                                key=lambda g: (len(members[g]), g), reverse=True)
+            for group in candidates[:max(self.max_groups - len(self.groups), 0)]:
+                self.groups[group] = {'share': None, 'idle': 0, 'rate': None, 'last': None}
+
+            demand = {group: self.min_rate if state['rate'] is None else state['rate']
+                      for group, state in self.groups.items()}
+            link_rate = capacity * self.headroom
+            available = max(link_rate - reserved, link_rate * 0.05)
+            demands = dict(demand)
+            demands[None] = self.min_rate  # everything unclassified shares the default class
+            weights = {group: self.weights.get(group, 1.0) for group in demands}
+            shares = max_min_shares(demands, weights, available)
+
+            # Leftover capacity is handed out by weight so guarantees add up to the link
+            leftover = available - sum(shares.values())
+            if leftover > 0:
+                total_weight = sum(weights.values())
+                for group in shares:
+                    shares[group] += leftover * weights[group] / total_weight
+
+            if self._changed(self.last_shares.get(None), shares[None]) or link_rate != self.shaper.link_rate:
+                self.shaper.set_link_rate(link_rate, shares[None])
+                self.last_shares[None] = shares[None]
+            for group, state in list(self.groups.items()):
+                measured = state['rate'] is not None
+                state['idle'] = state['idle'] + 1 if measured and demand[group] < self.min_rate else 0
+                if state['idle'] >= self.idle_runs:
+                    self.shaper.remove(f"fair-{group}")
+                    del self.groups[group]
+                    self.dormant[group] = self.runs + self.idle_runs
+                    continue
+                if self._changed(state['share'], shares[group]):
+                    state['share'] = shares[group]
+                self.shaper.set_limit(f"fair-{group}", members[group], state['share'], link_rate)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'weights': self.weights,
+                'groups': {group: state['share'] for group, state in self.groups.items()},
+                'measured': {group: state['rate'] for group, state in self.groups.items()},
+            }
+
+
+# Closes the loop on hard limits: compares what each class actually passes with its target
+# every tick, nudges rate/ceil/burst to converge, and flags limits traffic is getting around
+class LimitFeedback:
+    def __init__(self, shaper, gain=0.5, tolerance=0.05, min_factor=0.5, max_factor=1.5,
+                 escape_factor=1.2, escape_ticks=5, min_burst=3000):
+        self.shaper = shaper
+        self.gain = gain  # fraction of the error corrected per tick
+        self.tolerance = tolerance  # relative error we accept as on target
+        self.min_factor = min_factor  # command stays within [min_factor, max_factor] * target
+        self.max_factor = max_factor
+        self.escape_factor = escape_factor  # network traffic this far over target means it's leaking
+        self.escape_ticks = escape_ticks
+        self.min_burst = min_burst
+        self.limits = {}  # group -> control state
+        self.lock = threading.RLock()  # set_target()/remove() come from request threads, tick() from the sampler
+
+    def set_target(self, group, pids, target):
+        with self.lock:
+            group = str(group)
+            limit = self.limits.get(group)
+            if limit is None or limit['target'] != target:
+                limit = self.limits[group] = {
+                    'target': target, 'command': target, 'burst': None, 'measured': None,
+                    'observed': None, 'last': None, 'escaping': 0, 'status': 'pending',
+                }
+            limit['pids'] = list(pids)
+            self.shaper.set_limit(group, pids, limit['command'], burst=limit['burst'])
+
+    def remove(self, group):
+        with self.lock:
+            self.limits.pop(str(group), None)
+            self.shaper.remove(group)
+
+    # group -> target bytes/s, a snapshot callers can iterate while the sampler ticks
+    def targets(self):
+        with self.lock:
+            return {group: limit['target'] for group, limit in self.limits.items()}
+
+    # Drop the limits (and their classes and cgroups) of groups whose processes have all exited
+    def prune(self, alive):
+        with self.lock:
+            for group in [group for group, limit in self.limits.items() if not alive.intersection(limit['pids'])]:
+                self.remove(group)
+
+    # counters: shaper.read_counters(); observed: shaper.read_observed(), the group's network rate over
+    # every interface. Traffic the class doesn't see (another interface, a VPN) marks the limit unenforceable.
+    def tick(self, counters, observed, now):
+        with self.lock:
+            for group, limit in self.limits.items():
+                counter = counters.get(group)
+                limit['observed'] = observed.get(group)
+                if counter is None:
+                    continue
+                last, limit['last'] = limit['last'], (now, counter['bytes'])
+                if last is None or now <= last[0] or counter['bytes'] < last[1]:
+                    continue
+                measured = limit['measured'] = (counter['bytes'] - last[1]) / (now - last[0])
+                target = limit['target']
+                command, burst = limit['command'], limit['burst']
+                error = (target - measured) / target if target else 0
+
+                if error < -self.tolerance:
+                    # Overshooting: pull the rate down and keep bursts to ~20ms worth of target
+                    command = command * (1 + self.gain * error)
+                    burst = max(int(target / 50), self.min_burst)
+                elif error > self.tolerance and counter.get('dropped') and measured > target * 0.5:
+                    # Saturated but under target (HTB overhead, ack clocking): let it go a bit faster
+                    command = command * (1 + self.gain * error)
+                command = min(max(command, target * self.min_factor), target * self.max_factor)
+                if abs(command - limit['command']) > target * 0.01 or burst != limit['burst']:
+                    limit['command'], limit['burst'] = command, burst
+                    self.shaper.set_limit(group, limit['pids'], command, burst=burst)
+
+                seen = limit['observed']
+                leaking = seen is not None and seen > target * self.escape_factor
+                if leaking and measured <= target * (1 + self.tolerance):
+                    limit['escaping'] += 1
+                else:
+                    limit['escaping'] = 0
+                if limit['escaping'] >= self.escape_ticks:
+                    limit['status'] = 'unenforceable'
+                elif abs(error) <= self.tolerance or measured < target:
+                    limit['status'] = 'ok'
+                else:
+                    limit['status'] = 'converging'
+
+    def status(self, group):
+        with self.lock:
+            limit = self.limits.get(str(group))
+            if limit is None:
+                return None
+            return {key: limit[key] for key in ('target', 'command', 'burst', 'measured', 'observed', 'status')}
+
+
+SHAPERS = {
+    'iptables': TcShaper,
+    'simulated': SimulatedShaper,
+}
+
+
+# Shapers follow the firewall backend choice so a simulated run never touches tc
+def create_shaper(name=None, direction='egress'):
+    name = name or os.environ.get('WATERWALL_BACKEND', 'iptables')
+    if name not in SHAPERS:
+        raise ValueError(f"Unknown shaper: {name}")
+    if name == 'simulated':
+        return SimulatedShaper()
+    return SHAPERS[name](direction=direction)
@@ -0,0 +1,474 @@
+import json
+import logging
+import math
+import struct
+import threading
+import time
+import uuid
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+KEEPALIVE_INTERVAL = 15  # seconds of silence before an SSE comment keeps proxies from closing the stream
+REPLAY_EVENTS = 64  # recent deltas kept for clients resuming with Last-Event-ID
+FORMATS = ('sse', 'columnar', 'binary', 'json')  # SSE events, SSE with one array per field, packed frames, bare JSON
+SSE_FORMATS = ('sse', 'columnar')  # the ones an HTTP event stream can carry
+NO_VALUE = 0xFFFFFFFF  # uint32 column entry meaning "unchanged", NaN plays that part in float32 columns
+SERIES_REPLACE = 0x80000000  # flag on a series point count: the points replace the series
+
+
+# One connected stream client. Its queue holds (seq, payload, encoded frames) items and stays
+# bounded: when it fills up the queued deltas are collapsed into one, so a slow client skips
+# intermediate states but still ends up at the latest one with an unbroken sequence.
+class Subscriber:
+    def __init__(self, broadcaster, max_queue, name=None, fmt='sse'):
+        self.broadcaster = broadcaster
+        self.fmt = fmt  # one of FORMATS
+        self.queue = deque()
+        self.max_queue = max_queue
+        self.name = name
+        self.cond = threading.Condition()
+        self.closed = False
+        self.connected = time.time()
+        self.delivered = None  # seq of the last event handed to the client
+        self.collapsed = 0
+        self.resyncs = 0
+        self.events_sent = 0
+        self.bytes_sent = 0
+
+    def _collapse(self):
+        items = list(self.queue)
+        self.queue.clear()
+        if any(payload is None or 'records' in payload for _, payload, _ in items):
+            # a snapshot is still queued, send a newer one instead
+            if all(seq is not None for seq, _, _ in items):
+                self.resyncs += 1
+            self.queue.append((None, None, None))
+            return
+        merged = items[0][1]
+        for _, payload, _ in items[1:]:
+            merged = self.broadcaster.compose(merged, payload)
+        self.queue.append((merged['seq'], merged, {}))
+        self.collapsed += len(items) - 1
+
+    def put(self, seq, payload, frames):
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                self._collapse()
+                if self.queue[0][1] is None:  # the fresh snapshot covers this delta too
+                    self.cond.notify()
+                    return
+            self.queue.append((seq, payload, frames))
+            self.cond.notify()
+
+    # Next event, or None after `timeout` seconds of silence
+    def get(self, timeout=KEEPALIVE_INTERVAL):
+        with self.cond:
+            if not self.queue and not self.closed:
+                self.cond.wait(timeout)
+            while self.queue:
+                seq, payload, frames = self.queue.popleft()
+                if seq is None or self.delivered is None or seq > self.delivered:
+                    break
+            else:
+                return None
+        if seq is None:
+            seq, payload, frames = self.broadcaster.current_snapshot()
+        event = self.broadcaster.frame(payload, frames, self.fmt)
+        with self.cond:
+            self.delivered = seq
+            self.events_sent += 1
+            self.bytes_sent += len(event)
+        return event
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def stats(self, seq):
+        with self.cond:
+            return {
+                'client': self.name,
+                'connected_for': time.time() - self.connected,
+                'delivered': self.delivered,
+                'lag': seq - self.delivered if self.delivered is not None else None,
+                'queued': len(self.queue),
+                'collapsed': self.collapsed,
+                'resyncs': self.resyncs,
+                'events_sent': self.events_sent,
+                'bytes_sent': self.bytes_sent,
+            }
+
+
+# Points appended to a rolling series between two samples (the client appends them and keeps the
+# last `max_length`), or None if the series changed some other way
+def appended_points(old, new, max_length, max_points=4):
+    for count in range(1, min(max_points, len(new)) + 1):
+        if len(new) != len(old) + count and len(new) != max_length:
+            continue
+        if (old + new[-count:])[-len(new):] == new:
+            return new[-count:]
+    return None
+
+
+# Describe how `current` differs from `previous` (both key -> record): added records, removed keys,
+# changed scalar fields and the points appended to each series field
+def diff_records(previous, current, series=(), max_length=None):
+    delta = {'added': [], 'removed': [key for key in previous if key not in current], 'changed': {}, 'appended': {}}
+    for key, record in current.items():
+        old = previous.get(key)
+        if old is None:
+            delta['added'].append(record)
+            continue
+        fields = {}
+        for field, value in record.items():
+            previous_value = old.get(field)
+            if value == previous_value:
+                continue
+            if field in series:
+                points = appended_points(previous_value or [], value, max_length)
+                if points is not None:
+                    delta['appended'].setdefault(key, {})[field] = points
+                    continue
+            fields[field] = value
+        if fields:
+            delta['changed'][key] = fields
+    return delta
+
+
+def _trim(points, max_length):
+    return points[-max_length:] if max_length else points
+
+
+# One delta equivalent to applying `first` and then `second`
+def compose_deltas(first, second, key, max_length=None):
+    removed = set(second['removed'])
+    readded = {record[key] for record in second['added']}
+    superseded = removed | readded  # keys whose earlier changes no longer matter
+    first_added = {record[key] for record in first['added']}
+    added = {}
+    for record in first['added']:
+        if record[key] in superseded:
+            continue
+        record = {**record, **second['changed'].get(record[key], {})}
+        for field, points in second['appended'].get(record[key], {}).items():
+            record[field] = _trim(record.get(field, []) + points, max_length)
+        added[record[key]] = record
+    changed = {k: dict(fields) for k, fields in first['changed'].items() if k not in superseded}
+    appended = {k: dict(series) for k, series in first['appended'].items() if k not in superseded}
+    for k, fields in second['changed'].items():
+        if k in added:
+            continue
+        changed.setdefault(k, {}).update(fields)
+        for field in fields:  # a series sent whole replaces the points appended before
+            appended.get(k, {}).pop(field, None)
+    for k, series in second['appended'].items():
+        if k in added:
+            continue
+        for field, points in series.items():
+            if field in changed.get(k, {}):
+                changed[k][field] = _trim(changed[k][field] + points, max_length)
+            else:
+                earlier = appended.setdefault(k, {}).get(field, [])
+                appended[k][field] = _trim(earlier + points, max_length)
+    return {
+        'seq': second['seq'],
+        'base': first['base'],
+        'added': list(added.values()) + second['added'],
+        'removed': first['removed'] + [k for k in second['removed'] if k not in first['removed'] and k not in first_added],
+        'changed': changed,
+        'appended': {k: series for k, series in appended.items() if series},
+    }
+
+
+# Keeps the current process table and fans out one sequence-numbered delta per tick to every subscriber.
+# A subscriber starts with a full snapshot, or with the deltas it missed when it resumes with the id
+# of the last event it saw; a client that sees a delta whose `base` isn't the last `seq` it applied
+# has missed something and resyncs by reconnecting.
+class Broadcaster:
+    def __init__(self, key='pid', series=('historical_data',), max_length=None, max_queue=8, replay=REPLAY_EVENTS):
+        self.key = key
+        self.series = series
+        self.max_length = max_length  # rolling series are trimmed to this many points client side
+        self.max_queue = max_queue
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.records = {}  # key -> record as of self.seq
+        self.seq = 0
+        self.snapshot = None  # (seq, snapshot payload, encoded frames), built on demand
+        self.epoch = uuid.uuid4().hex[:8]  # event ids from before a restart never match this run's sequence
+        self.ring = deque(maxlen=replay)  # (seq, delta payload, encoded frames)
+        self.replayed = 0
+        self.resyncs = 0
+        self.published = 0
+        self.encoded = {fmt: [0, 0] for fmt in FORMATS}  # format -> [frames, bytes]
+        self.hooks = []  # called after every publish, on the publishing thread
+
+    # Queue item for the full state, shared by everyone who needs it at this sequence number;
+    # call with the lock held
+    def _snapshot_item(self):
+        if self.snapshot is None or self.snapshot[0] != self.seq:
+            payload = {'seq': self.seq, 'max_length': self.max_length, 'records': list(self.records.values())}
+            self.snapshot = (self.seq, payload, {})
+        return self.snapshot
+
+    def current_snapshot(self):
+        with self.lock:
+            return self._snapshot_item()
+
+    # Encoded form of a payload, built once per format and shared by every subscriber that sends it
+    def frame(self, payload, frames, fmt='sse'):
+        encoded = frames.get(fmt)
+        if encoded is None:
+            event_id = self.event_id(payload['seq'])
+            if fmt == 'binary':
+                encoded = binary_frame(payload, event_id, self.key, self.series)
+            elif fmt == 'json':
+                encoded = json.dumps({'id': event_id, **payload}).encode()
+            else:
+                data = columnar_payload(payload, self.key) if fmt == 'columnar' else payload
+                encoded = sse_event(json.dumps(data), 'snapshot' if 'records' in payload else 'delta', event_id)
+            frames[fmt] = encoded
+            counters = self.encoded[fmt]
+            counters[0] += 1
+            counters[1] += len(encoded)
+        return encoded
+
+    def compose(self, first, second):
+        return compose_deltas(first, second, self.key, self.max_length)
+
+    def event_id(self, seq):
+        return f"{self.epoch}-{seq}"
+
+    # Sequence number from an event id of this run, or None
+    def parse_event_id(self, event_id):
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    # Deltas after `seq` if the ring still holds all of them, else None; call with the lock held
+    def _missed_events(self, seq):
+        if seq is None or seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.ring or self.ring[0][0] > seq + 1:
+            return None
+        return [item for item in self.ring if item[0] > seq]
+
+    def subscribe(self, last_event_id=None, name=None, fmt='sse'):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown stream format {fmt!r}")
+        subscriber = Subscriber(self, self.max_queue, name, fmt)
+        with self.lock:  # no delta can slip in between the catch-up and the subscription
+            missed = self._missed_events(self.parse_event_id(last_event_id))
+            if missed is None:
+                if last_event_id:
+                    self.resyncs += 1
+                subscriber.queue.append(self._snapshot_item())
+            else:
+                self.replayed += len(missed)
+                subscriber.queue.extend(missed)  # the catch-up isn't subject to the live queue bound
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, records):
+        current = {record[self.key]: record for record in records}
+        with self.lock:
+            payload = {'seq': self.seq + 1, 'base': self.seq,
+                       **diff_records(self.records, current, self.series, self.max_length)}
+            self.seq += 1
+            self.records = current
+            frames = {}  # encoded lazily, only in the formats someone actually reads
+            self.ring.append((self.seq, payload, frames))
+            self.published += 1
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(payload['seq'], payload, frames)
+        for hook in list(self.hooks):
+            hook()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    # The counters from stats() without asking every subscriber for its own, for frequent scrapes
+    def counts(self):
+        with self.lock:
+            formats = dict.fromkeys(FORMATS, 0)
+            for subscriber in self.subscribers:
+                formats[subscriber.fmt] += 1
+            return {'clients': formats, 'seq': self.seq, 'published': self.published,
+                    'replayed': self.replayed, 'resyncs': self.resyncs}
+
+    def stats(self):
+        with self.lock:
+            subscribers = list(self.subscribers)
+            seq = self.seq
+        clients = [subscriber.stats(seq) for subscriber in subscribers]
+        lags = [client['lag'] for client in clients if client['lag'] is not None]
+        with self.lock:
+            return {
+                'clients': len(subscribers),
+                'seq': self.seq,
+                'records': len(self.records),
+                'published': self.published,
+                'average_frame_bytes': {kind: total / frames if frames else 0
+                                        for kind, (frames, total) in self.encoded.items()},
+                'replay_window': len(self.ring),
+                'replayed': self.replayed,
+                'resyncs': self.resyncs,
+                'collapsed': sum(client['collapsed'] for client in clients),
+                'max_lag': max(lags, default=0),
+                'subscribers': clients,
+            }
+
+
+# The format= of an event stream request, raising ValueError for anything that isn't sent as SSE
+def sse_format(value):
+    if value not in SSE_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(SSE_FORMATS)}")
+    return value
+
+
+# Encode a payload as one Server-Sent Events frame
+def sse_event(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {data}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+def _to_columns(records, key):
+    fields = {}
+    for record in records:
+        fields.update(dict.fromkeys(record))
+    fields.pop(key, None)
+    return {'index': [record[key] for record in records],
+            'columns': {field: [record.get(field) for record in records] for field in fields}}
+
+
+def _by_field(changes):
+    columns = {}
+    for k, fields in changes.items():
+        for field, value in fields.items():
+            column = columns.setdefault(field, {'index': [], 'values': []})
+            column['index'].append(k)
+            column['values'].append(value)
+    return columns
+
+
+# Columnar form of a snapshot or delta payload: records become {'index': [keys], 'columns': {field: [values]}}
+# and per-key changes and appended points become {field: {'index': [keys], 'values': [values]}}
+def columnar_payload(payload, key='pid'):
+    if 'records' in payload:
+        return {'seq': payload['seq'], 'max_length': payload['max_length'], **_to_columns(payload['records'], key)}
+    return {
+        'seq': payload['seq'],
+        'base': payload['base'],
+        'removed': payload['removed'],
+        'added': _to_columns(payload['added'], key),
+        'changed': _by_field(payload['changed']),
+        'appended': _by_field(payload['appended']),
+    }
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _pack(fmt, values):
+    return struct.pack(f'<{len(values)}{fmt}', *values)
+
+
+# Encode a snapshot or delta payload as one binary frame the browser can read without parsing numbers:
+#   uint32 header length, UTF-8 JSON header padded to 4 bytes,
+#   uint32 keys[rows], then one uint32 or float32 array[rows] per numeric column,
+#   then per series uint32 counts[rows] (SERIES_REPLACE set when the points replace the series)
+#   followed by float32 points[sum of counts].
+# Everything is little-endian and 4-byte aligned, so each array can be wrapped in a typed array view.
+# The header carries the table changes: removed and added keys plus the non-numeric fields per key.
+def binary_frame(payload, event_id, key='pid', series=()):
+    snapshot = 'records' in payload
+    rows = {}  # key -> {numeric field or series: value}
+    fields = {}  # key -> {other field: value}, sent in the JSON header
+    replaced = set()  # (key, series) sent whole
+
+    def take(k, values, whole):
+        row = rows.setdefault(k, {})
+        for field, value in values.items():
+            if field == key:
+                continue
+            if field in series and isinstance(value, list):
+                row[field] = value
+                if whole:
+                    replaced.add((k, field))
+            elif _is_number(value):
+                row[field] = value
+            else:
+                fields.setdefault(k, {})[field] = value
+
+    added = payload['records'] if snapshot else payload['added']
+    for record in added:
+        take(record[key], record, True)
+    if not snapshot:
+        for k, changed in payload['changed'].items():
+            take(k, changed, True)
+        for k, appended in payload['appended'].items():
+            take(k, appended, False)
+
+    keys = list(rows)
+    names = sorted({field for row in rows.values() for field in row if field not in series})
+    columns = []
+    body = [_pack('I', keys)]
+    for name in names:
+        values = [row.get(name) for row in rows.values()]
+        present = [value for value in values if value is not None]
+        if all(isinstance(value, int) and 0 <= value < NO_VALUE for value in present):
+            columns.append([name, 'u32'])
+            body.append(_pack('I', [NO_VALUE if value is None else value for value in values]))
+        else:
+            columns.append([name, 'f32'])
+            body.append(_pack('f', [math.nan if value is None else value for value in values]))
+    series_info = []
+    for name in series:
+        if not any(name in row for row in rows.values()):
+            continue
+        counts, points = [], []
+        for k, row in rows.items():
+            values = row.get(name, [])
+            counts.append(len(values) | (SERIES_REPLACE if (k, name) in replaced else 0))
+            points.extend(values)
+        series_info.append([name, len(points)])
+        body.append(_pack('I', counts))
+        body.append(_pack('f', points))
+
+    header = {
+        'type': 'snapshot' if snapshot else 'delta',
+        'id': event_id,
+        'seq': payload['seq'],
+        'base': None if snapshot else payload['base'],
+        'max_length': payload.get('max_length'),
+        'removed': [] if snapshot else payload['removed'],
+        'added': [record[key] for record in added],
+        'rows': len(keys),
+        'columns': columns,
+        'series': series_info,
+        'fields': fields,
+    }
+    encoded = json.dumps(header).encode()
+    encoded += b' ' * (-len(encoded) % 4)
+    return struct.pack('<I', len(encoded)) + encoded + b''.join(body)
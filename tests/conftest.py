@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules live at the top of the repository, next to waterwall.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('WATERWALL_BACKEND', 'simulated')  # read when waterwall is imported
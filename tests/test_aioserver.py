@@ -0,0 +1,86 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from aioserver import AsyncServer
+from stream import Broadcaster
+
+
+# WSGI app that answers with what it was sent
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    reply = json.dumps({'method': environ['REQUEST_METHOD'], 'path': environ['PATH_INFO'],
+                        'length': environ.get('CONTENT_LENGTH'), 'body': body.decode()}).encode()
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [reply]
+
+
+# Send raw bytes to a server on a free port; returns everything read until the server closes or goes quiet
+def exchange(*parts, broadcaster=None, pause=0.05):
+    async def run():
+        server = AsyncServer(echo_app, broadcaster or Broadcaster())
+        server.loop = asyncio.get_running_loop()
+        server.executor = ThreadPoolExecutor(2)
+        listener = await asyncio.start_server(server._handle, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname()[:2])
+        received = b''
+        for part in parts:
+            writer.write(part)
+            await writer.drain()
+            try:
+                received += await asyncio.wait_for(reader.read(65536), pause)
+            except asyncio.TimeoutError:
+                pass
+        try:
+            while chunk := await asyncio.wait_for(reader.read(65536), pause):
+                received += chunk
+        except asyncio.TimeoutError:
+            pass
+        writer.close()
+        listener.close()
+        server.executor.shutdown()
+        return received
+    return asyncio.run(run())
+
+
+def body_of(response):
+    return json.loads(response.split(b'\r\n\r\n', 1)[1])
+
+
+def test_wsgi_routes_keep_the_connection_alive():
+    response = exchange(b'GET /processes HTTP/1.1\r\nHost: x\r\n\r\n', b'GET /other HTTP/1.1\r\nHost: x\r\n\r\n')
+    assert response.count(b'HTTP/1.1 200 OK') == 2 and b'Connection: keep-alive' in response
+    assert b'"/other"' in response
+
+
+def test_chunked_body_is_decoded_for_the_app():
+    response = exchange(b'POST /limit HTTP/1.1\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n'
+                        b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nTrailer: x\r\n\r\n')
+    assert body_of(response) == {'method': 'POST', 'path': '/limit', 'length': '11', 'body': 'hello world'}
+
+
+def test_expect_continue_is_answered_before_the_body():
+    head = b'POST /limit HTTP/1.1\r\nContent-Length: 2\r\nExpect: 100-continue\r\nConnection: close\r\n\r\n'
+    response = exchange(head, b'{}')
+    assert response.startswith(b'HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK')
+    assert body_of(response.split(b'\r\n\r\n', 1)[1])['body'] == '{}'
+
+
+def test_unsupported_transfer_encoding_is_501():
+    response = exchange(b'POST /limit HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n')
+    assert response.startswith(b'HTTP/1.1 501 Not Implemented') and b'Connection: close' in response
+
+
+def test_malformed_request_line_is_400():
+    assert exchange(b'NONSENSE\r\n\r\n').startswith(b'HTTP/1.1 400 Bad Request')
+
+
+def test_stream_sends_the_snapshot_and_rejects_other_formats():
+    broadcaster = Broadcaster()
+    broadcaster.publish([{'pid': 1, 'rate': 2.0}])
+    response = exchange(b'GET /process_stream HTTP/1.1\r\n\r\n', broadcaster=broadcaster)
+    assert b'Content-Type: text/event-stream' in response and b'event: snapshot' in response
+    assert broadcaster.counts()['clients']['sse'] == 0  # unsubscribed once the stream's coroutine ended
+
+    response = exchange(b'GET /process_stream?format=binary HTTP/1.1\r\n\r\n', broadcaster=broadcaster)
+    assert response.startswith(b'HTTP/1.1 400 Bad Request')
@@ -0,0 +1,40 @@
+import ipaddress
+
+from blocklist import aggregate, chunks, import_blocklist, parse_entries
+from firewall import SimulatedBackend
+
+
+def networks(*values):
+    return [ipaddress.ip_network(value) for value in values]
+
+
+def test_aggregate_merges_adjacent_and_nested():
+    v4, v6 = aggregate(networks('10.0.0.0/25', '10.0.0.128/25', '10.0.0.7/32', '192.0.2.1/32'))
+    assert v4 == ['10.0.0.0/24', '192.0.2.1/32']
+    assert v6 == []
+
+
+def test_aggregate_keeps_families_apart():
+    v4, v6 = aggregate(networks('2001:db8::/33', '2001:db8:8000::/33', '0.0.0.0/1'))
+    assert v4 == ['0.0.0.0/1']
+    assert v6 == ['2001:db8::/32']
+
+
+def test_aggregate_shorter_prefix_covers_longer():
+    v4, _ = aggregate(networks('198.51.100.0/24', '198.51.0.0/16'))
+    assert v4 == ['198.51.0.0/16']
+
+
+def test_parse_entries_skips_comments_and_junk():
+    parsed = parse_entries(['# feed', '10.0.0.1  # host', 'not an address', '', '10.1.0.0/16 extra'])
+    assert parsed == networks('10.0.0.1/32', '10.1.0.0/16')
+
+
+def test_chunks():
+    assert list(chunks(list(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_import_blocklist_loads_a_diff():
+    backend = SimulatedBackend()
+    import_blocklist(backend, 'feed', networks('10.0.0.0/25', '10.0.0.128/25', '2001:db8::1/128'))
+    assert backend.sets == {'feed-v4': {'10.0.0.0/24'}, 'feed-v6': {'2001:db8::1/128'}}
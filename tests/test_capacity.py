@@ -0,0 +1,68 @@
+import pytest
+
+import capacity
+from capacity import DEFAULT_CAPACITY, CapacityEstimator
+
+
+# An interface whose speed and byte counter the test controls
+@pytest.fixture
+def link(monkeypatch):
+    state = {'speed': None, 'bytes': 0}
+    monkeypatch.setattr(capacity, 'link_speed', lambda iface: state['speed'])
+    monkeypatch.setattr(capacity, 'iface_bytes', lambda iface, direction='tx': state['bytes'])
+    return state
+
+
+def feed(estimator, link, rates, capped=False, start=0):
+    for second, rate in enumerate(rates, start + 1):
+        link['bytes'] += rate
+        estimator.update(now=second, capped=capped)
+
+
+def test_override_beats_link_speed(link):
+    link['speed'] = 125000000
+    estimator = CapacityEstimator('eth0')
+    assert estimator.current == 125000000
+    estimator.set_override(5000000)
+    assert estimator.current == 5000000
+    estimator.set_override(None)
+    assert estimator.current == 125000000
+
+
+def test_link_speed_ignores_measured_throughput(link):
+    link['speed'] = 12500000
+    estimator = CapacityEstimator('eth0')
+    feed(estimator, link, [100, 50000000, 100])
+    assert estimator.current == 12500000
+
+
+def test_peak_is_the_fallback_without_a_speed(link):
+    estimator = CapacityEstimator('wlan0', floor=1000)
+    assert estimator.current == 1000
+    feed(estimator, link, [0, 5000, 20000, 3000])
+    assert estimator.current == 20000
+    assert estimator.stats()['observed_peak'] == 20000
+
+
+def test_peak_slides_out_of_the_window(link):
+    estimator = CapacityEstimator('wlan0', floor=1000, window=3)
+    feed(estimator, link, [0, 20000, 5000, 5000, 5000, 5000])
+    assert estimator.observed_peak() == 5000
+    assert estimator.current == 5000
+
+
+def test_capped_samples_dont_pull_the_estimate_down(link):
+    estimator = CapacityEstimator('wlan0', floor=1000, window=3)
+    feed(estimator, link, [0, 20000])
+    feed(estimator, link, [2000] * 10, capped=True, start=2)
+    assert estimator.current == 20000
+
+
+def test_small_moves_dont_rerate(link):
+    estimator = CapacityEstimator('wlan0', floor=DEFAULT_CAPACITY)
+    link['bytes'] = 0
+    estimator.update(now=0)
+    link['bytes'] += DEFAULT_CAPACITY + DEFAULT_CAPACITY // 20
+    assert estimator.update(now=1) is False  # 5% over the floor
+    link['bytes'] += DEFAULT_CAPACITY * 2
+    assert estimator.update(now=2) is True
@@ -0,0 +1,109 @@
+import json
+import os
+import socket
+import tempfile
+
+import pytest
+
+import waterwall_cli
+from control import HEADER, MAX_FRAME, ControlServer, read_frame, write_frame
+from stream import Broadcaster
+
+
+def fail(request):
+    raise ValueError("no such process")
+
+
+HANDLERS = {
+    'ping': lambda request: 'pong',
+    'echo': lambda request: request,
+    'fail': fail,
+    'query': lambda request: {'processes': [{'pid': 1, 'name': 'init'}], 'next_cursor': None},
+}
+
+
+@pytest.fixture
+def server():
+    with tempfile.TemporaryDirectory(dir='/tmp') as directory:  # socket paths are limited to ~100 bytes
+        broadcaster = Broadcaster()
+        broadcaster.publish([{'pid': 1, 'rate': 2.0}])
+        control = ControlServer(os.path.join(directory, 'ctl.sock'), HANDLERS, broadcaster)
+        control.start()
+        yield control
+        control.stop()
+
+
+def connect(server):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    sock.connect(server.path)
+    return sock
+
+
+def test_many_requests_per_connection(server):
+    with connect(server) as sock:
+        write_frame(sock, {'op': 'ping', 'id': 1})
+        write_frame(sock, {'op': 'echo', 'id': 2, 'value': [1, 2]})
+        assert read_frame(sock) == {'id': 1, 'ok': True, 'result': 'pong'}
+        assert read_frame(sock)['result'] == {'op': 'echo', 'id': 2, 'value': [1, 2]}
+
+
+def test_errors_are_replies(server):
+    with connect(server) as sock:
+        write_frame(sock, {'op': 'fail', 'id': 3})
+        assert read_frame(sock) == {'id': 3, 'ok': False, 'error': "no such process"}
+        write_frame(sock, {'op': 'drop'})
+        reply = read_frame(sock)
+        assert not reply['ok'] and 'subscribe' in reply['error']
+
+
+def test_oversized_frame_closes_the_connection(server):
+    with connect(server) as sock:
+        sock.sendall(HEADER.pack(MAX_FRAME + 1))
+        assert 'too large' in read_frame(sock)['error']
+        assert read_frame(sock) is None
+
+
+def test_subscribe_streams_json_events(server):
+    with connect(server) as sock:
+        write_frame(sock, {'op': 'subscribe', 'id': 4})
+        assert read_frame(sock) == {'id': 4, 'ok': True, 'result': 'subscribed'}
+        event = read_frame(sock)
+        assert event['id'] == server.broadcaster.event_id(1) and event['records'] == [{'pid': 1, 'rate': 2.0}]
+        server.broadcaster.publish([{'pid': 1, 'rate': 3.0}])
+        assert read_frame(sock)['changed'] == {'1': {'rate': 3.0}}
+
+
+def test_start_replaces_a_stale_socket_but_not_a_live_one(server):
+    with pytest.raises(OSError):
+        ControlServer(server.path, HANDLERS).start()
+    server.stop()
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(server.path)  # bound but nobody listening, like after a crash
+    stale.close()
+    server.start()
+    with connect(server) as sock:
+        write_frame(sock, {'op': 'ping'})
+        assert read_frame(sock)['ok']
+
+
+def parse(*argv):
+    return waterwall_cli.build_parser().parse_args(['--socket', '/nonexistent', *argv])
+
+
+def test_cli_requests():
+    assert waterwall_cli.request_for(parse('limit', 'none', '12', '--download')) == {
+        'op': 'limit', 'percentage': None, 'direction': 'download', 'pids': [12]}
+    assert waterwall_cli.request_for(parse('block', '--name', 'steam')) == {'op': 'block', 'name': 'steam'}
+    assert waterwall_cli.request_for(parse('ps', '--top', '3', '--columnar')) == {
+        'op': 'query', 'sort_by': 'traffic_usage', 'sort_order': 'desc', 'top': 3, 'format': 'columnar'}
+    with pytest.raises(SystemExit):
+        waterwall_cli.request_for(parse('unblock'))  # no target
+
+
+def test_cli_prints_rows_and_reports_errors(server, capsys, monkeypatch):
+    assert waterwall_cli.main(['--socket', server.path, 'ps']) == 0
+    assert [json.loads(line) for line in capsys.readouterr().out.splitlines()] == [{'pid': 1, 'name': 'init'}]
+    monkeypatch.setattr(waterwall_cli, 'request_for', lambda args: {'op': 'fail'})
+    assert waterwall_cli.main(['--socket', server.path, 'ping']) == 1
+    assert 'no such process' in capsys.readouterr().err
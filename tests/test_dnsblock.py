@@ -0,0 +1,127 @@
+import asyncio
+import ipaddress
+import socket
+import struct
+
+import pytest
+
+from dnsblock import (QTYPE_A, QTYPE_AAAA, DomainBlocklist, DomainResolver, LookupFailed, _QueryProtocol,
+                      build_query, parse_response)
+from firewall import SimulatedBackend
+
+
+# A response to build_query(query_id, ...) with the question echoed and one A/AAAA record per answer
+def build_response(query_id, domain, rcode=0, answers=()):
+    question = build_query(query_id, domain, QTYPE_A)[12:]
+    records = b''
+    for address, ttl in answers:
+        packed = ipaddress.ip_address(address).packed
+        qtype = QTYPE_A if len(packed) == 4 else QTYPE_AAAA
+        records += b'\xc0\x0c' + struct.pack('>HHIH', qtype, 1, ttl, len(packed)) + packed
+    return struct.pack('>HHHHHH', query_id, 0x8180 | rcode, 1, len(answers), 0, 0) + question + records
+
+
+def test_parse_response():
+    data = build_response(7, 'example.com', answers=[('192.0.2.1', 60), ('2001:db8::1', 30)])
+    assert parse_response(data) == (7, 0, [('192.0.2.1', 60), ('2001:db8::1', 30)])
+
+
+def receive(data, query_id=7):
+    loop = asyncio.new_event_loop()
+    try:
+        future = loop.create_future()
+        _QueryProtocol(query_id, future).datagram_received(data, None)
+        return future.result() if future.done() else None
+    finally:
+        loop.close()
+
+
+def test_servfail_is_a_failed_lookup():
+    with pytest.raises(LookupFailed):
+        receive(build_response(7, 'example.com', rcode=2))
+
+
+def test_nxdomain_is_an_answer():
+    assert receive(build_response(7, 'example.com', rcode=3)) == (7, 3, [])
+
+
+def test_other_query_ids_are_ignored():
+    assert receive(build_response(8, 'example.com'), query_id=7) is None
+
+
+def resolve_with(query):
+    resolver = DomainResolver(nameserver='127.0.0.1')
+    resolver._query = query
+    return asyncio.run(resolver.resolve('example.com'))
+
+
+def test_nameserver_outage_resolves_to_none():
+    async def timeout(domain, qtype):
+        raise asyncio.TimeoutError()
+    assert resolve_with(timeout)[0] is None
+
+
+def test_nameserver_empty_answer_resolves_to_nothing():
+    async def empty(domain, qtype):
+        return []
+    assert resolve_with(empty)[0] == set()
+
+
+def test_nameserver_answers_keep_the_shortest_ttl():
+    async def answer(domain, qtype):
+        if qtype == QTYPE_AAAA:
+            raise LookupFailed("rcode 2")
+        return [('192.0.2.1', 600), ('192.0.2.2', 120)]
+    assert resolve_with(answer) == ({'192.0.2.1', '192.0.2.2'}, 120)
+
+
+@pytest.mark.parametrize('errno, expected', [(socket.EAI_NONAME, set()), (socket.EAI_AGAIN, None)])
+def test_system_resolver_errors(monkeypatch, errno, expected):
+    async def getaddrinfo(*args, **kwargs):
+        raise socket.gaierror(errno, 'lookup failed')
+
+    async def resolve():
+        monkeypatch.setattr(asyncio.get_running_loop(), 'getaddrinfo', getaddrinfo)
+        return await DomainResolver().resolve('example.com')
+    assert asyncio.run(resolve())[0] == expected
+
+
+# Hands out canned answers: {domain: addresses or None for a failed lookup}
+class FakeResolver:
+    def __init__(self, answers):
+        self.answers = answers
+
+    async def resolve(self, domain):
+        return self.answers.get(domain), 60
+
+
+def refresh(blocklist, domains):
+    with blocklist.lock:
+        blocklist.domains |= set(domains)
+    asyncio.run(blocklist._refresh(domains))
+
+
+def test_outage_keeps_the_last_good_answer():
+    backend = SimulatedBackend()
+    resolver = FakeResolver({'ads.example': {'192.0.2.1'}})
+    blocklist = DomainBlocklist(backend, 'ads', resolver)
+    refresh(blocklist, ['ads.example'])
+    assert backend.sets['ads-v4'] == {'192.0.2.1/32'}
+    resolver.answers['ads.example'] = None
+    refresh(blocklist, ['ads.example'])
+    assert backend.sets['ads-v4'] == {'192.0.2.1/32'}
+    resolver.answers['ads.example'] = set()
+    refresh(blocklist, ['ads.example'])
+    assert backend.sets['ads-v4'] == set()
+
+
+def test_shared_addresses_are_counted():
+    backend = SimulatedBackend()
+    resolver = FakeResolver({'a.example': {'192.0.2.1'}, 'b.example': {'192.0.2.1', '2001:db8::1'}})
+    blocklist = DomainBlocklist(backend, 'ads', resolver)
+    refresh(blocklist, ['a.example', 'b.example'])
+    assert backend.sets == {'ads-v4': {'192.0.2.1/32'}, 'ads-v6': {'2001:db8::1/128'}}
+    resolver.answers['b.example'] = set()
+    refresh(blocklist, ['b.example'])
+    assert backend.sets['ads-v4'] == {'192.0.2.1/32'}  # a.example still resolves to it
+    assert blocklist.stats()['addresses'] == 1
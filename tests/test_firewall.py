@@ -0,0 +1,105 @@
+import subprocess
+
+import pytest
+
+import firewall
+from firewall import FirewallError, IptablesBackend, SimulatedBackend, bench_control_plane, rule_comment
+
+
+def test_block_and_unblock():
+    backend = SimulatedBackend()
+    backend.block(42)
+    backend.block('42')  # already blocked
+    assert backend.evaluate(42)[0] == 'DROP'
+    assert backend.evaluate(7)[0] == 'ACCEPT'
+    backend.unblock(42)
+    backend.unblock(42)
+    assert backend.evaluate(42)[0] == 'ACCEPT'
+    assert backend.stats()['ops'] == 2
+    assert backend.stats()['noops'] == 2
+
+
+def test_transaction_commits_once():
+    backend = SimulatedBackend()
+    with backend.transaction():
+        for pid in range(10):
+            backend.block(pid)
+        with backend.transaction():  # nested transactions join the outer one
+            backend.unblock(3)
+    assert backend.stats()['rules'] == 9
+    assert backend.ops == 1
+
+
+def test_transaction_without_changes_commits_nothing():
+    backend = SimulatedBackend()
+    with backend.transaction():
+        backend.unblock(1)
+    assert backend.ops == 0
+
+
+def test_counters_follow_evaluated_packets():
+    backend = SimulatedBackend()
+    backend.block(5)
+    backend.evaluate(5, size=100)
+    backend.evaluate(5, size=200)
+    assert backend.read_counters() == {rule_comment('block', 5): (2, 300)}
+
+
+def test_sync_set_is_incremental():
+    backend = SimulatedBackend()
+    networks = ['10.0.0.0/8', '192.0.2.0/24']  # as aggregate() returns them
+    assert backend.sync_set('feed', networks) == (2, 0)
+    assert backend.sync_set('feed', networks) == (0, 0)
+    assert backend.sync_set('feed', networks[:1]) == (0, 1)
+    assert backend.stats()['set_entries'] == 1
+
+
+def test_cleanup_drops_everything():
+    backend = SimulatedBackend()
+    backend.block(1)
+    backend.sync_set('feed', ['10.0.0.0/8'])
+    backend.cleanup()
+    assert backend.stats()['rules'] == 0
+    assert backend.stats()['set_entries'] == 0
+
+
+def test_bench_control_plane():
+    backend = SimulatedBackend()
+    result = bench_control_plane(backend, operations=300, pids=10)
+    assert result['operations'] == 300
+    assert backend.ops + backend.noops == 300
+
+
+# Stands in for the ipset binary: `list` reports `members`, `restore` applies its input or fails
+class FakeIpset:
+    def __init__(self, members, fail=False):
+        self.members = set(members)
+        self.fail = fail
+
+    def __call__(self, args, input=None, **kwargs):
+        returncode, stdout = 0, ''
+        if args[:2] == ['ipset', 'list']:
+            stdout = 'Name: x\nMembers:\n' + '\n'.join(sorted(self.members))
+        elif args[:2] == ['ipset', 'restore']:
+            if self.fail:
+                returncode = 1
+            else:
+                for line in input.split('\n'):
+                    if line:
+                        op, _, net = line.split()
+                        (self.members.add if op == 'add' else self.members.discard)(net)
+        return subprocess.CompletedProcess(args, returncode, stdout, 'ipset: error')
+
+
+def test_failed_ipset_restore_raises_and_keeps_the_kernel_view(monkeypatch):
+    ipset = FakeIpset(['10.0.0.0/8'])
+    monkeypatch.setattr(firewall.subprocess, 'run', ipset)
+    backend = IptablesBackend()
+    assert backend.sync_set('feed', ['10.0.0.0/8', '192.0.2.0/24']) == (1, 0)
+    ipset.fail = True
+    with pytest.raises(FirewallError):
+        backend.sync_set('feed', ['198.51.100.0/24'])
+    assert backend.sets['waterwall-feed-v4'] == {'10.0.0.0/8', '192.0.2.0/24'}
+    ipset.fail = False
+    assert backend.sync_set('feed', ['198.51.100.0/24']) == (1, 2)  # the failed diff is retried in full
+    assert ipset.members == {'198.51.100.0/24'}
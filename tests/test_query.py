@@ -0,0 +1,80 @@
+import re
+
+import pytest
+
+from query import _select_rows, decode_cursor, parse_query, select_columns, select_processes
+
+RECORDS = [
+    {'pid': 1, 'name': 'systemd', 'exe': '/usr/lib/systemd/systemd', 'traffic_usage_mb': 1.0, 'historical_data': [1.0]},
+    {'pid': 2, 'name': 'firefox', 'exe': '/usr/bin/firefox', 'traffic_usage_mb': 50.0, 'historical_data': [40.0, 50.0]},
+    {'pid': 3, 'name': 'steam', 'exe': '/opt/steam/steam', 'traffic_usage_mb': 20.0, 'historical_data': []},
+    {'pid': 4, 'name': 'kworker', 'exe': None, 'traffic_usage_mb': None, 'historical_data': []},
+    {'pid': 5, 'name': 'Firefox-bin', 'exe': '/usr/bin/firefox-bin', 'traffic_usage_mb': 20.0, 'historical_data': []},
+]
+
+
+def select(**selection):
+    return _select_rows(len(RECORDS), lambda i, field: RECORDS[i].get(field), **selection)
+
+
+def pids(indexes):
+    return [RECORDS[i]['pid'] for i in indexes]
+
+
+def test_sorts_descending_with_missing_values_last():
+    indexes, matched, cursor = select()
+    assert pids(indexes) == [2, 5, 3, 1, 4]  # ties broken by pid
+    assert (matched, cursor) == (5, None)
+
+
+def test_sorts_ascending():
+    indexes, _, _ = select(descending=False)
+    assert pids(indexes) == [4, 1, 3, 5, 2]
+
+
+def test_name_and_pattern_filters():
+    assert pids(select(name='firefox')[0]) == [2, 5]
+    assert pids(select(name='opt/steam')[0]) == [3]  # executable path too
+    indexes, matched, _ = select(pattern=re.compile('^fire', re.IGNORECASE))
+    assert (pids(indexes), matched) == ([2, 5], 2)
+
+
+def test_pages_with_cursor():
+    seen = []
+    cursor = None
+    while True:
+        indexes, matched, cursor = select(top=2, cursor=cursor and decode_cursor(cursor))
+        seen += pids(indexes)
+        assert matched == 5
+        if cursor is None:
+            break
+    assert seen == [2, 5, 3, 1, 4]
+
+
+def test_unsortable_field():
+    records = [{'pid': 1, 'odd': 'a'}, {'pid': 2, 'odd': 1}]
+    with pytest.raises(ValueError):
+        _select_rows(2, lambda i, field: records[i].get(field), sort_by='odd')
+
+
+def test_rows_and_columns_agree():
+    query = parse_query({'fields': 'pid,name', 'top': '2'})
+    rows, _, _ = select_processes(RECORDS, **query)
+    columns = {field: [record[field] for record in RECORDS] for field in RECORDS[0]}
+    table, _, _ = select_columns(columns, **query)
+    assert rows == [{'pid': 2, 'name': 'firefox'}, {'pid': 5, 'name': 'Firefox-bin'}]
+    assert table == {'index': [2, 5], 'columns': {'pid': [2, 5], 'name': ['firefox', 'Firefox-bin']}}
+
+
+def test_history_is_left_out_by_default():
+    rows, _, _ = select_processes(RECORDS, **parse_query({'top': '1'}))
+    assert 'historical_data' not in rows[0]
+    rows, _, _ = select_processes(RECORDS, **parse_query({'top': '1', 'history': '1'}))
+    assert rows[0]['historical_data'] == [50.0]
+
+
+@pytest.mark.parametrize('args', [{'top': '0'}, {'top': 'x'}, {'history': 'some'}, {'match': '('},
+                                  {'cursor': '!!'}])
+def test_parse_query_rejects(args):
+    with pytest.raises(ValueError):
+        parse_query(args)
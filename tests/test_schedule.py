@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+from schedule import RuleScheduler, TimerWheel, is_active, next_transition, normalize_rule
+
+
+def test_timer_wheel_fires_in_order():
+    wheel = TimerWheel(tick=1.0, now=0)
+    wheel.add(5, 'b')
+    wheel.add(2, 'a')
+    wheel.add(5, 'c')
+    assert wheel.advance(1) == []
+    assert wheel.advance(10) == [(2.0, ['a']), (5.0, ['b', 'c'])]
+    assert wheel.size == 0
+
+
+def test_timer_wheel_cascades_from_outer_levels():
+    wheel = TimerWheel(tick=1.0, slots=(4, 4), now=0)
+    deadlines = [3, 7, 15, 40]  # level 0, level 1 and past the whole wheel
+    for deadline in deadlines:
+        wheel.add(deadline, deadline)
+    fired = wheel.advance(100)
+    assert [when for when, _ in fired] == deadlines
+    assert [items for _, items in fired] == [[deadline] for deadline in deadlines]
+
+
+def test_timer_wheel_rounds_up_to_the_next_tick():
+    wheel = TimerWheel(tick=1.0, now=10)
+    wheel.add(3, 'past')  # already due: fires on the next tick
+    wheel.add(12.5, 'later')
+    assert wheel.advance(11) == [(11.0, ['past'])]
+    assert wheel.advance(12) == []
+    assert wheel.advance(13) == [(13.0, ['later'])]
+
+
+def at(hour, minute=0):
+    return datetime.datetime(2024, 1, 1, hour, minute).timestamp()  # a Monday
+
+
+def test_normalize_rule_checks_input():
+    rule = normalize_rule({'action': 'block', 'name': 'steam', 'start': '09:00'})
+    assert len(rule['id']) == 8
+    assert (rule['start'], rule['end']) == ('09:00', '00:00')
+    with pytest.raises(ValueError):
+        normalize_rule({'action': 'drop', 'name': 'steam'})
+    with pytest.raises(ValueError):
+        normalize_rule({'action': 'limit', 'name': 'steam'})
+    with pytest.raises(ValueError):
+        normalize_rule({'action': 'block'})
+
+
+def test_windows_and_transitions():
+    rule = normalize_rule({'action': 'block', 'name': 'steam', 'days': ['mon'], 'start': '09:00', 'end': '17:00'})
+    assert not is_active(rule, at(8))
+    assert is_active(rule, at(9))
+    assert not is_active(rule, at(17))
+    assert next_transition(rule, at(8)) == (at(9), True)
+    assert next_transition(rule, at(12)) == (at(17), False)
+
+
+def test_overnight_window():
+    rule = normalize_rule({'action': 'block', 'pid': 1, 'start': '22:00', 'end': '06:00'})
+    assert is_active(rule, at(23))
+    assert is_active(rule, at(5))
+    assert not is_active(rule, at(12))
+
+
+def test_scheduler_applies_transitions_in_batches():
+    batches = []
+    scheduler = RuleScheduler(batches.append)
+    rule = normalize_rule({'action': 'block', 'pid': 1, 'start': '00:00', 'end': '00:00'})
+    scheduler.set_rules([rule])
+    assert batches == [[(rule, True)]]
+    scheduler.set_rules([])
+    assert batches[-1] == [(rule, False)]
@@ -0,0 +1,217 @@
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+import shaping
+from shaping import CgroupClassifier, FairShareController, SimulatedShaper, TcShaper, max_min_shares
+
+
+# Stands in for subprocess.run: records every command, answers with canned output per command prefix
+class FakeRun:
+    def __init__(self):
+        self.calls = []
+        self.outputs = {}  # command prefix tuple -> stdout
+        self.delay = 0
+        self.failing = set()  # command prefix tuples that exit 1
+
+    def __call__(self, args, input=None, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        self.calls.append((list(args), input))
+        stdout = next((out for prefix, out in self.outputs.items() if tuple(args[:len(prefix)]) == prefix), '')
+        failed = any(tuple(args[:len(prefix)]) == prefix for prefix in self.failing)
+        return subprocess.CompletedProcess(args, 1 if failed else 0, stdout, '')
+
+    def commands(self, *prefix):
+        return [args for args, _ in self.calls if tuple(args[:len(prefix)]) == prefix]
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    fake = FakeRun()
+    monkeypatch.setattr(shaping.subprocess, 'run', fake)
+    monkeypatch.setattr(shaping, 'NET_CLS_ROOT', str(tmp_path / 'net_cls'))  # missing: mark mode
+    monkeypatch.setattr(shaping, 'CGROUP2_ROOT', str(tmp_path / 'cgroup'))
+    monkeypatch.setattr(shaping, 'classifier', None)
+    return fake
+
+
+def test_set_limit_creates_updates_and_removes_a_class(run):
+    shaper = TcShaper('eth9')
+    shaper.set_limit('web', [101, 102], 1000)
+    added = run.commands('tc', 'class', 'add')
+    assert len(added) == 1 and 'classid' in added[0] and '1:2' in added[0] and '8000bit' in added[0]
+    assert len(run.commands('tc', 'filter', 'add')) == 1  # mark mode: one fw filter per class
+    assert shaper.classifier.members() == {'web': {101, 102}}
+
+    shaper.set_limit('web', [101, 102], 1000)
+    assert len(run.commands('tc', 'class', 'add')) == 1 and not run.commands('tc', 'class', 'change')
+    shaper.set_limit('web', [101, 102], 2000)
+    assert '16000bit' in run.commands('tc', 'class', 'change')[-1]
+
+    shaper.remove('web')
+    assert run.commands('tc', 'class', 'del')
+    assert shaper.classifier.members() == {}
+    assert len(run.commands('iptables', '-t', 'mangle', '-D')) == 2  # mark and count rules
+
+
+def test_read_counters(run):
+    shaper = TcShaper('eth9')
+    shaper.set_limit('web', [101], 1000)
+    run.outputs[('tc', '-s', 'class', 'show')] = (
+        "class htb 1:1 root rate 10Gbit\n Sent 999 bytes 9 pkt (dropped 0, overlimits 0)\n"
+        "class htb 1:2 parent 1:1 prio 0 rate 8Kbit\n Sent 1500 bytes 3 pkt (dropped 2, overlimits 5)\n")
+    assert shaper.read_counters() == {'web': {'bytes': 1500, 'packets': 3, 'dropped': 2}}
+
+
+def test_concurrent_acquires_get_distinct_minors(run):
+    run.delay = 0.001  # widen the window between picking a minor and recording it
+    classifier = CgroupClassifier()
+    minors = []
+    threads = [threading.Thread(target=lambda n=n: minors.append(classifier.acquire(f"g{n}", [n], 'egress')))
+               for n in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(minors) == list(range(2, 22))
+
+
+def test_release_returns_processes_to_their_cgroup(run, tmp_path):
+    classifier = CgroupClassifier()
+    origin = tmp_path / 'cgroup' / 'user.slice'
+    origin.mkdir(parents=True)
+    classifier._origin = lambda pid: str(origin)
+    classifier.acquire('web', [101], 'egress')
+    classifier.acquire('web', [101], 'ingress')
+    classifier.release('web', 'egress')
+    assert 'web' in classifier.members()  # the ingress shaper still uses it
+    classifier.release('web', 'ingress')
+    assert (origin / 'cgroup.procs').read_text() == '101'
+    assert classifier.members() == {}
+
+
+def test_ingress_shapes_on_the_ifb_with_restored_connmarks(run):
+    shaper = TcShaper('eth9', direction='ingress')
+    shaper.set_limit('web', [101], 1000)
+    assert ['ip', 'link', 'add', 'ifb-waterwall', 'type', 'ifb'] in run.commands('ip')
+    redirect = run.commands('tc', 'filter', 'replace', 'dev', 'eth9', 'parent', 'ffff:')[0]
+    assert 'connmark' in redirect and redirect[-2:] == ['dev', 'ifb-waterwall']
+    assert run.commands('tc', 'class', 'add', 'dev', 'ifb-waterwall')
+    assert run.commands('tc', 'filter', 'add', 'dev', 'ifb-waterwall')  # fw filter on the restored mark
+    assert not run.commands('tc', 'class', 'add', 'dev', 'eth9')
+
+    shaper.cleanup()
+    assert ['tc', 'qdisc', 'del', 'dev', 'eth9', 'ingress'] in run.commands('tc')
+    assert ['ip', 'link', 'del', 'ifb-waterwall'] in run.commands('ip')
+
+
+def test_both_directions_share_one_cgroup_and_count_replies(run):
+    egress, ingress = TcShaper('eth9'), TcShaper('eth9', direction='ingress')
+    egress.set_limit('web', [101], 1000)
+    ingress.set_limit('web', [101], 4000)
+    assert egress.classes['web']['minor'] == ingress.classes['web']['minor']
+    run.outputs[('iptables-save',)] = (
+        '[3:300] -A OUTPUT -m cgroup --path waterwall/web -m comment --comment "waterwall:shape:web" -j MARK\n'
+        '[9:9000] -A INPUT -m connmark --mark 22274 -m comment --comment "waterwall:shape-in:web"\n')
+    ingress.read_observed(0)
+    run.outputs[('iptables-save',)] = run.outputs[('iptables-save',)].replace('9:9000', '19:13000')
+    assert ingress.read_observed(2) == {'web': 2000}
+    egress.remove('web')
+    assert ingress.classifier.members() == {'web': {101}}  # still held by the ingress class
+
+
+def test_priorities_are_applied_in_one_restore(run):
+    shaper = TcShaper('eth9')
+    shaper.set_priorities({'1': ([1], 'interactive'), '2': ([2], 'bulk'), '3': ([3], 'normal')})
+    assert shaper.priority_mode == 'cake'
+    restores = [script for args, script in run.calls if args[0] == 'iptables-restore']
+    assert len(restores) == 1
+    assert restores[0].count('-A OUTPUT') == 2 and '--set-dscp-class' in restores[0]
+    assert set(shaper.classifier.members()) == {'1', '2'}
+
+    shaper.set_priorities({'1': ([1], 'normal')})
+    assert '-D OUTPUT' in [script for args, script in run.calls if args[0] == 'iptables-restore'][-1]
+    assert set(shaper.classifier.members()) == {'2'}
+
+
+def test_priorities_fall_back_to_prio_bands_without_cake(run):
+    run.failing.add(('tc', 'qdisc', 'replace', 'dev', 'eth9', 'parent', '1:ffff', 'handle', '10:', 'cake'))
+    shaper = TcShaper('eth9')
+    shaper.set_priorities({'1': ([1], 'interactive')})
+    assert shaper.priority_mode == 'prio'
+    assert len(run.commands('tc', 'qdisc', 'replace', 'dev', 'eth9', 'parent', '10:1')) == 1  # fq_codel per band
+    script = [script for args, script in run.calls if args[0] == 'iptables-restore'][0]
+    assert '--set-class 10:' in script
+
+
+def test_max_min_shares_fills_small_demands_first():
+    shares = max_min_shares({'a': 100, 'b': 1000, None: 50}, {'a': 1, 'b': 1, None: 1}, 600)
+    assert shares == {'a': 100, 'b': 450, None: 50}
+
+
+def fair_share(**kwargs):
+    controller = FairShareController(SimulatedShaper(), interval=1, headroom=1, hysteresis=0, min_rate=10, **kwargs)
+    controller.configure(enabled=True)
+    return controller
+
+
+def test_fair_share_demand_comes_from_class_counters():
+    controller = fair_share()
+    processes = [(1, 'backup'), (2, 'browser')]
+    controller.tick(processes, {}, 1000, now=0)
+    assert controller.stats()['measured'] == {'backup': None, 'browser': None}  # not measured yet
+    controller.tick(processes, {'fair-backup': {'bytes': 0}, 'fair-browser': {'bytes': 0}}, 1000, now=1)
+    controller.tick(processes, {'fair-backup': {'bytes': 900}, 'fair-browser': {'bytes': 50}}, 1000, now=2)
+    stats = controller.stats()
+    assert stats['measured'] == {'backup': 900, 'browser': 50}
+    assert stats['groups']['backup'] > stats['groups']['browser']
+    assert controller.shaper.classes['fair-backup']['pids'] == {1}
+
+
+def test_fair_share_drops_idle_and_exited_groups():
+    controller = fair_share(idle_runs=2)
+    controller.tick([(1, 'idle'), (2, 'gone')], {}, 1000, now=0)
+    for now in (1, 2, 3):
+        controller.tick([(1, 'idle')], {'fair-idle': {'bytes': 0}}, 1000, now=now)
+    assert 'fair-gone' not in controller.shaper.classes
+    assert 'fair-idle' not in controller.shaper.classes
+    controller.tick([(1, 'idle')], {}, 1000, now=4)
+    assert controller.stats()['groups'] == {}  # dormant for a few runs before it is tried again
+
+
+def test_limit_feedback_pulls_an_overshooting_class_down():
+    feedback = shaping.LimitFeedback(SimulatedShaper())
+    feedback.set_target('7', [7], 1000)
+    feedback.tick({'7': {'bytes': 0}}, {}, 0)
+    feedback.tick({'7': {'bytes': 1500}}, {}, 1)
+    status = feedback.status('7')
+    assert status['measured'] == 1500 and status['status'] == 'converging'
+    assert status['command'] < 1000 and status['burst'] is not None
+    assert feedback.shaper.classes['7']['rate'] == status['command']
+
+
+def test_limit_feedback_flags_traffic_that_bypasses_the_class():
+    feedback = shaping.LimitFeedback(SimulatedShaper(), escape_ticks=3)
+    feedback.set_target('7', [7], 1000)
+    for now in range(4):
+        feedback.tick({'7': {'bytes': now * 1000}}, {'7': 5000}, now)
+    assert feedback.status('7')['status'] == 'unenforceable'
+
+
+def test_limit_feedback_prunes_exited_groups_and_locks_every_method():
+    feedback = shaping.LimitFeedback(SimulatedShaper())
+    feedback.set_target('7', [7], 1000)
+    feedback.set_target('8', [8], 2000)
+    feedback.prune({8})
+    assert feedback.targets() == {'8': 2000}
+    assert '7' not in feedback.shaper.classes
+    feedback.lock.acquire()  # the sampler mid-tick: a request thread must wait for it
+    done = threading.Event()
+    threading.Thread(target=lambda: (feedback.set_target('9', [9], 500), done.set()), daemon=True).start()
+    assert not done.wait(0.1)
+    feedback.lock.release()
+    assert done.wait(1) and feedback.targets() == {'8': 2000, '9': 500}
@@ -0,0 +1,193 @@
+import json
+import math
+import struct
+
+from stream import NO_VALUE, SERIES_REPLACE, Broadcaster, binary_frame, compose_deltas, diff_records
+
+SERIES = ('history',)
+MAX_LENGTH = 3
+
+
+# What a client does with a delta: drop, add, update fields, append points and keep the last MAX_LENGTH
+def apply_delta(table, delta):
+    table = {key: dict(record) for key, record in table.items() if key not in delta['removed']}
+    for record in delta['added']:
+        table[record['pid']] = dict(record)
+    for key, fields in delta['changed'].items():
+        table[key].update(fields)
+    for key, series in delta['appended'].items():
+        for field, points in series.items():
+            table[key][field] = (table[key].get(field, []) + points)[-MAX_LENGTH:]
+    return table
+
+
+def record(pid, rate, history):
+    return {'pid': pid, 'rate': rate, 'history': history}
+
+
+def delta(seq, previous, current):
+    return {'seq': seq, 'base': seq - 1, **diff_records(previous, current, SERIES, MAX_LENGTH)}
+
+
+def check(*tables):
+    tables = [{r['pid']: r for r in table} for table in tables]
+    first = delta(1, tables[0], tables[1])
+    second = delta(2, tables[1], tables[2])
+    composed = compose_deltas(first, second, 'pid', MAX_LENGTH)
+    assert (composed['seq'], composed['base']) == (2, 0)
+    assert apply_delta(tables[0], composed) == tables[2]
+    return composed
+
+
+def test_changes_and_appends_compose():
+    composed = check([record(1, 0.0, [1]), record(2, 5.0, [1, 2])],
+                     [record(1, 1.0, [1, 2]), record(2, 5.0, [1, 2, 3])],
+                     [record(1, 2.0, [1, 2, 3]), record(2, 6.0, [2, 3, 4])])
+    assert composed['changed'] == {1: {'rate': 2.0}, 2: {'rate': 6.0}}
+    assert composed['appended'] == {1: {'history': [2, 3]}, 2: {'history': [3, 4]}}
+
+
+def test_added_then_changed_stays_added():
+    composed = check([record(1, 0.0, [])],
+                     [record(1, 0.0, []), record(2, 1.0, [7])],
+                     [record(1, 0.0, []), record(2, 3.0, [7, 8])])
+    assert composed['added'] == [record(2, 3.0, [7, 8])]
+    assert composed['changed'] == {}
+
+
+def test_added_then_removed_disappears():
+    composed = check([record(1, 0.0, [])],
+                     [record(1, 0.0, []), record(2, 1.0, [])],
+                     [record(1, 0.0, [])])
+    assert composed['added'] == [] and composed['removed'] == []
+
+
+def test_removed_then_readded():
+    composed = check([record(1, 0.0, [1, 2])],
+                     [],
+                     [record(1, 9.0, [5])])
+    assert composed['removed'] == [1]
+    assert composed['added'] == [record(1, 9.0, [5])]
+
+
+def test_series_replaced_then_appended():
+    check([record(1, 0.0, [1, 2])],
+          [record(1, 0.0, [9])],  # not an append: sent whole
+          [record(1, 0.0, [9, 10])])
+
+
+def broadcaster(**kwargs):
+    return Broadcaster(series=SERIES, max_length=MAX_LENGTH, **kwargs)
+
+
+def publish_rates(stream, *rates):
+    for rate in rates:
+        stream.publish([record(1, rate, [])])
+
+
+# (event type, id, data) of one SSE frame
+def parse_event(frame):
+    fields = dict(line.split(': ', 1) for line in frame.decode().strip().split('\n'))
+    return fields.get('event'), fields.get('id'), json.loads(fields['data'])
+
+
+def test_resume_replays_the_missed_deltas():
+    stream = broadcaster()
+    publish_rates(stream, 1.0, 2.0, 3.0)
+    subscriber = stream.subscribe(stream.event_id(1))
+    events = [parse_event(subscriber.get(0)) for _ in range(2)]
+    assert [(kind, event_id) for kind, event_id, _ in events] == [('delta', stream.event_id(2)),
+                                                                  ('delta', stream.event_id(3))]
+    assert events[1][2]['changed'] == {'1': {'rate': 3.0}}
+    assert subscriber.get(0) is None
+    assert stream.counts()['replayed'] == 2
+
+
+def test_resume_up_to_date_gets_no_catch_up():
+    stream = broadcaster()
+    publish_rates(stream, 1.0)
+    assert stream.subscribe(stream.event_id(1)).get(0) is None
+
+
+def test_resume_outside_the_window_or_from_another_run_resyncs():
+    stream = broadcaster(replay=2)
+    publish_rates(stream, 1.0, 2.0, 3.0, 4.0)
+    for event_id in (stream.event_id(1), 'deadbeef-3', 'garbage'):
+        kind, event_id, data = parse_event(stream.subscribe(event_id).get(0))
+        assert kind == 'snapshot' and event_id == stream.event_id(4)
+        assert data['records'] == [record(1, 4.0, [])]
+    assert stream.counts()['resyncs'] == 3
+
+
+def test_slow_subscriber_gets_collapsed_deltas_with_an_unbroken_sequence():
+    stream = broadcaster(max_queue=2)
+    publish_rates(stream, 1.0)
+    subscriber = stream.subscribe(stream.event_id(1))
+    publish_rates(stream, 2.0, 3.0, 4.0, 5.0, 6.0)
+    events = []
+    while (frame := subscriber.get(0)) is not None:
+        events.append(parse_event(frame)[2])
+    assert len(events) < 5
+    assert events[0]['base'] == 1 and events[-1]['seq'] == 6
+    assert all(later['base'] == earlier['seq'] for earlier, later in zip(events, events[1:]))
+    assert events[-1]['changed'] == {'1': {'rate': 6.0}}
+    assert subscriber.stats(stream.seq)['collapsed'] > 0
+
+
+def test_overflow_behind_a_snapshot_sends_one_fresh_snapshot():
+    stream = broadcaster(max_queue=2)
+    subscriber = stream.subscribe()  # starts with a snapshot queued
+    publish_rates(stream, 1.0, 2.0, 3.0)
+    kind, event_id, data = parse_event(subscriber.get(0))
+    assert kind == 'snapshot' and event_id == stream.event_id(3)
+    assert data['records'] == [record(1, 3.0, [])]
+    assert subscriber.get(0) is None
+
+
+# What the browser does with a binary frame: the header, then typed array views over the body
+def decode_frame(frame):
+    (length,) = struct.unpack_from('<I', frame)
+    header = json.loads(frame[4:4 + length])
+    offset = 4 + length
+    assert offset % 4 == 0
+
+    def read(kind, count):
+        nonlocal offset
+        values = list(struct.unpack_from(f'<{count}{kind}', frame, offset))
+        offset += 4 * count
+        return values
+
+    rows = header['rows']
+    keys = read('I', rows)
+    columns = {name: read('I' if kind == 'u32' else 'f', rows) for name, kind in header['columns']}
+    series = {}
+    for name, total in header['series']:
+        series[name] = (read('I', rows), read('f', total))
+    assert offset == len(frame)
+    return header, keys, columns, series
+
+
+def test_binary_snapshot_packs_numbers_and_keeps_the_rest_in_the_header():
+    payload = {'seq': 4, 'max_length': MAX_LENGTH,
+               'records': [{'pid': 7, 'rate': 1.5, 'threads': 3, 'name': 'a', 'history': [1.0, 2.0]},
+                           {'pid': 9, 'rate': 0.25, 'threads': None, 'name': 'b', 'history': [3.0]}]}
+    header, keys, columns, series = decode_frame(binary_frame(payload, 'e-4', 'pid', SERIES))
+    assert (header['type'], header['id'], header['added']) == ('snapshot', 'e-4', [7, 9])
+    assert header['fields'] == {'7': {'name': 'a'}, '9': {'name': 'b', 'threads': None}}  # None isn't a number
+    assert keys == [7, 9]
+    assert columns['rate'] == [1.5, 0.25]
+    assert columns['threads'] == [3, NO_VALUE]  # integers go in a uint32 column
+    counts, points = series['history']
+    assert counts == [2 | SERIES_REPLACE, 1 | SERIES_REPLACE] and points == [1.0, 2.0, 3.0]
+
+
+def test_binary_delta_marks_unchanged_values_and_appended_points():
+    previous = {1: record(1, 1.0, [1.0]), 2: record(2, 2.0, [5.0])}
+    current = {1: record(1, 1.5, [1.0, 2.0]), 2: record(2, 2.0, [5.0, 6.0]), 3: record(3, 0.5, [])}
+    header, keys, columns, series = decode_frame(binary_frame(delta(5, previous, current), 'e-5', 'pid', SERIES))
+    assert (header['type'], header['base'], header['added']) == ('delta', 4, [3])
+    rates = dict(zip(keys, columns['rate']))
+    assert rates[1] == 1.5 and rates[3] == 0.5 and math.isnan(rates[2])  # NaN: unchanged
+    counts, points = series['history']
+    assert dict(zip(keys, counts)) == {1: 1, 2: 1, 3: SERIES_REPLACE}
+    assert points == [2.0, 6.0]
@@ -0,0 +1,230 @@
+import contextlib
+import os
+
+import pytest
+
+import waterwall
+from firewall import FirewallError, SimulatedBackend
+
+PID = os.getpid()  # a process that's sure to exist while the tests run
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(waterwall, 'STATE_FILE', str(tmp_path / 'state.json'))
+    monkeypatch.setattr(waterwall, 'firewall', SimulatedBackend())
+    monkeypatch.setattr(waterwall, 'start_sampler', lambda: None)  # the tests publish snapshots themselves
+    monkeypatch.setattr(waterwall, 'scheduled_targets', {})
+    waterwall.publish_snapshot()
+    return waterwall.app.test_client()
+
+
+def test_processes(client):
+    response = client.get('/processes?fields=pid,name&top=5')
+    assert response.status_code == 200
+    assert len(response.json) == 5
+    assert set(response.json[0]) == {'pid', 'name'}
+    assert int(response.headers['X-Total-Count']) >= 5
+
+
+def test_processes_revalidates_with_a_weak_etag(client):
+    etag = client.get('/processes').headers['ETag']
+    assert etag.startswith('W/')
+    assert client.get('/processes', headers={'If-None-Match': etag}).status_code == 304
+    waterwall.publish_snapshot()
+    assert client.get('/processes', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_processes_gzip(client):
+    response = client.get('/processes', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_processes_columnar(client):
+    response = client.get(f'/processes?format=columnar&fields=name&name={waterwall.psutil.Process(PID).name()}')
+    assert PID in response.json['index']
+    assert list(response.json['columns']) == ['name']
+
+
+def test_processes_rejects_bad_queries(client):
+    assert client.get('/processes?top=0').status_code == 400
+    assert client.get('/processes?format=xml').status_code == 400
+
+
+def test_block_and_unblock(client):
+    assert client.post('/block', json={'pid': PID}).status_code == 200
+    assert waterwall.load_state()[str(PID)]['blocked'] is True
+    assert waterwall.firewall.evaluate(PID)[0] == 'DROP'
+    assert client.post('/unblock', json={'pid': PID}).status_code == 200
+    assert waterwall.load_state()[str(PID)]['blocked'] is False
+    assert waterwall.firewall.evaluate(PID)[0] == 'ACCEPT'
+
+
+def test_blocked_process_shows_up_after_the_next_tick(client):
+    client.post('/block', json={'pid': PID})
+    waterwall.firewall.evaluate(PID, size=1000)
+    waterwall.process_cache.clear()
+    waterwall.publish_snapshot()
+    rows = client.get('/processes?fields=pid,blocked,dropped_bytes&top=1000').json
+    assert {'pid': PID, 'blocked': True, 'dropped_bytes': 1000} in rows
+
+
+@pytest.mark.parametrize('fmt', ['binary', 'json', 'xml'])
+def test_process_stream_rejects_formats_it_cannot_send_as_sse(client, fmt):
+    response = client.get(f'/process_stream?format={fmt}')
+    assert response.status_code == 400
+    assert 'sse' in response.json['error']
+
+
+def test_rules_batch(client):
+    response = client.post('/rules/batch', json={'rules': [
+        {'op': 'block', 'pid': PID}, {'op': 'explode', 'pid': PID}]})
+    assert response.status_code == 400  # validated before anything is applied
+    assert waterwall.firewall.stats()['rules'] == 0
+    response = client.post('/rules/batch', json={'rules': [{'op': 'block', 'pids': [PID]}]})
+    assert response.status_code == 200
+    assert response.json['results'][0]['status'] == 'success'
+    assert waterwall.firewall.evaluate(PID)[0] == 'DROP'
+
+
+def test_rules_batch_applies_limits_only_after_the_transaction_commits(client, monkeypatch):
+    @contextlib.contextmanager
+    def rejected():
+        yield waterwall.firewall
+        seen.append(waterwall.limit_feedback.status(PID))  # what the shaper holds when the commit fails
+        raise FirewallError("iptables-restore failed")
+
+    seen = []
+
+    monkeypatch.setattr(waterwall.firewall, 'transaction', rejected)
+    response = client.post('/rules/batch', json={'rules': [
+        {'op': 'block', 'pid': PID}, {'op': 'limit', 'pid': PID, 'percentage': 50}]})
+    assert response.status_code == 500
+    assert [result['status'] for result in response.json['results']] == ['error', 'error']
+    assert seen == [None] and waterwall.limit_feedback.status(PID) is None  # the limit was only queued
+    assert str(PID) not in waterwall.load_state()
+
+    monkeypatch.delattr(waterwall.firewall, 'transaction')  # back to the backend's own
+    client.post('/rules/batch', json={'rules': [{'op': 'limit', 'pid': PID, 'percentage': 50}]})
+    assert waterwall.limit_feedback.status(PID)['target'] > 0
+    client.post('/limit', json={'pid': PID, 'percentage': None})
+
+
+@pytest.mark.parametrize('body', [{}, {'pids': ['x']}, {'pid': PID, 'priority': 'urgent'}, {'pids': 'all'}])
+def test_priority_rejects_bad_input(client, body):
+    assert client.post('/priority', json=body).status_code == 400
+
+
+def test_priority(client):
+    assert client.post('/priority', json={'pids': [PID], 'priority': 'bulk'}).status_code == 200
+    assert waterwall.load_state()[str(PID)]['priority'] == 'bulk'
+    client.post('/priority', json={'pids': [PID], 'priority': 'normal'})
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/limit', {'pid': PID, 'percentage': 50}),
+    ('/limit', {'pid': PID, 'percentage': 50, 'direction': 'download'}),
+    ('/block', {'pid': PID}),
+    ('/unblock', {'pid': PID}),
+])
+def test_rule_changes_keep_the_priority(client, path, body):
+    client.post('/priority', json={'pids': [PID], 'priority': 'interactive'})
+    assert client.post(path, json=body).status_code == 200
+    assert waterwall.load_state()[str(PID)]['priority'] == 'interactive'
+    client.post('/unblock', json={'pid': PID})
+    client.post('/priority', json={'pids': [PID], 'priority': 'normal'})
+
+
+def test_blocklist(client):
+    response = client.post('/blocklist', json={'name': 'feed', 'entries': ['10.0.0.0/25', '10.0.0.128/25']})
+    assert response.json['prefixes'] == 1
+    assert waterwall.firewall.sets['feed-v4'] == {'10.0.0.0/24'}
+
+
+@pytest.mark.parametrize('route', ['/blocklist', '/domain_blocklist'])
+def test_blocklist_names_are_plain_words(client, route):
+    assert client.post(route, json={'name': 'feed\nflush', 'entries': []}).status_code == 400
+
+
+def test_schedules(client):
+    assert client.post('/schedules', json={'action': 'drop', 'name': 'x'}).status_code == 400
+    rule = client.post('/schedules', json={'action': 'block', 'name': 'no-such-process-here'}).json['rule']
+    assert [r['id'] for r in client.get('/schedules').json] == [rule['id']]
+    assert client.delete(f"/schedules/{rule['id']}").status_code == 200
+    assert client.get('/schedules').json == []
+
+
+def test_metrics(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert '# TYPE waterwall_group_read_bytes gauge' in response.text
+
+
+def test_firewall_stats(client):
+    client.post('/block', json={'pid': PID})
+    stats = client.get('/firewall_stats').json
+    assert (stats['backend'], stats['rules']) == ('simulated', 1)
+
+
+def test_blocklist_reports_a_failed_load(client, monkeypatch):
+    def reject(name, networks, family=4):
+        raise FirewallError("ipset restore failed")
+    monkeypatch.setattr(waterwall.firewall, 'sync_set', reject)
+    response = client.post('/blocklist', json={'name': 'feed', 'entries': ['10.0.0.0/8']})
+    assert response.status_code == 500
+    assert response.json['status'] == 'error'
+
+
+def test_scheduled_name_rules_catch_new_processes(client, monkeypatch):
+    monkeypatch.setattr(waterwall, 'scheduled_seen', set())
+    rule = {'id': 'r1', 'action': 'block', 'name': 'no-such-process', 'start': '00:00', 'end': '00:00'}
+    waterwall.apply_scheduled_rules([(rule, True)])
+    processes = [{'pid': PID, 'name': 'python'}]
+    waterwall.enforce_scheduled_rules(processes)
+    assert waterwall.firewall.evaluate(PID)[0] == 'ACCEPT'
+    processes.append({'pid': 999999, 'name': 'No-Such-Process-2'})
+    waterwall.enforce_scheduled_rules(processes)
+    assert waterwall.firewall.evaluate(999999)[0] == 'DROP'
+    assert waterwall.scheduled_targets['r1'][1] == {999999: True}
+    client.post('/unblock', json={'pid': 999999})
+    waterwall.enforce_scheduled_rules(processes)  # known pids aren't matched again
+    assert waterwall.firewall.evaluate(999999)[0] == 'ACCEPT'
+    waterwall.enforce_scheduled_rules(processes[:1])
+    assert waterwall.scheduled_targets['r1'][1] == {}
+    waterwall.apply_scheduled_rules([(rule, False)])
+    assert waterwall.scheduled_targets == {}
+
+
+@pytest.mark.parametrize('route, body', [
+    ('/limit', {'pid': PID, 'percentage': 'abc'}),
+    ('/limit', {'pid': 'notapid', 'percentage': 50}),
+    ('/limit', {'pid': PID, 'percentage': 150}),
+    ('/limit', {'pid': PID, 'percentage': 50, 'direction': 'sideways'}),
+    ('/block', {}),
+    ('/unblock', {'pid': [PID]}),
+    ('/capacity', {'override': 'x'}),
+    ('/capacity', {'override': -5}),
+    ('/schedules', None),
+    ('/schedules', {'action': 'limit', 'name': 'steam', 'percentage': 'lots'}),
+    ('/schedules', {'action': 'block', 'name': 'steam', 'start': 'noon'}),
+    ('/schedules', {'action': 'block', 'name': 'steam', 'days': ['someday']}),
+    ('/schedules', {'action': 'block', 'pid': 'abc'}),
+])
+def test_bad_input_is_a_400(client, route, body):
+    response = client.post(route, json=body)
+    assert response.status_code == 400
+    assert response.json['error']
+
+
+def test_limit(client):
+    assert client.post('/limit', json={'pid': PID, 'percentage': 50}).status_code == 200
+    assert waterwall.load_state()[str(PID)]['limit'] == 50
+    assert waterwall.limit_feedback.status(PID)['target'] > 0
+    assert client.post('/limit', json={'pid': PID, 'percentage': None}).status_code == 200
+    assert waterwall.limit_feedback.status(PID) is None
+
+
+def test_capacity_override(client):
+    response = client.post('/capacity', json={'override': 1000000})
+    assert response.json['override'] == 1000000
+    assert client.post('/capacity', json={'override': None}).json['override'] is None
@@ -1,33 +1,97 @@
 import os
-import subprocess
 import json
 import webbrowser
 from flask import Flask, request, jsonify, Response
 import logging
 import psutil
 import time
-from pynput import mouse, keyboard
 import random
+import re
+import asyncio
+import signal
+import threading
+from array import array
 from collections import deque
+from firewall import create_backend, rule_comment, limit_to_bytes, FirewallError
+from shaping import create_shaper, default_interface, FairShareController, LimitFeedback, PRIORITIES
+from capacity import CapacityEstimator, override_from_env
+from blocklist import parse_entries, load_feed, import_blocklist
+from dnsblock import DomainBlocklist, DomainResolver
+from schedule import RuleScheduler, normalize_rule
+from stream import Broadcaster, sse_format
+from query import parse_query, select_processes, select_columns
+from responses import ResponseCache
+from metrics import MetricsRenderer, DEFAULT_TOP, family, summary
+from aioserver import AsyncServer
+from control import ControlServer, DEFAULT_SOCKET
+try:
+    from flask_sock import Sock
+except ImportError:  # the binary WebSocket stream is optional, /process_stream works without it
+    Sock = None
+try:
+    from pynput import mouse, keyboard
+except ImportError:  # no pynput, or no display to listen on: the user just never counts as away
+    mouse = keyboard = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+sock = Sock(app) if Sock else None
 
 # File to store the state
 STATE_FILE = 'waterwall_state.json'
 
+# Load the state from the file
+def load_state():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    return {}
+
+# Save the state to the file. The changed flags reach /processes and the streams with the next sampler tick;
+# rebuilding and broadcasting the whole table on every rule change would cap rule changes at a few per second.
+def save_state(state):
+    with open(STATE_FILE, 'w') as f:
+        json.dump(state, f)
+
 # Global variables
 last_activity_time = time.time()
 idle_threshold = 5  # Consider user away if no activity for 5 seconds
 intervalTime = 2000  # Reduced default refresh interval for faster updates
 process_cache = {}  # Cache to store process information and reduce query overhead
+sampler_lock = threading.Lock()
+sampler_thread = None  # background thread producing one snapshot per interval for all stream clients
 graph_refresh_enabled = True  # Flag to control graph refreshing
 historical_data = {}  # Store historical data for each process
+last_traffic = {}  # pid -> (timestamp, read bytes, written bytes) from the previous sample
 max_history_length = 60  # Keep 60 data points (e.g., 2 minutes of data with 2-second intervals)
 total_bandwidth_usage = 0  # Keep track of total bandwidth usage
+broadcaster = Broadcaster(max_length=max_history_length)
+snapshot = {'generation': 0, 'processes': None}  # latest sampler output
+snapshot_lock = threading.Lock()
+response_cache = ResponseCache()  # serialized (and gzipped) /processes bodies per generation and view
+state_lock = threading.RLock()  # one read-modify-write of the state file at a time, in every route and the socket
+sampler_timing = {'samples': 0, 'sample_seconds': 0.0, 'publishes': 0, 'publish_seconds': 0.0, 'last_publish': 0.0}
+metrics_renderer = MetricsRenderer(int(os.environ.get('WATERWALL_METRICS_TOP', DEFAULT_TOP)))
+firewall = create_backend()  # iptables by default, WATERWALL_BACKEND=simulated runs without root
+rule_counters = {}  # rule comment -> (packets, bytes), read once per sampler tick
+shaper = create_shaper()  # tc HTB classes that actually enforce /limit
+shaper_counters = {}  # shaping group -> class counters, read once per sampler tick
+limit_feedback = LimitFeedback(shaper)
+fair_share = FairShareController(shaper)
+fair_share.configure(**load_state().get('fair_share', {}))
+capacity = CapacityEstimator(getattr(shaper, 'uplink', None) or default_interface(),
+                             load_state().get('capacity_override') or override_from_env())
+ingress_shaper = create_shaper(direction='ingress')  # download limits, via an IFB device
+download_counters = {}
+download_feedback = LimitFeedback(ingress_shaper)
+download_capacity = CapacityEstimator(capacity.iface,
+                                      load_state().get('download_capacity_override')
+                                      or override_from_env('WATERWALL_DOWNLINK_CAPACITY'),
+                                      direction='rx')
+domain_blocklists = {}  # name -> DomainBlocklist kept fresh in the background
 
 # Wow factor: Inspiring quotes
 quotes = [
@@ -50,56 +114,297 @@ def check_root():
         logger.error("To preserve your aliases, run the script with: sudo -E python waterwall.py")
         exit(1)
 
-# Load the state from the file
-def load_state():
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-# Save the state to the file
-def save_state(state):
-    with open(STATE_FILE, 'w') as f:
-        json.dump(state, f)
-
 # Get a list of all running processes
 def get_processes():
-    global process_cache, historical_data, total_bandwidth_usage
-    current_time = time.time()
-    if not process_cache or current_time - process_cache['timestamp'] > 1:  # Refresh cache every 1 second
-        process_cache = {'timestamp': current_time, 'processes': []}
-        total_bandwidth_usage = 0
-        for p in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent', 'num_threads', 'io_counters']):
-            try:
-                process_info = p.info
-                pid = process_info['pid']
-                io_counters = process_info['io_counters']
-                traffic_usage = io_counters.read_bytes + io_counters.write_bytes if io_counters else 0
-                traffic_usage_mb = traffic_usage / (1024 * 1024)
-
-                # Update historical data
-                if pid not in historical_data:
-                    historical_data[pid] = deque(maxlen=max_history_length)
-                historical_data[pid].append(traffic_usage_mb)
+    with sampler_lock:  # the sampler thread and request threads share one cache
+        current_time = time.time()
+        if not process_cache or current_time - process_cache['timestamp'] > 1:  # Refresh cache every 1 second
+            refresh_processes(current_time)
+            sampler_timing['samples'] += 1
+            sampler_timing['sample_seconds'] += time.time() - current_time
+        return process_cache['processes']
+
+# Sample every process once and run the per-tick readouts and controllers
+def refresh_processes(current_time):
+    global process_cache, historical_data, total_bandwidth_usage, rule_counters, shaper_counters, download_counters
+    process_cache = {'timestamp': current_time, 'processes': [], 'columns': new_sample_columns()}
+    columns = process_cache['columns']
+    total_bandwidth_usage = 0
+    rule_counters = firewall.read_counters()  # one dump for all rules, not one call per process
+    shaper_counters = shaper.read_counters()
+    download_counters = ingress_shaper.read_counters()
+    upload_moved = capacity.update(capped=fair_share.enabled)  # fair sharing caps the uplink below capacity
+    download_moved = download_capacity.update()
+    if upload_moved or download_moved:
+        reapply_limits()
+    sampled = set()
+    for p in psutil.process_iter(['pid', 'name', 'exe', 'cpu_percent', 'memory_percent', 'num_threads', 'io_counters']):
+        try:
+            process_info = p.info
+            pid = process_info['pid']
+            io_counters = process_info['io_counters']
+            received, sent = (io_counters.read_bytes, io_counters.write_bytes) if io_counters else (0, 0)
+            traffic_usage = received + sent
+            traffic_usage_mb = traffic_usage / (1024 * 1024)
+            previous = last_traffic.get(pid)
+            if previous and current_time > previous[0]:
+                rx_rate = max(received - previous[1], 0) / (current_time - previous[0])
+                tx_rate = max(sent - previous[2], 0) / (current_time - previous[0])
+            else:
+                rx_rate = tx_rate = 0.0
+            process_info['rate'] = rx_rate + tx_rate
+            last_traffic[pid] = (current_time, received, sent)
+
+            # Update historical data
+            if pid not in historical_data:
+                historical_data[pid] = deque(maxlen=max_history_length)
+            historical_data[pid].append(traffic_usage_mb)
+
+            process_cache['processes'].append(process_info)
+            sampled.add(pid)
+            total_bandwidth_usage += traffic_usage_mb
+            for field in SAMPLED_FIELDS:
+                columns[field].append(process_info[field])
+            columns['traffic_usage'].append(traffic_usage)
+            columns['rx_bytes'].append(received)
+            columns['tx_bytes'].append(sent)
+            columns['rx_rate'].append(rx_rate)
+            columns['tx_rate'].append(tx_rate)
 
-                process_cache['processes'].append(process_info)
-                total_bandwidth_usage += traffic_usage_mb
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+    for pid in [pid for pid in last_traffic if pid not in sampled]:  # exited since the last tick
+        del last_traffic[pid]
+        historical_data.pop(pid, None)
+    alive = set(psutil.pids())  # not `sampled`: a process we failed to read once keeps its limit
+    limit_feedback.prune(alive)
+    download_feedback.prune(alive)
+    limit_feedback.tick(shaper_counters, shaper.read_observed(current_time), current_time)
+    download_feedback.tick(download_counters, ingress_shaper.read_observed(current_time), current_time)
+    run_fair_share(process_cache['processes'], current_time)
+
+# The sampler also keeps every tick column by column: one array (or list, where psutil may give None) per field
+SAMPLED_FIELDS = ('pid', 'name', 'exe', 'cpu_percent', 'memory_percent', 'num_threads', 'rate')
+
+def new_sample_columns():
+    return {'pid': array('q'), 'name': [], 'exe': [], 'cpu_percent': [], 'memory_percent': [], 'num_threads': [],
+            'rate': array('d'), 'traffic_usage': array('q'), 'rx_bytes': array('q'), 'tx_bytes': array('q'),
+            'rx_rate': array('d'), 'tx_rate': array('d')}
+
+# Column-per-field equivalent of build_process_info() for a whole sample, without building a dict per row
+def build_columns(sample, state):
+    pids = sample['pid']
+    entries = [state.get(str(pid), {}) for pid in pids]
+    dropped = [rule_counters.get(rule_comment('block', pid), (0, 0)) for pid in pids]
+    limited = [shaper_counters.get(str(pid), {}) for pid in pids]
+    return {
+        **{field: sample[field] for field in SAMPLED_FIELDS},
+        **{field: sample[field] for field in ('traffic_usage', 'rx_bytes', 'tx_bytes', 'rx_rate', 'tx_rate')},
+        'traffic_usage_mb': array('d', (traffic / (1024 * 1024) for traffic in sample['traffic_usage'])),
+        'blocked': [entry.get('blocked', False) for entry in entries],
+        'limit': [entry.get('limit', None) for entry in entries],
+        'dropped_packets': [counters[0] for counters in dropped],
+        'dropped_bytes': [counters[1] for counters in dropped],
+        'limited_packets': [counters.get('packets', 0) for counters in limited],
+        'limited_bytes': [counters.get('bytes', 0) for counters in limited],
+        'limited_dropped': [counters.get('dropped', 0) for counters in limited],
+        'limit_status': [limit_feedback.status(pid) for pid in pids],
+        'download_limit': [entry.get('download_limit', None) for entry in entries],
+        'download_limit_status': [download_feedback.status(pid) for pid in pids],
+        'priority': [entry.get('priority', 'normal') for entry in entries],
+        'scheduled': [entry.get('scheduled', []) for entry in entries],
+        'historical_data': [tuple(historical_data.get(pid, ())) for pid in pids],
+    }
 
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                pass
-    return process_cache['processes']
+# Re-divide the uplink between apps with network sockets; the controller measures each app's demand from its
+# own class byte counter. Pids that already have a class of their own (upload or download limits, manual or
+# scheduled, and priorities) are left alone: moving them into a fair-<name> cgroup would stop their marks and
+# rules from matching.
+def run_fair_share(processes, current_time):
+    if not fair_share.due():
+        return
+    state = load_state()
+    excluded = set(limit_feedback.targets()) | set(download_feedback.targets())
+    excluded |= {key for key, entry in state.items() if key.isdigit() and entry.get('priority', 'normal') != 'normal'}
+    classifier = getattr(shaper, 'classifier', None)
+    if classifier is not None:
+        excluded |= {str(pid) for group, pids in classifier.members().items() if not group.startswith('fair-')
+                     for pid in pids}
+    try:
+        connected = {conn.pid for conn in psutil.net_connections('inet') if conn.pid}
+    except psutil.AccessDenied:  # without the privileges to list sockets, every process is a candidate
+        connected = {p['pid'] for p in processes}
+    reserved = sum(limit_feedback.targets().values())
+    candidates = ((p['pid'], p['name']) for p in processes if p['pid'] in connected and str(p['pid']) not in excluded)
+    fair_share.tick(candidates, shaper_counters, capacity.current, reserved, current_time)
+
+# Flatten a sampled process into the dict served by the API
+def build_process_info(p, state):
+    pid = p['pid']
+    io_counters = p['io_counters']
+    traffic_usage = io_counters.read_bytes + io_counters.write_bytes if io_counters else 0
+    dropped = rule_counters.get(rule_comment('block', pid), (0, 0))
+    limited = shaper_counters.get(str(pid), {})
+    return {
+        'pid': pid,
+        'name': p['name'],
+        'exe': p.get('exe'),
+        'cpu_percent': p['cpu_percent'],
+        'memory_percent': p['memory_percent'],
+        'num_threads': p['num_threads'],
+        'traffic_usage': traffic_usage,
+        'traffic_usage_mb': traffic_usage / (1024 * 1024),
+        'rate': p.get('rate', 0.0),
+        'blocked': state.get(str(pid), {}).get('blocked', False),
+        'limit': state.get(str(pid), {}).get('limit', None),
+        'dropped_packets': dropped[0],
+        'dropped_bytes': dropped[1],
+        'limited_packets': limited.get('packets', 0),
+        'limited_bytes': limited.get('bytes', 0),
+        'limited_dropped': limited.get('dropped', 0),
+        'limit_status': limit_feedback.status(pid),
+        'download_limit': state.get(str(pid), {}).get('download_limit', None),
+        'download_limit_status': download_feedback.status(pid),
+        'priority': state.get(str(pid), {}).get('priority', 'normal'),
+        'scheduled': state.get(str(pid), {}).get('scheduled', []),
+        'historical_data': list(historical_data.get(pid, []))
+    }
 
-# Network Management Functions (using iptables)
+# Network Management Functions (delegated to the firewall backend)
 def block_process(pid):
-    subprocess.run(["iptables", "-A", "OUTPUT", "-m", "owner", "--uid-owner", str(pid), "-j", "DROP"])
+    firewall.block(pid)
 
 def unblock_process(pid):
-    subprocess.run(["iptables", "-D", "OUTPUT", "-m", "owner", "--uid-owner", str(pid), "-j", "DROP"])
+    firewall.unblock(pid)
 
+# Limits are enforced by a tc class per process group; the pid's cgroup carries its children along
 def set_traffic_limit(pid, percentage):
-    # Calculate bandwidth limit in bytes per second
-    bandwidth_limit = int(1024 * 1024 * percentage / 100) 
-    subprocess.run(["iptables", "-A", "OUTPUT", "-m", "owner", "--uid-owner", str(pid), "-m", "limit", "--limit-bytes", str(bandwidth_limit)+"/s", "-j", "ACCEPT"])
+    limit_feedback.set_target(str(pid), [int(pid)], limit_to_bytes(percentage, capacity.current))
+
+def remove_traffic_limit(pid):
+    limit_feedback.remove(str(pid))
+
+# Download limits use the same cgroup, classified on the IFB device by the restored connmark
+def set_download_limit(pid, percentage):
+    download_feedback.set_target(str(pid), [int(pid)], limit_to_bytes(percentage, download_capacity.current))
+
+def remove_download_limit(pid):
+    download_feedback.remove(str(pid))
+
+# Re-rate every limited process after the capacity estimate moved
+def reapply_limits():
+    for key, entry in load_state().items():
+        if not key.isdigit():
+            continue
+        if entry.get('limit') is not None:
+            set_traffic_limit(key, entry['limit'])
+        if entry.get('download_limit') is not None:
+            set_download_limit(key, entry['download_limit'])
+
+# Match a scheduled rule against running processes, by pid or case-insensitive name substring
+def match_processes(rule, names):
+    if rule.get('pid'):
+        return [int(rule['pid'])]
+    needle = rule['name'].lower()
+    return [pid for pid, name in names if needle in name]
+
+def running_names():
+    return [(p.info['pid'], (p.info['name'] or '').lower()) for p in psutil.process_iter(['pid', 'name'])]
+
+# Active scheduled rules: rule id -> (rule, {pid: True while the rule holds it, False once the user overrode it})
+scheduled_targets = {}
+
+def held_by_schedule(pid, action):
+    return any(rule['action'] == action and targets.get(pid) for rule, targets in scheduled_targets.values())
+
+# A manual unblock or limit removal wins over an active schedule until its next window
+def override_schedules(pid, action):
+    for rule, targets in scheduled_targets.values():
+        if rule['action'] == action and pid in targets:
+            targets[pid] = False
+
+def apply_schedule(rule, pids, active, state):
+    for pid in pids:
+        manual = state.get(str(pid), {})
+        if rule['action'] == 'block':
+            if active:
+                block_process(pid)
+            elif not manual.get('blocked') and not held_by_schedule(pid, 'block'):  # nor one set by hand
+                unblock_process(pid)
+        elif active:
+            set_traffic_limit(pid, rule['percentage'])
+        elif manual.get('limit') is None and not held_by_schedule(pid, 'limit'):
+            remove_traffic_limit(pid)
+
+# Apply one instant's worth of scheduled transitions in a single firewall transaction
+def apply_scheduled_rules(changes):
+    with state_lock:
+        state = load_state()
+        names = running_names()
+        try:
+            with firewall.transaction():
+                for rule, active in changes:
+                    if active:
+                        targets = scheduled_targets.get(rule['id'], (rule, {}))[1]
+                        scheduled_targets[rule['id']] = (rule, targets)
+                        pids = [pid for pid in match_processes(rule, names) if pid not in targets]
+                        apply_schedule(rule, pids, True, state)
+                        targets.update(dict.fromkeys(pids, True))
+                    else:
+                        targets = scheduled_targets.pop(rule['id'], (rule, {}))[1]
+                        pids = set(match_processes(rule, names)) | {pid for pid, held in targets.items() if held}
+                        apply_schedule(rule, pids, False, state)
+        except FirewallError as e:
+            logger.error(f"Scheduled rules failed: {e}")
+
+# Name rules also cover processes started while they're active: the sampler calls this every tick with its
+# process list. Only pids it hasn't seen before are matched against the rules, so a tick without new
+# processes costs a set difference however many rules are active.
+scheduled_seen = set()  # pids already checked against the active name rules
+
+def enforce_scheduled_rules(processes):
+    global scheduled_seen
+    running = {p['pid']: p['name'] for p in processes}
+    with state_lock:
+        new = [(pid, (name or '').lower()) for pid, name in running.items() if pid not in scheduled_seen]
+        scheduled_seen = set(running)
+        pending = []
+        for rule, targets in scheduled_targets.values():
+            for pid in [pid for pid in targets if pid not in running]:
+                del targets[pid]
+            if new and rule.get('name'):
+                pids = [pid for pid in match_processes(rule, new) if pid not in targets]
+                if pids:
+                    pending.append((rule, targets, pids))
+        if not pending:
+            return
+        state = load_state()
+        try:
+            with firewall.transaction():
+                for rule, targets, pids in pending:
+                    apply_schedule(rule, pids, True, state)
+                    targets.update(dict.fromkeys(pids, True))
+        except FirewallError as e:
+            logger.error(f"Scheduled rules failed: {e}")
+            scheduled_seen -= {pid for _, _, pids in pending for pid in pids}  # try them again next tick
+
+# The state as the API shows it: processes held by an active schedule read as blocked or limited, and
+# `scheduled` lists the rule ids holding them. Only for display, the state file keeps manual rules only.
+def with_schedules(state):
+    with state_lock:
+        for rule, targets in scheduled_targets.values():
+            for pid, held in targets.items():
+                if not held:
+                    continue
+                entry = state[str(pid)] = {'blocked': False, 'limit': None, **state.get(str(pid), {})}
+                if rule['action'] == 'block':
+                    entry['blocked'] = True
+                elif entry.get('limit') is None:
+                    entry['limit'] = rule['percentage']
+                entry['scheduled'] = entry.get('scheduled', []) + [rule['id']]
+    return state
+
+rule_scheduler = RuleScheduler(apply_scheduled_rules)
 
 # User Activity Monitoring
 def on_move(x, y):
@@ -114,14 +419,20 @@ def on_press(key):
     global last_activity_time
     last_activity_time = time.time()
 
-# Start listeners
-mouse_listener = mouse.Listener(on_move=on_move, on_click=on_click)
-keyboard_listener = keyboard.Listener(on_press=on_press)
-mouse_listener.start()
-keyboard_listener.start()
+# Listeners are started once from startup(), not at import time
+mouse_listener = None
+keyboard_listener = None
+
+def start_listeners():
+    global mouse_listener, keyboard_listener
+    if mouse_listener is None and mouse is not None:
+        mouse_listener = mouse.Listener(on_move=on_move, on_click=on_click)
+        keyboard_listener = keyboard.Listener(on_press=on_press)
+        mouse_listener.start()
+        keyboard_listener.start()
 
 def is_user_away():
-    return time.time() - last_activity_time > idle_threshold
+    return mouse is not None and time.time() - last_activity_time > idle_threshold
 
 # Process Throttling (using nice)
 def throttle_processes():
@@ -134,77 +445,306 @@ def throttle_processes():
             pass
 
 # Flask API Endpoints
+# Serves the sampler's latest snapshot; the (weak) ETag is its generation, so polling between ticks gets a 304
 @app.route('/processes', methods=['GET'])
 def list_processes():
     try:
-        processes = get_processes()
-        process_info = []
-        state = load_state()
-        for p in processes:
-            pid = p['pid']
-            name = p['name']
-            cpu_percent = p['cpu_percent']
-            memory_percent = p['memory_percent']
-            num_threads = p['num_threads']
-            io_counters = p['io_counters']
-            traffic_usage = io_counters.read_bytes + io_counters.write_bytes if io_counters else 0
-            traffic_usage_mb = traffic_usage / (1024 * 1024)
-            process_info.append({
-                'pid': pid,
-                'name': name,
-                'cpu_percent': cpu_percent,
-                'memory_percent': memory_percent,
-                'num_threads': num_threads,
-                'traffic_usage': traffic_usage,
-                'traffic_usage_mb': traffic_usage_mb,
-                'blocked': state.get(str(pid), {}).get('blocked', False),
-                'limit': state.get(str(pid), {}).get('limit', None),
-                'historical_data': list(historical_data.get(pid, []))
-            })
-
-        # Sorting Logic (Improved)
-        sort_by = request.args.get('sort_by', 'traffic_usage')
-        sort_order = request.args.get('sort_order', 'desc')
-
-        if sort_by == 'traffic_usage':
-            process_info.sort(key=lambda x: x['traffic_usage_mb'], reverse=(sort_order == 'desc'))
-        elif sort_by == 'name':
-            process_info.sort(key=lambda x: x['name'], reverse=(sort_order == 'desc'))
-        elif sort_by == 'pid':
-            process_info.sort(key=lambda x: x['pid'], reverse=(sort_order == 'desc'))
-
-        return jsonify(process_info)
+        start_sampler()
+        if snapshot['processes'] is None:
+            publish_snapshot()
+        current = snapshot
+        etag = f"{broadcaster.epoch}-{current['generation']}"
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        # fields=, name=, match=, sort_by=, sort_order=, top=, cursor=, history= (see query.py) and format=columnar
+        cache_key = (current['generation'], tuple(sorted(request.args.items(multi=True))))
+        cached = response_cache.get(cache_key)  # repeat requests this generation are a lookup
+        if cached is None:
+            output = request.args.get('format', 'rows')
+            try:
+                if output not in ('rows', 'columnar'):
+                    raise ValueError("format must be 'rows' or 'columnar'")
+                query = parse_query(request.args)
+                if output == 'columnar':
+                    rows, matched, next_cursor = select_columns(current['columns'], **query)
+                else:
+                    rows, matched, next_cursor = select_processes(current['processes'], **query)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            headers = {'X-Total-Count': str(matched)}
+            if next_cursor:
+                headers['X-Next-Cursor'] = next_cursor
+            cached = response_cache.put(cache_key, json.dumps(rows).encode(), headers)
+
+        body, encoding = cached.encoded(request.accept_encodings['gzip'] > 0)
+        response = app.response_class(body, mimetype='application/json', headers=cached.headers)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.set_etag(etag, weak=True)  # weak: the gzip and identity bodies are the same data, not the same bytes
+        response.headers['Cache-Control'] = 'no-cache'  # browsers revalidate with If-None-Match every time
+        return response
 
     except PermissionError as e:
         logger.error(str(e))
         return jsonify({'error': str(e)}), 500
 
+# A pid's saved entry, updated in place so the keys a change doesn't touch (priority, download limit) survive
+def state_entry(state, pid):
+    return state.setdefault(str(pid), {'blocked': False, 'limit': None})
+
+# Run a shaper or schedule change now, or queue it on `deferred` to run once the firewall transaction commits
+def shape(deferred, change, *args):
+    if deferred is None:
+        change(*args)
+    else:
+        deferred.append((change, args))
+
+# Rule changes for one pid, applied to an already loaded state; the caller saves it once. Firewall rules go
+# through the current transaction, everything else through shape()
+def apply_block(state, pid, deferred=None):
+    block_process(pid)
+    shape(deferred, remove_traffic_limit, pid)
+    shape(deferred, remove_download_limit, pid)
+    shape(deferred, override_schedules, pid, 'limit')
+    state_entry(state, pid).update(blocked=True, limit=None, download_limit=None)
+
+def apply_unblock(state, pid, deferred=None):
+    unblock_process(pid)
+    shape(deferred, remove_traffic_limit, pid)
+    shape(deferred, remove_download_limit, pid)
+    shape(deferred, override_schedules, pid, 'block')
+    shape(deferred, override_schedules, pid, 'limit')
+    state_entry(state, pid).update(blocked=False, limit=None, download_limit=None)
+
+def apply_limit(state, pid, percentage, direction='upload', deferred=None):
+    if direction == 'download':
+        if percentage in (None, ''):
+            shape(deferred, remove_download_limit, pid)
+            percentage = None
+        else:
+            shape(deferred, set_download_limit, pid, percentage)
+        state_entry(state, pid)['download_limit'] = percentage
+        return
+    if percentage in (None, ''):
+        shape(deferred, remove_traffic_limit, pid)
+        shape(deferred, override_schedules, pid, 'limit')
+        percentage = None
+    else:
+        shape(deferred, set_traffic_limit, pid, percentage)
+    state_entry(state, pid).update(blocked=False, limit=percentage)
+
+# The pid of a single-process request, raising ValueError on bad input
+def parse_pid(value):
+    if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, str) and value.isdigit())):
+        raise ValueError("pid must be an integer")
+    return int(value)
+
+# Check the percentage and direction of a limit request, raising ValueError on bad input
+def check_limit(item):
+    percentage = item.get('percentage')
+    if percentage not in (None, '') and not (isinstance(percentage, (int, float)) and 0 < percentage <= 100):
+        raise ValueError("percentage must be between 0 and 100, or null to remove the limit")
+    if item.get('direction', 'upload') not in (None, 'upload', 'download'):
+        raise ValueError("direction must be 'upload' or 'download'")
+
 @app.route('/block', methods=['POST'])
 def block():
-    pid = request.json.get('pid')
-    block_process(pid)
-    state = load_state()
-    state[str(pid)] = {'blocked': True, 'limit': None}
-    save_state(state)
+    try:
+        pid = parse_pid((request.get_json(silent=True) or {}).get('pid'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with state_lock:
+        state = load_state()
+        apply_block(state, pid)
+        save_state(state)
     return jsonify({'status': 'success'})
 
 @app.route('/unblock', methods=['POST'])
 def unblock():
-    pid = request.json.get('pid')
-    unblock_process(pid)
-    state = load_state()
-    state[str(pid)] = {'blocked': False, 'limit': None}
-    save_state(state)
+    try:
+        pid = parse_pid((request.get_json(silent=True) or {}).get('pid'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with state_lock:
+        state = load_state()
+        apply_unblock(state, pid)
+        save_state(state)
     return jsonify({'status': 'success'})
 
 @app.route('/limit', methods=['POST'])
 def limit():
-    pid = request.json.get('pid')
-    percentage = request.json.get('percentage')
-    set_traffic_limit(pid, percentage)
-    state = load_state()
-    state[str(pid)] = {'blocked': False, 'limit': percentage}
-    save_state(state)
+    body = request.get_json(silent=True) or {}
+    try:
+        pid = parse_pid(body.get('pid'))
+        check_limit(body)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with state_lock:
+        state = load_state()
+        apply_limit(state, pid, body.get('percentage'), body.get('direction'))
+        save_state(state)
+    return jsonify({'status': 'success'})
+
+BATCH_OPS = ('block', 'unblock', 'limit')
+
+# Check one /rules/batch item and resolve its target pids, raising ValueError on bad input
+def resolve_batch_item(item, processes):
+    if not isinstance(item, dict) or item.get('op') not in BATCH_OPS:
+        raise ValueError(f"op must be one of {', '.join(BATCH_OPS)}")
+    if item['op'] == 'limit':
+        check_limit(item)
+    selectors = [key for key in ('pid', 'pids', 'name', 'match', 'group') if item.get(key) not in (None, '', [])]
+    if len(selectors) != 1:
+        raise ValueError("give exactly one of pid, pids, name, match or group")
+    selector = selectors[0]
+    if selector in ('pid', 'pids'):
+        pids = item[selector] if isinstance(item[selector], list) else [item[selector]]
+        if not all(isinstance(pid, int) or (isinstance(pid, str) and pid.isdigit()) for pid in pids):
+            raise ValueError("pids must be integers")
+        return [int(pid) for pid in pids]
+    if selector == 'name':
+        return match_processes({'name': item['name']}, [(p['pid'], (p['name'] or '').lower()) for p in processes])
+    if selector == 'match':
+        try:
+            pattern = re.compile(item['match'], re.IGNORECASE)
+        except re.error as e:
+            raise ValueError(f"invalid match pattern: {e}")
+        return [p['pid'] for p in processes if pattern.search(p['name'] or '') or pattern.search(p.get('exe') or '')]
+    group = int(item['group'])  # POSIX process group, e.g. a whole shell job or a browser and its helpers
+    pids = []
+    for p in processes:
+        try:
+            if os.getpgid(p['pid']) == group:
+                pids.append(p['pid'])
+        except OSError:
+            pass
+    return pids
+
+# Apply many block/unblock/limit operations at once: everything is validated first, then applied in one
+# firewall transaction with one state write. {"rules": [{"op": "block", "name": "steam"},
+# {"op": "limit", "match": "^(rsync|restic)$", "percentage": 25}, {"op": "unblock", "pids": [1, 2]}]}
+@app.route('/rules/batch', methods=['POST'])
+def rules_batch():
+    result, status = run_batch((request.json or {}).get('rules'))
+    return jsonify(result), status
+
+# Shared by /rules/batch and the control socket; returns (response, HTTP status)
+def run_batch(items):
+    if not isinstance(items, list) or not items:
+        return {'status': 'error', 'error': "rules must be a non-empty list"}, 400
+    processes = get_processes()
+    resolved, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            resolved.append(resolve_batch_item(item, processes))
+        except (TypeError, ValueError) as e:
+            errors.append({'index': index, 'error': str(e)})
+    if errors:
+        return {'status': 'error', 'errors': errors}, 400
+
+    results, queued = [], []
+    with state_lock:
+        state = load_state()
+        try:
+            with firewall.transaction():
+                for index, (item, pids) in enumerate(zip(items, resolved)):
+                    result = {'index': index, 'op': item['op'], 'pids': pids,
+                              'status': 'success' if pids else 'no_match'}
+                    deferred = []
+                    try:
+                        for pid in pids:
+                            if item['op'] == 'block':
+                                apply_block(state, pid, deferred)
+                            elif item['op'] == 'unblock':
+                                apply_unblock(state, pid, deferred)
+                            else:
+                                apply_limit(state, pid, item.get('percentage'), item.get('direction', 'upload'),
+                                            deferred)
+                    except Exception as e:
+                        logger.exception(f"Batch rule {index} failed")
+                        result.update(status='error', error=str(e))
+                    results.append(result)
+                    queued.append((result, deferred))
+        except FirewallError as e:
+            # Nothing reached the kernel and the shaper changes were only queued: keep the saved state,
+            # so what we report and store still matches the kernel
+            for result in results:
+                if result['status'] == 'success':
+                    result.update(status='error', error=str(e))
+            return {'status': 'error', 'error': str(e), 'results': results}, 500
+        # The firewall rules are in: now the limits and schedule overrides that go with them
+        for result, deferred in queued:
+            try:
+                for change, args in deferred:
+                    change(*args)
+            except Exception as e:
+                logger.exception(f"Batch rule {result['index']} failed")
+                result.update(status='error', error=str(e))
+        save_state(state)
+    return {'status': 'success', 'results': results}, 200
+
+# Control socket: the same operations for scripts, without HTTP. See control.py and waterwall_cli.py.
+# JSON request values as the query strings parse_query() expects: lists (`"fields": ["pid", "name"]`) are
+# comma-joined like in a URL, anything that isn't a scalar is refused
+def query_value(key, value):
+    if isinstance(value, list) and all(isinstance(item, (str, int, float)) for item in value):
+        return ','.join(str(item) for item in value)
+    if isinstance(value, (dict, list)):
+        raise ValueError(f"{key} must be a string, a number or a list of them")
+    return str(value)
+
+def control_query(request_args):
+    if snapshot['processes'] is None:
+        publish_snapshot()
+    current = snapshot
+    args = {key: query_value(key, value) for key, value in request_args.items()
+            if key not in ('op', 'id') and value is not None}
+    query = parse_query(args)
+    if args.get('format') == 'columnar':
+        rows, matched, next_cursor = select_columns(current['columns'], **query)
+    else:
+        rows, matched, next_cursor = select_processes(current['processes'], **query)
+    return {'generation': current['generation'], 'processes': rows, 'matched': matched, 'next_cursor': next_cursor}
+
+def control_rules(items):
+    result, status = run_batch(items)
+    if status != 200:
+        raise ValueError(result.get('error') or json.dumps(result['errors']))
+    return result['results']
+
+control_server = ControlServer(os.environ.get('WATERWALL_SOCKET', DEFAULT_SOCKET), {
+    'ping': lambda request: 'pong',
+    'query': control_query,
+    'block': lambda request: control_rules([{**request, 'op': 'block'}]),
+    'unblock': lambda request: control_rules([{**request, 'op': 'unblock'}]),
+    'limit': lambda request: control_rules([{**request, 'op': 'limit'}]),
+    'batch': lambda request: control_rules(request.get('rules')),
+    'stats': lambda request: {**firewall.stats(), **shaper.stats(), 'stream': broadcaster.stats()},
+}, broadcaster)
+
+# Latency priority per process: interactive, normal or bulk. Accepts one pid or a list of pids,
+# and every process in the request is reclassified in one batch.
+@app.route('/priority', methods=['POST'])
+def priority():
+    body = request.get_json(silent=True) or {}
+    pids = body.get('pids') or [body.get('pid')]
+    level = body.get('priority', 'normal')
+    if level not in PRIORITIES:
+        return jsonify({'error': f"priority must be one of {', '.join(PRIORITIES)}"}), 400
+    if not isinstance(pids, list) or not all(isinstance(pid, int) or (isinstance(pid, str) and pid.isdigit())
+                                             for pid in pids):
+        return jsonify({'error': "give a pid or a list of pids"}), 400
+    pids = [int(pid) for pid in pids]
+    with state_lock:
+        shaper.set_priorities({str(pid): ([pid], level) for pid in pids})
+        state = load_state()
+        for pid in pids:
+            state_entry(state, pid)['priority'] = level
+        save_state(state)
     return jsonify({'status': 'success'})
 
 @app.route('/user_status', methods=['GET'])
@@ -216,42 +756,229 @@ def throttle():
     throttle_processes()
     return jsonify({'status': 'success'})
 
-# Server-Sent Events (SSE) for Real-time Updates
+# Blocklist names end up in ipset names and `ipset restore` input, so nothing but a plain word gets through
+def valid_set_name(name):
+    return isinstance(name, str) and re.fullmatch(r'[A-Za-z0-9_-]+', name) is not None
+
+# Load or update an IP/CIDR blocklist, either inline entries or a feed file on disk
+@app.route('/blocklist', methods=['POST'])
+def blocklist():
+    name = request.json.get('name', 'default')
+    if not valid_set_name(name):
+        return jsonify({'error': "name may only contain letters, digits, '_' and '-'"}), 400
+    if 'path' in request.json:
+        networks = load_feed(request.json['path'])
+    else:
+        networks = parse_entries(request.json.get('entries', []))
+    try:
+        result = import_blocklist(firewall, name, networks)
+    except FirewallError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 500
+    return jsonify({'status': 'success', **result})
+
+# Block a list of domains; addresses are re-resolved as their TTLs expire
+@app.route('/domain_blocklist', methods=['POST'])
+def domain_blocklist():
+    name = request.json.get('name', 'domains')
+    if not valid_set_name(name):
+        return jsonify({'error': "name may only contain letters, digits, '_' and '-'"}), 400
+    if 'path' in request.json:
+        with open(request.json['path'], 'r') as f:
+            domains = f.read().split()
+    else:
+        domains = request.json.get('domains', [])
+    if name not in domain_blocklists:
+        resolver = DomainResolver(nameserver=request.json.get('nameserver'))
+        domain_blocklists[name] = DomainBlocklist(firewall, name, resolver)
+    added, removed = domain_blocklists[name].set_domains(domains)
+    return jsonify({'status': 'success', 'added': added, 'removed': removed})
+
+@app.route('/domain_blocklist', methods=['GET'])
+def domain_blocklist_status():
+    return jsonify([blocklist.stats() for blocklist in domain_blocklists.values()])
+
+# Time-scheduled block/limit rules, stored next to the per-process entries
+@app.route('/schedules', methods=['GET'])
+def list_schedules():
+    return jsonify(load_state().get('schedules', []))
+
+@app.route('/schedules', methods=['POST'])
+def add_schedule():
+    try:
+        rule = normalize_rule(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with state_lock:
+        state = load_state()
+        state['schedules'] = [r for r in state.get('schedules', []) if r['id'] != rule['id']] + [rule]
+        save_state(state)
+    rule_scheduler.set_rules(state['schedules'])
+    return jsonify({'status': 'success', 'rule': rule})
+
+@app.route('/schedules/<rule_id>', methods=['DELETE'])
+def delete_schedule(rule_id):
+    with state_lock:
+        state = load_state()
+        state['schedules'] = [r for r in state.get('schedules', []) if r['id'] != rule_id]
+        save_state(state)
+    rule_scheduler.set_rules(state['schedules'])
+    return jsonify({'status': 'success'})
+
+# Link capacity that 100% refers to; POST an override in bytes/s, or null to go back to estimating
+@app.route('/capacity', methods=['GET'])
+def get_capacity():
+    return jsonify({'upload': capacity.stats(), 'download': download_capacity.stats()})
+
+@app.route('/capacity', methods=['POST'])
+def set_capacity():
+    body = request.get_json(silent=True) or {}
+    override = body.get('override')
+    if override and (isinstance(override, bool) or not (isinstance(override, (int, float)) and override > 0)):
+        return jsonify({'error': "override must be a positive number of bytes per second, or null"}), 400
+    if body.get('direction', 'upload') not in ('upload', 'download'):
+        return jsonify({'error': "direction must be 'upload' or 'download'"}), 400
+    download = body.get('direction') == 'download'
+    estimator = download_capacity if download else capacity
+    with state_lock:
+        estimator.set_override(int(override) if override else None)
+        state = load_state()
+        state['download_capacity_override' if download else 'capacity_override'] = estimator.override
+        save_state(state)
+        reapply_limits()
+    return jsonify(estimator.stats())
+
+# Dynamic fair sharing of the uplink; POST {"enabled": true, "weights": {"firefox": 4, "restic": 0.5}}
+@app.route('/fair_share', methods=['GET'])
+def get_fair_share():
+    return jsonify(fair_share.stats())
+
+@app.route('/fair_share', methods=['POST'])
+def set_fair_share():
+    enabled = request.json.get('enabled')
+    weights = request.json.get('weights')
+    try:
+        fair_share.configure(enabled, weights)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    with state_lock:
+        state = load_state()
+        state['fair_share'] = {'enabled': fair_share.enabled, 'weights': fair_share.weights}
+        save_state(state)
+    return jsonify(fair_share.stats())
+
+@app.route('/firewall_stats', methods=['GET'])
+def firewall_stats():
+    return jsonify({**firewall.stats(), **shaper.stats()})
+
+# Build the process list once, stamp it with a new generation and hand it to the stream clients
+def publish_snapshot():
+    global snapshot
+    started = time.time()
+    get_processes()
+    sample = process_cache  # rows and columns both come from this one refresh
+    state = with_schedules(load_state())
+    process_info = [build_process_info(p, state) for p in sample['processes']]
+    columns = build_columns(sample['columns'], state)
+    with snapshot_lock:  # generations and stream sequence numbers advance in the same order
+        snapshot = {'generation': snapshot['generation'] + 1, 'processes': process_info, 'columns': columns}
+        broadcaster.publish(process_info)
+        sampler_timing['last_publish'] = time.time() - started
+        sampler_timing['publishes'] += 1
+        sampler_timing['publish_seconds'] += sampler_timing['last_publish']
+
+# Sampler: diffs and serializes the process list once per interval, however many clients listen
+def sampler_loop():
+    while True:
+        try:
+            enforce_scheduled_rules(get_processes())
+            publish_snapshot()
+        except Exception:
+            logger.exception("Sampler tick failed")
+        time.sleep(intervalTime / 1000)
+
+def start_sampler():
+    global sampler_thread
+    with sampler_lock:
+        if sampler_thread is None:
+            sampler_thread = threading.Thread(target=sampler_loop, name='sampler', daemon=True)
+            sampler_thread.start()
+
+# Server-Sent Events (SSE) for Real-time Updates: a `snapshot` event, then one `delta` event per tick
 @app.route('/process_stream')
 def process_stream():
+    start_sampler()
+    # Browsers resend the last id on reconnect; a query parameter lets a fresh EventSource resume too
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        fmt = sse_format(request.args.get('format', 'sse'))
+        subscriber = broadcaster.subscribe(last_event_id, name=request.remote_addr, fmt=fmt)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     def generate():
-        while True:
-            processes = get_processes()
-            process_info = []
-            state = load_state()
-            for p in processes:
-                pid = p['pid']
-                name = p['name']
-                cpu_percent = p['cpu_percent']
-                memory_percent = p['memory_percent']
-                num_threads = p['num_threads']
-                io_counters = p['io_counters']
-                traffic_usage = io_counters.read_bytes + io_counters.write_bytes if io_counters else 0
-                traffic_usage_mb = traffic_usage / (1024 * 1024)
-                process_info.append({
-                    'pid': pid,
-                    'name': name,
-                    'cpu_percent': cpu_percent,
-                    'memory_percent': memory_percent,
-                    'num_threads': num_threads,
-                    'traffic_usage': traffic_usage,
-                    'traffic_usage_mb': traffic_usage_mb,
-                    'blocked': state.get(str(pid), {}).get('blocked', False),
-                    'limit': state.get(str(pid), {}).get('limit', None),
-                    'historical_data': list(historical_data.get(pid, []))
-                })
-
-            # Send the processes array directly
-            yield f"data: {json.dumps(process_info)}\n\n"  # Fixed: Send array directly
-            time.sleep(intervalTime / 1000)
+        try:
+            while True:
+                event = subscriber.get()
+                yield event if event is not None else b": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
 
     return Response(generate(), mimetype='text/event-stream')
 
+# Binary WebSocket stream: the same snapshot/delta sequence as packed frames (see stream.binary_frame)
+if sock:
+    @sock.route('/process_ws')
+    def process_ws(ws):
+        start_sampler()
+        subscriber = broadcaster.subscribe(request.args.get('last_event_id'), name=request.remote_addr, fmt='binary')
+        try:
+            while True:
+                frame = subscriber.get()
+                if frame is not None:
+                    ws.send(frame)
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+@app.route('/stream_stats', methods=['GET'])
+def stream_stats():
+    return jsonify({**broadcaster.stats(), 'response_cache': response_cache.stats()})
+
+# Prometheus exposition. The per-executable series are rendered once per snapshot generation (top
+# WATERWALL_METRICS_TOP executables by throughput, the rest as exe="other"); only the handful of
+# server-wide counters below are formatted on every scrape.
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if snapshot['processes'] is None:
+        publish_snapshot()
+    current = snapshot
+    stream = broadcaster.counts()
+    timing = dict(sampler_timing)
+    cache = response_cache.stats()
+    text = metrics_renderer.groups(current['generation'], current['columns']) + ''.join([
+        family('waterwall_processes', 'gauge', "Processes in the latest snapshot", [('', len(current['processes']))]),
+        family('waterwall_snapshot_generation', 'gauge', "Generation of the latest snapshot",
+               [('', current['generation'])]),
+        summary('waterwall_sample_duration_seconds', "Time to walk the process table and read the counters",
+                timing['samples'], timing['sample_seconds']),
+        summary('waterwall_publish_duration_seconds', "Time to sample (when due), build and publish a snapshot",
+                timing['publishes'], timing['publish_seconds']),
+        family('waterwall_publish_last_duration_seconds', 'gauge', "Duration of the latest publish",
+               [('', timing['last_publish'])]),
+        family('waterwall_stream_clients', 'gauge', "Connected stream clients",
+               [(f'format="{fmt}"', count) for fmt, count in stream['clients'].items()]),
+        family('waterwall_stream_published_total', 'counter', "Ticks published to stream clients",
+               [('', stream['published'])]),
+        family('waterwall_stream_replayed_total', 'counter', "Deltas replayed to resuming clients",
+               [('', stream['replayed'])]),
+        family('waterwall_stream_resyncs_total', 'counter', "Snapshots sent to clients that fell behind",
+               [('', stream['resyncs'])]),
+        family('waterwall_response_cache_hits_total', 'counter', "/processes bodies served from the cache",
+               [('', cache['hits'])]),
+        family('waterwall_response_cache_misses_total', 'counter', "/processes bodies serialized",
+               [('', cache['misses'])]),
+    ])
+    return Response(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # HTML for the Web Interface
 @app.route('/')
 def index():
@@ -426,6 +1153,7 @@ def index():
         <div id="quote"></div>
         <div class="button-row">
             <button onclick="fetchProcesses()">Refresh Process List</button>
+            <button onclick="connectLiveStream()">Live Stream</button>
             <button onclick="toggleDarkMode()">Toggle Dark Mode</button>
             <button onclick="analyzeCyberSpaceHaze()">AI Analyze</button>
             <button onclick="intruderWaterPlay()">Intruder Water Play</button>
@@ -482,6 +1210,7 @@ def index():
         let isDarkMode = false;
         let chart;
         let sortCriteria = 'traffic_desc';
+        const processPageSize = 50; // the server selects the top rows, the page doesn't need thousands of cards
         let graphRefreshEnabled = true; // Track graph refresh status
         const quotes = [ // Added quotes array in JavaScript
             "The only way to do great work is to love what you do. - Steve Jobs",
@@ -499,7 +1228,9 @@ def index():
         async function fetchProcesses() {
             $('.loading').style.display = 'block'; // Show loading indicator
             try {
-                const response = await fetch(`/processes?sort=${sortCriteria}`);
+                const [sortBy, sortOrder] = sortCriteria.split('_');
+                const sortField = sortBy === 'traffic' ? 'traffic_usage' : sortBy;
+                const response = await fetch(`/processes?sort_by=${sortField}&sort_order=${sortOrder}&top=${processPageSize}`);
                 if (!response.ok) {
                     throw new Error(`HTTP error! status: ${response.status}`);
                 }
@@ -546,18 +1277,111 @@ def index():
                 card.innerHTML = `
                     <h3>${process.name} (PID: ${process.pid})</h3>
                     <p>Traffic Usage: ${(process.traffic_usage_mb).toFixed(2)} MB</p>
-                    <p>Status: ${process.blocked ? 'Blocked' : 'Active'}</p>
+                    <p>Status: ${process.blocked ? `Blocked${process.scheduled.length ? ' by schedule' : ''} (dropped ${formatBytes(process.dropped_bytes)})` : 'Active'} &middot; Priority: ${process.priority}</p>
+                    ${process.limit_status ? `<p>Limit: ${formatBytes(process.limit_status.target)}/s, measured ${formatBytes(process.limit_status.measured || 0)}/s (${process.limit_status.status})</p>` : ''}
                     <div class="button-group">
                         <button onclick="toggleBlock(${process.pid}, ${process.blocked})">${process.blocked ? 'Unblock' : 'Block'}</button>
                         <button onclick="setLimit(${process.pid}, 75)">Limit 75%</button>
                         <button onclick="setLimit(${process.pid}, 50)">Limit 50%</button>
                         <button onclick="setLimit(${process.pid}, 25)">Limit 25%</button>
+                        <button onclick="setLimit(${process.pid}, 25, 'download')">Limit Download 25%</button>
+                        <button onclick="setPriority(${process.pid}, '${process.priority === 'interactive' ? 'normal' : 'interactive'}')">${process.priority === 'interactive' ? 'Normal Priority' : 'Interactive'}</button>
+                        <button onclick="setPriority(${process.pid}, '${process.priority === 'bulk' ? 'normal' : 'bulk'}')">${process.priority === 'bulk' ? 'Normal Priority' : 'Bulk'}</button>
                     </div>
                 `;
                 processList.appendChild(card);
             });
         }
 
+        // Live updates over /process_ws: each binary frame is a JSON header plus packed little-endian arrays
+        let liveProcesses = new Map();
+        let liveSocket;
+        let liveEventId = null;
+        let liveSeq = null;
+        let liveMaxLength = 60;
+
+        function applyLiveFrame(buffer) {
+            const headerLength = new DataView(buffer).getUint32(0, true);
+            const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+            if (header.type === 'snapshot') {
+                liveProcesses = new Map();
+                liveMaxLength = header.max_length || liveMaxLength;
+            } else if (header.base !== liveSeq) {
+                liveEventId = null; // missed frames, reconnect for a fresh snapshot
+                liveSocket.close();
+                return;
+            }
+            liveSeq = header.seq;
+            liveEventId = header.id;
+            header.removed.forEach(pid => liveProcesses.delete(pid));
+            header.added.forEach(pid => liveProcesses.set(pid, { pid }));
+            Object.entries(header.fields).forEach(([pid, fields]) => Object.assign(liveProcesses.get(Number(pid)), fields));
+
+            let offset = 4 + headerLength;
+            const pids = new Uint32Array(buffer, offset, header.rows);
+            offset += header.rows * 4;
+            header.columns.forEach(([name, type]) => {
+                const values = type === 'u32' ? new Uint32Array(buffer, offset, header.rows) : new Float32Array(buffer, offset, header.rows);
+                offset += header.rows * 4;
+                pids.forEach((pid, i) => {
+                    if (type === 'u32' ? values[i] !== 0xFFFFFFFF : !Number.isNaN(values[i])) {
+                        liveProcesses.get(pid)[name] = values[i];
+                    }
+                });
+            });
+            header.series.forEach(([name, total]) => {
+                const counts = new Uint32Array(buffer, offset, header.rows);
+                offset += header.rows * 4;
+                const points = new Float32Array(buffer, offset, total);
+                offset += total * 4;
+                let start = 0;
+                pids.forEach((pid, i) => {
+                    const count = counts[i] & 0x7FFFFFFF;
+                    const fresh = Array.from(points.subarray(start, start + count));
+                    const process = liveProcesses.get(pid);
+                    start += count;
+                    if (counts[i] & 0x80000000) {
+                        process[name] = fresh;
+                    } else if (count) {
+                        process[name] = (process[name] || []).concat(fresh).slice(-liveMaxLength);
+                    }
+                });
+            });
+            updateProcessList([...liveProcesses.values()]);
+        }
+
+        function connectLiveStream() {
+            if (liveSocket && liveSocket.readyState <= WebSocket.OPEN) {
+                return;
+            }
+            const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+            const resume = liveEventId ? `?last_event_id=${encodeURIComponent(liveEventId)}` : '';
+            let received = false;
+            liveSocket = new WebSocket(`${scheme}://${location.host}/process_ws${resume}`);
+            liveSocket.binaryType = 'arraybuffer';
+            liveSocket.onmessage = event => {
+                received = true;
+                applyLiveFrame(event.data);
+            };
+            liveSocket.onclose = () => {
+                if (!received && liveSeq === null) {
+                    showMessage('Live stream unavailable (install flask-sock), use the refresh interval instead');
+                    return;
+                }
+                setTimeout(connectLiveStream, 2000);
+            };
+        }
+
+        function formatBytes(bytes) {
+            const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+            let i = 0;
+            while (bytes >= 1024 && i < units.length - 1) {
+                bytes /= 1024;
+                i++;
+            }
+            return `${bytes.toFixed(i ? 1 : 0)} ${units[i]}`;
+        }
+
         function toggleChart() {
             const chartContainer = $('#trafficChartContainer');
             if (chartContainer.style.display === 'none') {
@@ -582,7 +1406,7 @@ def index():
     const ctx = $('#trafficChart').getContext('2d');
 
     // Fetch latest process data
-    fetch('/processes')
+    fetch('/processes?history=all')
         .then(response => response.json())
         .then(processes => {
             const labels = generateTimeLabels();
@@ -675,7 +1499,7 @@ def index():
             }
         }
 
-        async function setLimit(pid, percentage) {
+        async function setLimit(pid, percentage, direction = 'upload') {
             $('.loading').style.display = 'block'; // Show loading indicator
             try {
                 const response = await fetch('/limit', {
@@ -683,12 +1507,12 @@ def index():
                     headers: {
                         'Content-Type': 'application/json'
                     },
-                    body: JSON.stringify({ pid, percentage: percentage })
+                    body: JSON.stringify({ pid, percentage: percentage, direction: direction })
                 });
                 if (!response.ok) {
                     throw new Error(`HTTP error! status: ${response.status}`);
                 }
-                showMessage(`Set traffic limit for process with PID ${pid} to ${percentage}%`);
+                showMessage(`Set ${direction} limit for process with PID ${pid} to ${percentage}%`);
                 await fetchProcesses(); // Refresh process list
             } catch (error) {
                 console.error('Error setting limit:', error);
@@ -699,6 +1523,27 @@ def index():
             }
         }
 
+        async function setPriority(pid, priority) {
+            try {
+                const response = await fetch('/priority', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({ pid, priority })
+                });
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+                showMessage(`Set priority of process with PID ${pid} to ${priority}`);
+                await fetchProcesses(); // Refresh process list
+            } catch (error) {
+                console.error('Error setting priority:', error);
+                $('#errorMessage').textContent = `Error: ${error.message}. Please try again.`;
+                $('#errorMessage').style.display = 'block';
+            }
+        }
+
         function setIntervalTime() {
             clearInterval(intervalId);
             intervalTime = parseInt($('#intervalInput').value, 10);
@@ -812,7 +1657,82 @@ def index():
 </html>
 """
 
+# Put the saved blocks, limits and priorities of still-running processes back in place
+def restore_state():
+    state = load_state()
+    priorities = {}
+    try:
+        with firewall.transaction():
+            for key, entry in state.items():
+                if not key.isdigit() or not psutil.pid_exists(int(key)):
+                    continue
+                if entry.get('blocked'):
+                    block_process(int(key))
+                if entry.get('limit') is not None:
+                    set_traffic_limit(key, entry['limit'])
+                if entry.get('download_limit') is not None:
+                    set_download_limit(key, entry['download_limit'])
+                if entry.get('priority', 'normal') != 'normal':
+                    priorities[key] = ([int(key)], entry['priority'])
+    except FirewallError as e:
+        logger.error(f"Saved blocks could not be restored: {e}")
+    if priorities:
+        shaper.set_priorities(priorities)
+
+# Everything that must happen exactly once per process before serving
+def startup():
+    if firewall.name != 'simulated':
+        check_root()
+    restore_state()
+    rule_scheduler.set_rules(load_state().get('schedules', []))
+    rule_scheduler.start()
+    start_listeners()
+    start_sampler()
+    try:
+        control_server.start()
+    except OSError as e:
+        logger.warning(f"Control socket not available: {e}")
+
+# Take our limits and shaping back out of the kernel; blocks stay, they are part of the saved state
+def shutdown():
+    logger.info("Shutting down, removing limits and shaping")
+    rule_scheduler.stop()
+    control_server.stop()
+    if mouse_listener is not None:
+        mouse_listener.stop()
+        keyboard_listener.stop()
+    for component in (firewall, shaper, ingress_shaper):
+        try:
+            component.cleanup()
+        except Exception:
+            logger.exception(f"Cleanup of {component.name} failed")
+
+def handle_sigterm(signum, frame):
+    raise SystemExit(0)  # unwinds serve_forever() so shutdown() runs in the main thread
+
+# Threaded server: one thread per connection, so hundreds of long-lived streams don't starve requests.
+# WATERWALL_SERVER=asyncio serves streams from an event loop instead, for thousands of mostly idle dashboards.
+# WATERWALL_DEBUG=1 runs the Flask debugger instead (without the reloader, which would start everything twice).
+def serve(host, port):
+    from werkzeug.serving import make_server
+    startup()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        if os.environ.get('WATERWALL_DEBUG'):
+            app.run(host=host, port=port, debug=True, use_reloader=False, threaded=True)
+        elif os.environ.get('WATERWALL_SERVER') == 'asyncio':
+            asyncio.run(AsyncServer(app, broadcaster, host, port).serve_forever())
+        else:
+            server = make_server(host, port, app, threaded=True)
+            logger.info(f"Serving on http://{host}:{port}")
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown()
+
 if __name__ == '__main__':
-    check_root()
-    webbrowser.open('http://127.0.0.1:5000')
-    app.run(debug=True)
+    host = os.environ.get('WATERWALL_HOST', '127.0.0.1')
+    port = int(os.environ.get('WATERWALL_PORT', 5000))
+    webbrowser.open(f'http://{host}:{port}')
+    serve(host, port)
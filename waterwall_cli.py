@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Thin client for the WaterWall control socket. Standard library only, so it starts in milliseconds:
+#   waterwall_cli.py ps --top 10 --sort-by rate --fields pid,name,rate
+#   waterwall_cli.py block --name steam
+#   waterwall_cli.py limit 25 1234 5678 --download
+#   waterwall_cli.py watch
+#   generate-ops | waterwall_cli.py pipe      (one JSON request per line, one reply per line)
+import argparse
+import json
+import os
+import socket
+import sys
+
+from control import DEFAULT_SOCKET, read_frame, write_frame
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        sys.exit(f"waterwall: cannot connect to {path}: {e}")
+    return sock
+
+
+def call(sock, request):
+    write_frame(sock, request)
+    reply = read_frame(sock)
+    if reply is None:
+        sys.exit("waterwall: connection closed by server")
+    return reply
+
+
+def target(args):
+    if args.name:
+        return {'name': args.name}
+    if args.match:
+        return {'match': args.match}
+    if args.group is not None:
+        return {'group': args.group}
+    if not args.pids:
+        sys.exit("waterwall: give pids, --name, --match or --group")
+    return {'pids': args.pids}
+
+
+def add_target_options(parser):
+    parser.add_argument('pids', nargs='*', type=int)
+    parser.add_argument('--name', help="case-insensitive process name substring")
+    parser.add_argument('--match', help="regex on process name or executable")
+    parser.add_argument('--group', type=int, help="POSIX process group id")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='waterwall', description="Query and control WaterWall over its Unix socket")
+    parser.add_argument('--socket', default=os.environ.get('WATERWALL_SOCKET', DEFAULT_SOCKET))
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('ping')
+    commands.add_parser('stats')
+    ps = commands.add_parser('ps', help="list processes from the latest snapshot")
+    ps.add_argument('--top', type=int)
+    ps.add_argument('--sort-by', default='traffic_usage')
+    ps.add_argument('--asc', action='store_true')
+    ps.add_argument('--fields')
+    ps.add_argument('--name')
+    ps.add_argument('--match')
+    ps.add_argument('--history')
+    ps.add_argument('--cursor')
+    ps.add_argument('--columnar', action='store_true')
+    for op in ('block', 'unblock'):
+        add_target_options(commands.add_parser(op))
+    limit = commands.add_parser('limit', help="limit to a percentage of the link, 'none' removes the limit")
+    limit.add_argument('percentage')
+    add_target_options(limit)
+    limit.add_argument('--download', action='store_true')
+    batch = commands.add_parser('batch', help="apply a JSON list of rules from a file or stdin")
+    batch.add_argument('file', nargs='?', default='-')
+    watch = commands.add_parser('watch', help="print snapshot and delta events as JSON lines")
+    watch.add_argument('--last-event-id')
+    commands.add_parser('pipe', help="send JSON requests read from stdin over one connection")
+    return parser
+
+
+def request_for(args):
+    if args.command in ('ping', 'stats'):
+        return {'op': args.command}
+    if args.command == 'ps':
+        request = {'op': 'query', 'sort_by': args.sort_by, 'sort_order': 'asc' if args.asc else 'desc',
+                   'top': args.top, 'fields': args.fields, 'name': args.name, 'match': args.match,
+                   'history': args.history, 'cursor': args.cursor}
+        if args.columnar:
+            request['format'] = 'columnar'
+        return {key: value for key, value in request.items() if value is not None}
+    if args.command in ('block', 'unblock'):
+        return {'op': args.command, **target(args)}
+    if args.command == 'limit':
+        percentage = None if args.percentage.lower() == 'none' else float(args.percentage)
+        return {'op': 'limit', 'percentage': percentage, 'direction': 'download' if args.download else 'upload',
+                **target(args)}
+    if args.command == 'batch':
+        rules = json.load(sys.stdin if args.file == '-' else open(args.file))
+        return {'op': 'batch', 'rules': rules['rules'] if isinstance(rules, dict) else rules}
+    raise ValueError(args.command)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sock = connect(args.socket)
+    if args.command == 'pipe':
+        failed = False
+        for line in sys.stdin:
+            if line.strip():
+                reply = call(sock, json.loads(line))
+                failed = failed or not reply.get('ok')
+                print(json.dumps(reply), flush=True)
+        return 1 if failed else 0
+    if args.command == 'watch':
+        request = {'op': 'subscribe', 'format': 'json'}
+        if args.last_event_id:
+            request['last_event_id'] = args.last_event_id
+        reply = call(sock, request)
+        if not reply.get('ok'):
+            sys.exit(f"waterwall: {reply.get('error')}")
+        try:
+            while True:
+                event = read_frame(sock)
+                if event is None:
+                    return 0
+                print(json.dumps(event), flush=True)
+        except KeyboardInterrupt:
+            return 0
+    reply = call(sock, request_for(args))
+    if not reply.get('ok'):
+        print(f"waterwall: {reply.get('error')}", file=sys.stderr)
+        return 1
+    result = reply['result']
+    if args.command == 'ps' and not args.columnar:
+        for row in result['processes']:
+            print(json.dumps(row))
+        if result['next_cursor']:
+            print(f"# more: --cursor {result['next_cursor']}", file=sys.stderr)
+    else:
+        print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())